@@ -0,0 +1,282 @@
+"""Achievements: declarative threshold rules indexed by the metric they watch.
+
+Every rule unlocks when one metric of a player reaches a threshold. Rules
+are grouped per metric and sorted by threshold, and each loaded player
+keeps, per metric, the position of the first rule not yet unlocked. A
+metric update only walks forward from that position, so evaluating an
+event costs the same however many rules the catalogue holds. Events only
+touch the metrics they feed (EVENT_METRICS); derived metrics such as win
+and login streaks are kept incrementally in AchievementState and stored
+in the achievement_state table.
+"""
+import asyncio
+import json
+import logging
+from collections import OrderedDict, namedtuple
+
+logger = logging.getLogger(__name__)
+
+Rule = namedtuple('Rule', 'key title description metric threshold reward')
+
+RULES = (
+    Rule('first_win', '🥇 First Blood', 'Win your first battle', 'battles_won', 1, 10),
+    Rule('wins_10', '⚔️ Warrior', 'Win 10 battles', 'battles_won', 10, 25),
+    Rule('wins_100', '🗡️ Samurai', 'Win 100 battles', 'battles_won', 100, 100),
+    Rule('wins_1000', '🏯 Shogun', 'Win 1,000 battles', 'battles_won', 1000, 500),
+    Rule('streak_3', '🔥 On Fire', 'Win 3 battles in a row', 'win_streak', 3, 20),
+    Rule('streak_5', '☄️ Unstoppable', 'Win 5 battles in a row', 'win_streak', 5, 50),
+    Rule('streak_10', '🐉 Legendary', 'Win 10 battles in a row', 'win_streak', 10, 250),
+    Rule('coins_1000', '💰 Four Digits', 'Hold 1,000 coins', 'coins', 1000, 0),
+    Rule('coins_10000', '💎 Rich', 'Hold 10,000 coins', 'coins', 10_000, 0),
+    Rule('coins_100000', '👑 Tycoon', 'Hold 100,000 coins', 'coins', 100_000, 0),
+    Rule('login_3', '📅 Regular', 'Play 3 days in a row', 'login_streak', 3, 15),
+    Rule('login_7', '🗓️ Devoted', 'Play 7 days in a row', 'login_streak', 7, 50),
+    Rule('login_30', '🌸 Way of the Samurai', 'Play 30 days in a row', 'login_streak', 30, 300),
+)
+RULES_BY_KEY = {rule.key: rule for rule in RULES}
+
+# Metric -> its rules by ascending threshold
+RULES_BY_METRIC = {}
+for _rule in RULES:
+    RULES_BY_METRIC.setdefault(_rule.metric, []).append(_rule)
+for _rules in RULES_BY_METRIC.values():
+    _rules.sort(key=lambda rule: rule.threshold)
+
+# Events the engine consumes and the metrics each one can move
+EVENT_METRICS = {
+    'balance': ('coins', 'battles_won'),
+    'win': ('win_streak',),
+    'loss': ('win_streak',),
+    'active': ('login_streak',),
+}
+EVENTS = frozenset(EVENT_METRICS)
+
+
+class AchievementState:
+    """A player's unlocked rules, rule positions and streak counters."""
+
+    __slots__ = ('unlocked', 'next_rule', 'win_streak', 'best_streak', 'login_day', 'login_streak', 'dirty')
+
+    def __init__(self, unlocked=(), win_streak=0, best_streak=0, login_day=None, login_streak=0):
+        self.unlocked = set(unlocked)
+        self.next_rule = {}
+        for metric, rules in RULES_BY_METRIC.items():
+            position = 0
+            while position < len(rules) and rules[position].key in self.unlocked:
+                position += 1
+            self.next_rule[metric] = position
+        self.win_streak = win_streak
+        self.best_streak = best_streak
+        self.login_day = login_day
+        self.login_streak = login_streak
+        self.dirty = False
+
+    def metric(self, name):
+        return getattr(self, name, None)
+
+    def reach(self, metric, value):
+        """Rules of `metric` newly reached at `value`."""
+        rules = RULES_BY_METRIC.get(metric, ())
+        position = self.next_rule.get(metric, 0)
+        reached = []
+        while position < len(rules) and rules[position].threshold <= value:
+            if rules[position].key not in self.unlocked:
+                self.unlocked.add(rules[position].key)
+                reached.append(rules[position])
+            position += 1
+        self.next_rule[metric] = position
+        return reached
+
+    def apply(self, event, value):
+        """Update the state for one event; returns the rules it unlocked."""
+        if event == 'balance':
+            coins, battles_won = value
+            return self.reach('coins', coins) + self.reach('battles_won', battles_won)
+        if event == 'win':
+            self.win_streak += 1
+            self.best_streak = max(self.best_streak, self.win_streak)
+            self.dirty = True
+            return self.reach('win_streak', self.win_streak)
+        if event == 'loss':
+            if self.win_streak:
+                self.win_streak = 0
+                self.dirty = True
+            return []
+        if event == 'active':
+            if self.login_day == value:
+                return []
+            self.login_streak = self.login_streak + 1 if self.login_day == value - 1 else 1
+            self.login_day = value
+            self.dirty = True
+            return self.reach('login_streak', self.login_streak)
+        return []
+
+
+class AchievementEngine:
+    """Evaluates player events in batches off the handlers' path.
+
+    emit() only appends to a list. The run() task takes the batch every
+    `interval` seconds, loads the states of players it hasn't seen with
+    one read per shard, applies the events and writes the changed streaks
+    and new unlocks (with their rewards) as one write job per shard.
+    on_reward(user_id, coins, battles_won) is called for every reward paid.
+    Loaded states are kept for the `capacity` most recent players.
+    """
+
+    def __init__(self, db, on_reward=None, interval=5.0, capacity=100_000):
+        self.db = db
+        self.on_reward = on_reward
+        self.interval = interval
+        self.capacity = capacity
+        self.unlocked = 0
+        self._states = OrderedDict()
+        self._events = []
+        self._unlocks = []
+
+    def __len__(self):
+        return len(self._states)
+
+    def emit(self, user_id, event, value=None):
+        if event == 'active':
+            state = self._states.get(user_id)
+            if state is not None and state.login_day == value:
+                return
+        self._events.append((user_id, event, value))
+
+    async def state(self, user_id):
+        if user_id not in self._states:
+            await self._load([user_id])
+        self._states.move_to_end(user_id)
+        return self._states[user_id]
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.process()
+            except Exception as e:
+                logger.error(f"Achievement evaluation failed: {e}")
+
+    async def process(self):
+        events, self._events = self._events, []
+        missing = {user_id for user_id, _, _ in events if user_id not in self._states}
+        if missing:
+            await self._load(missing)
+        for user_id, event, value in events:
+            state = self._states[user_id]
+            self._states.move_to_end(user_id)
+            for rule in state.apply(event, value):
+                self._unlocks.append((user_id, rule.key))
+        await self.flush()
+        self._evict()
+        return len(events)
+
+    async def flush(self):
+        states = {user_id: state for user_id, state in self._states.items() if state.dirty}
+        unlocks, self._unlocks = self._unlocks, []
+        by_shard = {}
+        for user_id, state in states.items():
+            by_shard.setdefault(self.db.shard(user_id).index, ([], []))[0].append(
+                (user_id, state.win_streak, state.best_streak, state.login_day, state.login_streak)
+            )
+            state.dirty = False
+        for user_id, key in unlocks:
+            by_shard.setdefault(self.db.shard(user_id).index, ([], []))[1].append((user_id, key))
+
+        saved = await asyncio.gather(*(
+            self.db.shards[index].storage.write(save, rows, shard_unlocks)
+            for index, (rows, shard_unlocks) in by_shard.items()
+        ), return_exceptions=True)
+        for (rows, shard_unlocks), result in zip(by_shard.values(), saved):
+            if isinstance(result, Exception):
+                # Retried with the next batch
+                logger.error(f"Saving achievements failed: {result}")
+                for row in rows:
+                    if row[0] in self._states:
+                        self._states[row[0]].dirty = True
+                self._unlocks.extend(shard_unlocks)
+                continue
+            self.unlocked += len(result)
+            for user_id, coins, battles_won in result:
+                if self.on_reward and coins is not None:
+                    self.on_reward(user_id, coins, battles_won)
+
+    async def _load(self, user_ids):
+        by_shard = {}
+        for user_id in user_ids:
+            by_shard.setdefault(self.db.shard(user_id).index, []).append(user_id)
+        for loaded in await asyncio.gather(*(
+            self.db.shards[index].storage.read(load, shard_users) for index, shard_users in by_shard.items()
+        )):
+            for user_id, state in loaded.items():
+                self._states.setdefault(user_id, state)
+
+    def _evict(self):
+        excess = len(self._states) - self.capacity
+        for user_id in list(self._states)[:max(0, excess)]:
+            if not self._states[user_id].dirty:
+                del self._states[user_id]
+
+
+def create_schema(connection):
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS achievements (
+            user_id INTEGER,
+            key TEXT,
+            unlocked_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, key)
+        )
+    ''')
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS achievement_state (
+            user_id INTEGER PRIMARY KEY,
+            win_streak INTEGER DEFAULT 0,
+            best_streak INTEGER DEFAULT 0,
+            login_day INTEGER,
+            login_streak INTEGER DEFAULT 0
+        )
+    ''')
+
+
+def load(connection, user_ids):
+    """Storage read job: {user_id: AchievementState} for every requested player."""
+    ids = json.dumps(list(user_ids))
+    unlocked = {}
+    for user_id, key in connection.execute(
+        'SELECT user_id, key FROM achievements WHERE user_id IN (SELECT value FROM json_each(?))', (ids,)
+    ):
+        unlocked.setdefault(user_id, []).append(key)
+    counters = {
+        row[0]: row[1:] for row in connection.execute(
+            'SELECT user_id, win_streak, best_streak, login_day, login_streak FROM achievement_state '
+            'WHERE user_id IN (SELECT value FROM json_each(?))', (ids,)
+        )
+    }
+    return {user_id: AchievementState(unlocked.get(user_id, ()), *counters.get(user_id, ()))
+            for user_id in user_ids}
+
+
+def save(connection, states, unlocks):
+    """Storage write job: store streak counters and unlocks, paying each reward once.
+
+    Returns [(user_id, coins, battles_won)] per new unlock; coins is None
+    for rules without a reward.
+    """
+    connection.executemany(
+        'INSERT INTO achievement_state (user_id, win_streak, best_streak, login_day, login_streak) '
+        'VALUES (?, ?, ?, ?, ?) ON CONFLICT (user_id) DO UPDATE SET win_streak = excluded.win_streak, '
+        'best_streak = excluded.best_streak, login_day = excluded.login_day, login_streak = excluded.login_streak',
+        states
+    )
+    paid = []
+    for user_id, key in unlocks:
+        if not connection.execute(
+            'INSERT OR IGNORE INTO achievements (user_id, key) VALUES (?, ?)', (user_id, key)
+        ).rowcount:
+            continue
+        reward = RULES_BY_KEY[key].reward
+        row = connection.execute(
+            'UPDATE users SET coins = coins + ? WHERE user_id = ? RETURNING coins, battles_won', (reward, user_id)
+        ).fetchone() if reward else None
+        paid.append((user_id, *(row or (None, None))))
+    return paid
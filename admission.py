@@ -0,0 +1,147 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+import metrics
+from outbound import TokenBucket
+
+SHED = metrics.counter('admission_shed_total', 'Updates dropped before reaching a handler', ['reason', 'priority'])
+ADMISSION_WAIT = metrics.histogram('admission_wait_seconds', 'Time an update waited for a handler slot')
+
+# Priority classes, served in this order under load
+URGENT, NORMAL = 0, 1
+PRIORITY_NAMES = ('urgent', 'normal')
+
+
+class Shed(Exception):
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class PrioritySlots:
+    """A semaphore whose waiters are woken by priority, then arrival order.
+
+    At most `queue_limit` updates wait for a slot. When the queue is full a
+    newcomer is shed, unless it outranks someone waiting: then the most
+    recent waiter of the lowest class present is shed in its place.
+    """
+
+    def __init__(self, slots, queue_limit):
+        self.free = slots
+        self.queue_limit = queue_limit
+        self._waiting = []
+        self._counts = [0] * len(PRIORITY_NAMES)
+        self._order = itertools.count()
+
+    def __len__(self):
+        return sum(self._counts)
+
+    async def acquire(self, priority):
+        if self.free and not len(self):
+            self.free -= 1
+            return
+        if len(self) >= self.queue_limit:
+            self._make_room(priority)
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._order), future)
+        heapq.heappush(self._waiting, entry)
+        self._counts[priority] += 1
+        start = time.perf_counter()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # Woken and cancelled in the same tick: hand the slot on
+                self.release()
+            elif entry in self._waiting:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._counts[priority] -= 1
+            raise
+        ADMISSION_WAIT.observe(time.perf_counter() - start)
+
+    def release(self):
+        while self._waiting:
+            priority, _, future = heapq.heappop(self._waiting)
+            self._counts[priority] -= 1
+            if not future.done():
+                future.set_result(None)
+                return
+        self.free += 1
+
+    def _make_room(self, priority):
+        if not self._waiting:
+            # queue_limit 0: nobody may wait
+            raise Shed('overload')
+        lowest = max(p for p, count in enumerate(self._counts) if count)
+        if priority >= lowest:
+            raise Shed('overload')
+        victim = max((entry for entry in self._waiting if entry[0] == lowest), key=lambda entry: entry[1])
+        self._waiting.remove(victim)
+        heapq.heapify(self._waiting)
+        self._counts[lowest] -= 1
+        victim[2].set_exception(Shed('overload'))
+
+
+class Admission:
+    """Cheap checks that drop excess updates before they cost a query.
+
+    Each user has a token bucket refilled at `rate` updates per second up to
+    `burst`; an update finding it empty is shed. An update repeating one
+    of the user's updates still waiting to run (same payload) is coalesced
+    into it. Admitted updates then wait for one of `slots` handler slots,
+    urgent ones first. Buckets of users idle long enough to refill
+    completely are forgotten.
+    """
+
+    def __init__(self, rate=3.0, burst=6, slots=8, queue_limit=256, sweep_interval=60.0):
+        self.rate = rate
+        self.burst = burst
+        self.slots = PrioritySlots(slots, queue_limit)
+        self.sweep_interval = sweep_interval
+        self.shed = 0
+        self._buckets = {}
+        self._pending = {}
+        self._swept = time.monotonic()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def admit(self, user_id, key, priority):
+        """Take a click token and mark the update as pending; raises Shed when it's dropped."""
+        now = time.monotonic()
+        if now - self._swept >= self.sweep_interval:
+            self._sweep(now)
+        if (user_id, key) in self._pending:
+            self._shed('duplicate', priority)
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+        if not bucket.try_take():
+            self._shed('rate', priority)
+        self._pending[(user_id, key)] = priority
+
+    def started(self, user_id, key):
+        self._pending.pop((user_id, key), None)
+
+    async def acquire(self, priority):
+        try:
+            await self.slots.acquire(priority)
+        except Shed as e:
+            self._shed(e.reason, priority)
+
+    def release(self):
+        self.slots.release()
+
+    def _shed(self, reason, priority):
+        self.shed += 1
+        SHED.inc(1, (reason, PRIORITY_NAMES[priority]))
+        raise Shed(reason)
+
+    def _sweep(self, now):
+        self._swept = now
+        idle = self.burst / self.rate
+        for user_id in [user_id for user_id, bucket in self._buckets.items() if now - bucket.updated >= idle]:
+            del self._buckets[user_id]
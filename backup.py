@@ -0,0 +1,318 @@
+"""Online backups and streaming export/import of the bot's databases.
+
+Usage:
+    python backup.py backup --path game_bot.db --shards 4 --to backups/
+    python backup.py export --table users --format csv --output users.csv
+    python backup.py import --table users --input users.jsonl
+
+backup is safe while the bot runs: each shard is copied with SQLite's
+backup API a few pages per step, inside one read transaction so the copy
+is a consistent snapshot even while the writer keeps committing. export
+streams one table of every shard as JSON lines or CSV without holding it
+in memory. import loads such a file back in batched transactions,
+routing per-player tables (sharding.SHARD_KEYS) to the player's shard;
+the target shards must already have the bot's schema (start the bot
+once). Use `-` as --output / --input for stdout / stdin.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+import sharding
+
+logger = logging.getLogger('backup')
+
+BATCH_SIZE = 10_000
+BACKUP_PAGES = 256
+CONFLICTS = {'abort': 'INSERT', 'ignore': 'INSERT OR IGNORE', 'replace': 'INSERT OR REPLACE'}
+
+
+def backup_file(source_path, target_path, pages=BACKUP_PAGES, pause=0.001):
+    """Copy a live database file, `pages` pages per step with `pause` seconds between steps.
+
+    The copy is written next to the target and renamed once complete, so a
+    failed backup never leaves a torn file under the final name.
+    """
+    if not os.path.exists(source_path):
+        raise FileNotFoundError(f"Database {source_path} does not exist")
+    partial = target_path + '.partial'
+    source = sqlite3.connect(f'file:{source_path}?mode=ro', uri=True)
+    target = sqlite3.connect(partial)
+    try:
+        # A read transaction pins one WAL snapshot for the whole copy;
+        # without it every commit of the bot would restart the backup
+        source.execute('BEGIN')
+        source.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+        source.backup(target, pages=pages, progress=lambda status, remaining, total: time.sleep(pause))
+        source.rollback()
+    except BaseException:
+        target.close()
+        os.remove(partial)
+        raise
+    finally:
+        source.close()
+    target.close()
+    os.replace(partial, target_path)
+    return target_path
+
+
+def backup_name(path, directory, stamp):
+    base, ext = os.path.splitext(os.path.basename(path))
+    return os.path.join(directory, f'{base}.{stamp}{ext or ".db"}')
+
+
+def prune(path, directory, keep):
+    """Remove all but the `keep` newest backups of one shard file."""
+    base, ext = os.path.splitext(os.path.basename(path))
+    prefix, suffix = f'{base}.', ext or '.db'
+    backups = sorted(
+        name for name in os.listdir(directory)
+        if name.startswith(prefix) and name.endswith(suffix) and name[len(prefix):-len(suffix)].isdigit()
+    )
+    for name in backups[:max(0, len(backups) - keep)]:
+        os.remove(os.path.join(directory, name))
+
+
+async def backup_shards(paths, directory, keep=0, pages=BACKUP_PAGES, pause=0.001):
+    """Back up every shard file into `directory` off the event loop, one shard at a time."""
+    os.makedirs(directory, exist_ok=True)
+    stamp = time.strftime('%Y%m%d%H%M%S', time.gmtime())
+    written = []
+    for path in paths:
+        started = time.perf_counter()
+        written.append(await asyncio.to_thread(backup_file, path, backup_name(path, directory, stamp), pages, pause))
+        logger.info(f"Backed up {path} to {written[-1]} in {time.perf_counter() - started:.1f}s")
+        if keep:
+            prune(path, directory, keep)
+    return written
+
+
+def format_of(path, default='jsonl'):
+    return 'csv' if path.endswith('.csv') else default
+
+
+def open_shards(paths, readonly):
+    """Connections to a shard set, checked against the layout stamped in each file."""
+    connections = []
+    try:
+        for index, path in enumerate(paths):
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Database {path} does not exist")
+            if readonly:
+                connections.append(sqlite3.connect(f'file:{path}?mode=ro', uri=True))
+            else:
+                connections.append(sqlite3.connect(path, isolation_level=None, timeout=30))
+            # Databases from before sharding are a single unstamped file
+            if not sharding.check_layout(connections[-1], index, len(paths)) and len(paths) != 1:
+                raise ValueError(f"{path} is not stamped as shard {index} of {len(paths)}")
+    except BaseException:
+        for connection in connections:
+            connection.close()
+        raise
+    return connections
+
+
+def table_columns(connection, table):
+    columns = [row[1] for row in connection.execute(f'PRAGMA table_info("{table}")')]
+    if not columns:
+        raise ValueError(f"Table {table} does not exist")
+    return columns
+
+
+def iter_rows(connections, table, batch_size=BATCH_SIZE):
+    """Every row of `table` across the shards, fetched `batch_size` rows at a time."""
+    for connection in connections:
+        cursor = connection.execute(f'SELECT * FROM "{table}"')
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+
+
+class _LastLine:
+    """File-like target keeping only the line csv.writer wrote last."""
+
+    text = ''
+
+    def write(self, text):
+        self.text = text
+
+
+def encode_jsonl(columns, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n'
+
+
+def encode_csv(columns, rows):
+    line = _LastLine()
+    writer = csv.writer(line, lineterminator='\n')
+    writer.writerow(columns)
+    yield line.text
+    for row in rows:
+        writer.writerow(row)
+        yield line.text
+
+
+def decode_jsonl(stream):
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def decode_csv(stream):
+    # CSV has no NULL: export writes None as an empty field and this reads it back as None
+    for record in csv.DictReader(stream):
+        yield {column: value if value != '' else None for column, value in record.items()}
+
+
+ENCODERS = {'jsonl': encode_jsonl, 'csv': encode_csv}
+DECODERS = {'jsonl': decode_jsonl, 'csv': decode_csv}
+
+
+def export_table(paths, table, output, fmt='jsonl'):
+    """Stream `table` of every shard into the text file `output`; returns the row count."""
+    connections = open_shards(paths, readonly=True)
+    exported = 0
+
+    def counted(rows):
+        nonlocal exported
+        for row in rows:
+            exported += 1
+            yield row
+
+    try:
+        columns = table_columns(connections[0], table)
+        output.writelines(ENCODERS[fmt](columns, counted(iter_rows(connections, table))))
+    finally:
+        for connection in connections:
+            connection.close()
+    return exported
+
+
+def import_table(paths, table, records, conflict='abort', batch_size=BATCH_SIZE):
+    """Insert `records` (dicts keyed by column) into `table`; returns the rows written per shard.
+
+    Rows are buffered per shard and each full buffer is committed as one
+    transaction, so memory stays at `batch_size` rows per shard. Batches
+    committed before a failure stay; rerun with conflict='ignore' to resume.
+    """
+    connections = open_shards(paths, readonly=False)
+    key = sharding.SHARD_KEYS.get(table)
+    buffers = [[] for _ in connections]
+    imported = [0] * len(connections)
+    columns = insert = None
+
+    def write(index):
+        connection = connections[index]
+        connection.execute('BEGIN')
+        try:
+            connection.executemany(insert, buffers[index])
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        imported[index] += len(buffers[index])
+        buffers[index].clear()
+
+    try:
+        known = set(table_columns(connections[0], table))
+        for record in records:
+            if columns is None:
+                columns = list(record)
+                unknown = set(columns) - known
+                if unknown:
+                    raise ValueError(f"{table} has no columns {', '.join(sorted(unknown))}")
+                if key and key not in columns:
+                    raise ValueError(f"{table} rows need {key} to pick their shard")
+                column_list = ', '.join(f'"{column}"' for column in columns)
+                placeholders = ', '.join('?' for _ in columns)
+                insert = f'{CONFLICTS[conflict]} INTO "{table}" ({column_list}) VALUES ({placeholders})'
+            owner = record.get(key) if key else None
+            index = sharding.shard_index(int(owner), len(connections)) if owner is not None else 0
+            buffers[index].append(tuple(record.get(column) for column in columns))
+            if len(buffers[index]) >= batch_size:
+                write(index)
+        for index, buffer in enumerate(buffers):
+            if buffer:
+                write(index)
+    finally:
+        for connection in connections:
+            connection.close()
+    return imported
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--path', default=os.getenv('DB_PATH', 'game_bot.db'), help='DB_PATH of the bot')
+    parser.add_argument('--shards', type=int, default=int(os.getenv('SHARD_COUNT', '1')), help='SHARD_COUNT of the bot')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    backup = commands.add_parser('backup', help='consistent copy of every shard, safe while the bot runs')
+    backup.add_argument('--to', required=True, help='directory for the backup files')
+    backup.add_argument('--keep', type=int, default=0, help='backups kept per shard, 0 keeps all')
+    backup.add_argument('--pages', type=int, default=BACKUP_PAGES, help='pages copied per step')
+
+    export = commands.add_parser('export', help='stream a table to JSON lines or CSV')
+    export.add_argument('--table', required=True)
+    export.add_argument('--output', default='-', help='file to write, - for stdout')
+    export.add_argument('--format', choices=sorted(ENCODERS), help='defaults to the --output extension, else jsonl')
+
+    load = commands.add_parser('import', help='load an exported table in batched transactions')
+    load.add_argument('--table', required=True)
+    load.add_argument('--input', default='-', help='file to read, - for stdin')
+    load.add_argument('--format', choices=sorted(DECODERS), help='defaults to the --input extension, else jsonl')
+    load.add_argument('--on-conflict', choices=sorted(CONFLICTS), default='abort',
+                      help='what to do with rows whose key already exists')
+    load.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='rows per transaction')
+    return parser.parse_args(argv)
+
+
+def run(args):
+    paths = sharding.shard_paths(args.path, args.shards)
+    started = time.perf_counter()
+    if args.command == 'backup':
+        written = asyncio.run(backup_shards(paths, args.to, args.keep, args.pages))
+        logger.info(f"Wrote {len(written)} backup files to {args.to}")
+    elif args.command == 'export':
+        fmt = args.format or format_of(args.output)
+        if args.output == '-':
+            count = export_table(paths, args.table, sys.stdout, fmt)
+        else:
+            with open(args.output, 'w', newline='', encoding='utf-8') as output:
+                count = export_table(paths, args.table, output, fmt)
+        logger.info(f"Exported {count} {args.table} rows in {time.perf_counter() - started:.1f}s")
+    else:
+        fmt = args.format or format_of(args.input)
+        if args.input == '-':
+            imported = import_table(paths, args.table, DECODERS[fmt](sys.stdin), args.on_conflict, args.batch_size)
+        else:
+            with open(args.input, newline='', encoding='utf-8') as stream:
+                imported = import_table(paths, args.table, DECODERS[fmt](stream), args.on_conflict, args.batch_size)
+        logger.info(f"Imported {sum(imported)} {args.table} rows in {time.perf_counter() - started:.1f}s, "
+                    f"per shard {imported}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO,
+                        stream=sys.stderr)
+    if args.shards < 1:
+        logger.error("Shard count must be at least 1")
+        return 2
+    try:
+        run(args)
+    except (OSError, ValueError, sqlite3.Error) as e:
+        logger.error(f"{args.command.capitalize()} failed: {e}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+from collections import namedtuple
+
+BattleEntry = namedtuple(
+    'BattleEntry', 'battle_id battle_type bet_amount winner_id net_change battle_date'
+)
+
+
+class BattleLog:
+    """Buffered writer and keyset-paginated reader for the battles table.
+
+    record() runs inside a storage write job and only appends to a buffer;
+    the storage writer calls flush() once per group commit, so every battle
+    of the group goes in with a single executemany inside the same
+    transaction as the balance changes that produced it. A job that fails
+    after recording has its rows dropped back to mark(), so history never
+    shows a battle whose balance changes were rolled back.
+    """
+
+    INSERT = (
+        'INSERT INTO battles (player1_id, player2_id, battle_type, bet_amount, winner_id, net_change) '
+        'VALUES (?, ?, ?, ?, ?, ?)'
+    )
+
+    def __init__(self):
+        self.pending = []
+        self.flushed = 0
+
+    def record(self, player1_id, player2_id, battle_type, bet_amount, winner_id, net_change):
+        self.pending.append((player1_id, player2_id, battle_type, bet_amount, winner_id, net_change))
+
+    def flush(self, connection):
+        if not self.pending:
+            return
+        rows, self.pending = self.pending, []
+        connection.executemany(self.INSERT, rows)
+        self.flushed += len(rows)
+
+    def mark(self):
+        return len(self.pending)
+
+    def discard(self, mark=0):
+        del self.pending[mark:]
+
+    @staticmethod
+    def create_schema(connection):
+        columns = {row[1] for row in connection.execute('PRAGMA table_info(battles)')}
+        if 'net_change' not in columns:
+            connection.execute('ALTER TABLE battles ADD COLUMN net_change INTEGER DEFAULT 0')
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS idx_battles_player1_date ON battles (player1_id, battle_date)'
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS idx_battles_winner ON battles (winner_id)')
+
+    @staticmethod
+    def history(connection, user_id, before=None, limit=5):
+        """Newest-first page of a player's battles.
+
+        `before` is the battle_id of the last row already shown. Paging seeks
+        on the (player1_id, battle_date) index from that row instead of
+        skipping with OFFSET, so page 1000 costs the same as page 1. One
+        extra row is fetched to tell whether an older page exists.
+        """
+        if before is None:
+            rows = connection.execute(
+                'SELECT battle_id, battle_type, bet_amount, winner_id, net_change, battle_date '
+                'FROM battles WHERE player1_id = ? '
+                'ORDER BY battle_date DESC, battle_id DESC LIMIT ?',
+                (user_id, limit + 1)
+            ).fetchall()
+        else:
+            rows = connection.execute(
+                'SELECT battle_id, battle_type, bet_amount, winner_id, net_change, battle_date '
+                'FROM battles WHERE player1_id = ? '
+                'AND (battle_date, battle_id) < (SELECT battle_date, battle_id FROM battles WHERE battle_id = ?) '
+                'ORDER BY battle_date DESC, battle_id DESC LIMIT ?',
+                (user_id, before, limit + 1)
+            ).fetchall()
+        entries = [BattleEntry(*row) for row in rows[:limit]]
+        return entries, len(rows) > limit
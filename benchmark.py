@@ -0,0 +1,378 @@
+"""Handler benchmark: replays synthetic updates against a local stand-in bot.
+
+Usage:
+    python benchmark.py --users 10000 --updates 20000 --concurrency 32 --output results.json
+
+The bot module is imported against a fresh temporary database seeded with
+--users players. Every callback payload registered on the router plus the
+/start, /wallet and /rankings commands are first run once to check they
+all work, then --updates updates are replayed following the chosen traffic
+mix. Outgoing Telegram calls are recorded by RecordingBot instead of going
+to the network. Results are printed and written as JSON so runs can be
+compared.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from telegram import Update
+
+import backup
+
+RPS_MOVES = ('rock', 'paper', 'scissors')
+
+
+def rps_session(user_id, stake):
+    # RPS moves need a prompt opened by a bet first, like a player tapping through
+    import bot
+    return bot.battle_sessions.open(user_id, 'rps', stake)
+
+
+# Sample arguments for parameterized payloads, keyed by router prefix
+PREFIX_SAMPLES = {
+    'bet:rps:': lambda rng, user_id: [rng.choice((10, 25, 50))],
+    'bet:dice:': lambda rng, user_id: [rng.choice((10, 25, 50))],
+    'bet:stats:': lambda rng, user_id: [rng.choice((10, 25, 50))],
+    'rps:': lambda rng, user_id: [rps_session(user_id, rng.choice((10, 25))), rng.choice(RPS_MOVES)],
+    'rankings:': lambda rng, user_id: [rng.randrange(5)],
+    'history:': lambda rng, user_id: [2 ** 62],
+    'pvp:': lambda rng, user_id: [rng.choice(('rps', 'dice', 'stats'))],
+    'queue:': lambda rng, user_id: rng.choice((
+        ['dice', rng.choice((10, 25))], ['stats', 10], ['rps', 10, rng.choice(RPS_MOVES)], ['rps', 25],
+    )),
+    'tjoin:': lambda rng, user_id: [1],
+    'troll:': lambda rng, user_id: [1, 1],
+    'team:': lambda rng, user_id: [1, rng.randrange(2)],
+    'claim:': lambda rng, user_id: [rng.choice(('play', 'win', 'wager', 'chat'))],
+    'casino:': lambda rng, user_id: [rng.choice(('flip', 'roulette', 'slots'))],
+    'buy:': lambda rng, user_id: [rng.choice(('potion', 'katana', 'banner')), rng.choice((1, 5))],
+    'spin:': lambda rng, user_id: rng.choice((['flip', 'heads', 10], ['roulette', 'red', 25], ['slots', 'spin', 10])),
+}
+
+COMMANDS = ('/start', '/wallet', '/rankings', '/missions', '/shop')
+
+# Relative weights of a busy evening: mostly battles, then menus
+REALISTIC_MIX = {
+    'bet:dice:': 20, 'bet:stats:': 8, 'bet:rps:': 6, 'rps:': 12,
+    'battle_dice': 6, 'battle_rps': 4, 'battle_stats': 3,
+    'main': 8, 'wallet': 6, 'rankings': 6, 'rankings:': 2, 'rankings_me': 2,
+    'battle_mode': 5, 'pvp_duel': 5, 'battle_history': 3,
+    'pvp:': 2, 'queue:': 6, 'pvp_cancel': 1, 'spin:': 4,
+    '/start': 2, '/wallet': 2, '/rankings': 2,
+}
+
+
+class RecordingBot:
+    """Stands in for telegram.Bot and records outgoing calls."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.defaults = None
+        self._message_id = 1000
+
+    async def answer_callback_query(self, *args, **kwargs):
+        self.calls['answer_callback_query'] += 1
+        return True
+
+    async def edit_message_text(self, *args, **kwargs):
+        self.calls['edit_message_text'] += 1
+        return True
+
+    async def send_message(self, *args, **kwargs):
+        self.calls['send_message'] += 1
+        self._message_id += 1
+        return _SentMessage(self._message_id)
+
+    def total(self):
+        return sum(self.calls.values())
+
+
+class _SentMessage:
+    __slots__ = ('message_id',)
+
+    def __init__(self, message_id):
+        self.message_id = message_id
+
+
+class UpdateFactory:
+    def __init__(self, bot):
+        self.bot = bot
+        self.update_id = 0
+
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': 'Bench', 'username': f'bench{user_id}'}
+
+    def callback(self, user_id, data):
+        self.update_id += 1
+        return Update.de_json({
+            'update_id': self.update_id,
+            'callback_query': {
+                'id': str(self.update_id),
+                'chat_instance': str(user_id),
+                'data': data,
+                'from': self._user(user_id),
+                'message': {
+                    'message_id': 1,
+                    'date': 0,
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'text': 'menu',
+                },
+            },
+        }, self.bot)
+
+    def command(self, user_id, text):
+        self.update_id += 1
+        command = text.split()[0]
+        return Update.de_json({
+            'update_id': self.update_id,
+            'message': {
+                'message_id': self.update_id,
+                'date': 0,
+                'text': text,
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': self._user(user_id),
+            },
+        }, self.bot)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies):
+    values = sorted(latencies)
+    return {
+        'count': len(values),
+        'mean_ms': statistics.fmean(values) * 1000 if values else 0.0,
+        'p50_ms': percentile(values, 0.50) * 1000,
+        'p95_ms': percentile(values, 0.95) * 1000,
+        'p99_ms': percentile(values, 0.99) * 1000,
+        'max_ms': values[-1] * 1000 if values else 0.0,
+    }
+
+
+class Benchmark:
+    def __init__(self, bot_module, args):
+        self.bot = bot_module
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.telegram = RecordingBot()
+        self.factory = UpdateFactory(self.telegram)
+        self.routes = bot_module.router.payloads() + bot_module.router.prefixes() + list(COMMANDS)
+        self.entry = {
+            'callback': bot_module.per_user(bot_module.handle_button_click),
+            '/start': bot_module.per_user(bot_module.start),
+            '/wallet': bot_module.per_user(bot_module.wallet),
+            '/rankings': bot_module.per_user(bot_module.show_rankings),
+            '/missions': bot_module.per_user(bot_module.missions_screen),
+            '/shop': bot_module.per_user(bot_module.shop_screen),
+        }
+
+    def pick_user(self):
+        # Skewed towards a hot set of players, like real traffic
+        return 1 + int(self.args.users * self.rng.random() ** 3)
+
+    def build(self, route, user_id):
+        if route in COMMANDS:
+            return self.factory.command(user_id, route), route
+        if route in PREFIX_SAMPLES:
+            fields = PREFIX_SAMPLES[route](self.rng, user_id)
+            data = route + ':'.join(str(field) for field in fields)
+            return self.factory.callback(user_id, data), 'callback'
+        return self.factory.callback(user_id, route), 'callback'
+
+    def mix(self):
+        routes = [route for route in self.routes if route in PREFIX_SAMPLES or not route.endswith(':')]
+        if self.args.mix == 'uniform':
+            return routes, [1] * len(routes)
+        return routes, [REALISTIC_MIX.get(route, 1) for route in routes]
+
+    async def run_one(self, route, user_id, record):
+        update, kind = self.build(route, user_id)
+        context = _Context(self.telegram)
+        start = time.perf_counter()
+        try:
+            await self.entry[kind](update, context)
+        except Exception as e:
+            record['errors'][route] += 1
+            logging.getLogger('benchmark').warning(f"{route} failed: {e!r}")
+        record['latency'][route].append(time.perf_counter() - start)
+
+    async def coverage(self):
+        record = {'errors': Counter(), 'latency': defaultdict(list)}
+        routes, _ = self.mix()
+        for route in routes:
+            await self.run_one(route, self.pick_user(), record)
+        skipped = [route for route in self.routes if route not in routes]
+        return {'routes': len(routes), 'skipped_prefixes': skipped, 'errors': dict(record['errors'])}
+
+    async def replay(self):
+        routes, weights = self.mix()
+        plan = [(route, self.pick_user()) for route in self.rng.choices(routes, weights, k=self.args.updates)]
+        record = {'errors': Counter(), 'latency': defaultdict(list)}
+        storage = self.bot.db
+        statements, commits, calls = storage.statements, storage.commits, self.telegram.total()
+        shed = self.bot.admission.shed
+
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def limited(route, user_id):
+            async with semaphore:
+                await self.run_one(route, user_id, record)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(limited(route, user_id) for route, user_id in plan))
+        elapsed = time.perf_counter() - start
+
+        updates = len(plan)
+        all_latencies = [value for values in record['latency'].values() for value in values]
+        return {
+            'updates': updates,
+            'elapsed_seconds': elapsed,
+            'throughput_per_second': updates / elapsed if elapsed else 0.0,
+            'latency': summarize(all_latencies),
+            'per_update': {
+                'sql_statements': (storage.statements - statements) / updates,
+                'commits': (storage.commits - commits) / updates,
+                'telegram_calls': (self.telegram.total() - calls) / updates,
+            },
+            'shed': self.bot.admission.shed - shed,
+            'errors': dict(record['errors']),
+            'routes': {route: summarize(values) for route, values in sorted(record['latency'].items())},
+        }
+
+
+class _Context:
+    def __init__(self, bot):
+        self.bot = bot
+        self.args = []
+        self.error = None
+
+
+async def seed_users(db, count, rng):
+    def insert(connection, rows):
+        connection.executemany(
+            'INSERT OR IGNORE INTO users (user_id, username, coins, level, battles_won, battles_lost) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            rows
+        )
+
+    batches = [[] for _ in db.shards]
+    for user_id in range(1, count + 1):
+        won = rng.randrange(200)
+        batch = batches[db.shard(user_id).index]
+        batch.append((user_id, f'bench{user_id}', rng.randrange(10, 5000), rng.randrange(1, 30), won, rng.randrange(200)))
+        if len(batch) == 10_000:
+            await db.shard(user_id).storage.write(insert, batch)
+            batch.clear()
+    for shard, batch in zip(db.shards, batches):
+        if batch:
+            await shard.storage.write(insert, batch)
+
+
+async def main_async(args):
+    import bot
+
+    # Delivery pacing would only measure Telegram's limits, not our code
+    if not args.real_limits:
+        bot.outbox = bot.Outbox(global_rate=1e9, private_rate=1e9, group_rate=1e9, chat_burst=1e9)
+        # Synthetic players click far faster than people; keep only the slot scheduling
+        bot.admission = bot.Admission(rate=1e9, burst=1e9, slots=args.concurrency, queue_limit=args.concurrency)
+
+    rng = random.Random(args.seed)
+    if args.seed_file:
+        with open(args.seed_file, newline='', encoding='utf-8') as stream:
+            records = backup.DECODERS[backup.format_of(args.seed_file)](stream)
+            paths = [shard.storage.path for shard in bot.db.shards]
+            await asyncio.to_thread(backup.import_table, paths, 'users', records, 'ignore')
+    else:
+        await seed_users(bot.db, args.users, rng)
+    await bot.on_startup(None)
+    bot.db.count_statements()
+
+    benchmark = Benchmark(bot, args)
+    coverage = await benchmark.coverage()
+    replay = await benchmark.replay()
+    bot.db.close()
+
+    return {
+        'config': {
+            'users': args.users,
+            'updates': args.updates,
+            'concurrency': args.concurrency,
+            'shards': args.shards,
+            'mix': args.mix,
+            'seed': args.seed,
+            'seed_file': args.seed_file,
+            'real_limits': args.real_limits,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'coverage': coverage,
+        'results': replay,
+    }
+
+
+def print_report(report):
+    results = report['results']
+    latency = results['latency']
+    per_update = results['per_update']
+    print(f"Updates:      {results['updates']} in {results['elapsed_seconds']:.2f}s "
+          f"({results['throughput_per_second']:.0f}/s)")
+    print(f"Latency:      p50 {latency['p50_ms']:.2f} ms, p95 {latency['p95_ms']:.2f} ms, "
+          f"p99 {latency['p99_ms']:.2f} ms, max {latency['max_ms']:.2f} ms")
+    print(f"Per update:   {per_update['sql_statements']:.2f} SQL statements, "
+          f"{per_update['commits']:.3f} commits, {per_update['telegram_calls']:.2f} Telegram calls")
+    print(f"Shed:         {results['shed']} updates dropped by admission control")
+    print(f"Coverage:     {report['coverage']['routes']} routes, errors: {report['coverage']['errors'] or 'none'}")
+    if results['errors']:
+        print(f"Errors:       {results['errors']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10_000, help='players seeded into the database')
+    parser.add_argument('--updates', type=int, default=20_000, help='updates replayed')
+    parser.add_argument('--concurrency', type=int, default=32, help='updates in flight at once')
+    parser.add_argument('--shards', type=int, default=1, help='database shards (SHARD_COUNT)')
+    parser.add_argument('--mix', choices=('realistic', 'uniform'), default='realistic')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--seed-file', help='players to load instead of random ones, a users export of backup.py')
+    parser.add_argument('--real-limits', action='store_true', help='keep the outbox flood limits and click rate limits')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON results file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Must be set before bot is imported: the database opens at import
+        os.environ['DB_PATH'] = os.path.join(directory, 'game_bot.db')
+        os.environ['SHARD_COUNT'] = str(args.shards)
+        report = asyncio.run(main_async(args))
+
+    print_report(report)
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print(f"Results written to {args.output}")
+    return 0 if not report['results']['errors'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,30 +1,176 @@
 import os
 import logging
+import math
 import sqlite3
 import asyncio
 import random
-from datetime import datetime
+import time
+import warnings
+from collections import namedtuple
+from datetime import datetime, time as dtime, timezone
+from functools import lru_cache, wraps
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+from telegram.helpers import escape_markdown
+from telegram.warnings import PTBUserWarning
+
+import achievements
+import backup
+import casino
+import games
+import metrics
+import missions
+import settlement
+import shop
+import sharding
+import tournament
+from achievements import AchievementEngine
+from admission import NORMAL, URGENT, Admission, Shed
+from battlelog import BattleLog
+from leaderboard import Leaderboard
+from matchmaking import Matchmaker, Ticket, rate
+from missions import MissionCounters
+from outbound import TELEGRAM_SECONDS, Outbox
+from population import PopulationSnapshot, PopulationStats
+from router import CallbackRouter, pack
+from sequencing import UserSequencer
+from sessions import SessionStore
+from storage import DB_JOB_SECONDS, Storage
+from teambattle import BLUE, RED, TEAMS, TeamBattles
+from usercache import UserCache, UserRecord
 
 # Use environment variable for security
 BOT_TOKEN = os.getenv('BOT_TOKEN', 'your_bot_token_here')
 
+# Serving mode - webhook when WEBHOOK_URL is set, long polling otherwise
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+PORT = int(os.getenv('PORT', '8000'))
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '8'))
+WARM_USERS = int(os.getenv('WARM_USERS', '1000'))
+
+# Admission control - per-user click rate and burst, and how many updates may wait for one
+# of the UPDATE_CONCURRENCY handler slots before navigation gets shed
+CLICK_RATE = float(os.getenv('CLICK_RATE', '3'))
+CLICK_BURST = int(os.getenv('CLICK_BURST', '6'))
+ADMISSION_QUEUE = int(os.getenv('ADMISSION_QUEUE', '256'))
+
+# Storage - players are spread over SHARD_COUNT database files, each with its own writer
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '1'))
+
+# PvP matchmaking - queue timeout in seconds, starting rating gap and how fast it widens per second
+PVP_QUEUE_TIMEOUT = float(os.getenv('PVP_QUEUE_TIMEOUT', '120'))
+PVP_RATING_WINDOW = int(os.getenv('PVP_RATING_WINDOW', '100'))
+PVP_WINDOW_GROWTH = float(os.getenv('PVP_WINDOW_GROWTH', '10'))
+
+# Tournaments - a weekly one opens registration on TOURNAMENT_WEEKDAY (0 = Sunday ... 6 = Saturday,
+# -1 to disable) at TOURNAMENT_HOUR UTC; TOURNAMENT_ADMINS may open extra ones with /newtournament
+TOURNAMENT_FORMAT = os.getenv('TOURNAMENT_FORMAT', tournament.SINGLE_ELIMINATION)
+TOURNAMENT_ENTRY_FEE = int(os.getenv('TOURNAMENT_ENTRY_FEE', '50'))
+TOURNAMENT_WEEKDAY = int(os.getenv('TOURNAMENT_WEEKDAY', '6'))
+TOURNAMENT_HOUR = int(os.getenv('TOURNAMENT_HOUR', '18'))
+TOURNAMENT_REGISTRATION_HOURS = float(os.getenv('TOURNAMENT_REGISTRATION_HOURS', '24'))
+TOURNAMENT_ROUND_MINUTES = float(os.getenv('TOURNAMENT_ROUND_MINUTES', '30'))
+TOURNAMENT_ADMINS = {int(user_id) for user_id in os.getenv('TOURNAMENT_ADMINS', '').split(',') if user_id.strip()}
+
+# Team battles in group chats - window length, scoreboard edit interval, per-player attack cooldown and rewards
+TEAM_BATTLE_MINUTES = float(os.getenv('TEAM_BATTLE_MINUTES', '5'))
+TEAM_SCOREBOARD_SECONDS = float(os.getenv('TEAM_SCOREBOARD_SECONDS', '3'))
+TEAM_ACTION_COOLDOWN = float(os.getenv('TEAM_ACTION_COOLDOWN', '1'))
+TEAM_WIN_REWARD = int(os.getenv('TEAM_WIN_REWARD', '25'))
+TEAM_PLAY_REWARD = int(os.getenv('TEAM_PLAY_REWARD', '5'))
+
+# Seconds between writes of the buffered daily mission counters and achievement evaluations
+EVENT_FLUSH_SECONDS = float(os.getenv('EVENT_FLUSH_SECONDS', '5'))
+
+# Online backups of every shard into BACKUP_DIR every BACKUP_INTERVAL_HOURS, keeping BACKUP_KEEP per shard
+BACKUP_DIR = os.getenv('BACKUP_DIR')
+BACKUP_INTERVAL_HOURS = float(os.getenv('BACKUP_INTERVAL_HOURS', '24'))
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', '7'))
+
+# Casino RNG seed, random per process unless set; every spin logs the seed and its draw position
+CASINO_SEED = int(os.environ['CASINO_SEED']) if os.getenv('CASINO_SEED') else None
+
+# Players allowed to hand out items and gems with /grant; separate from TOURNAMENT_ADMINS since it mints currency
+GRANT_ADMINS = {int(user_id) for user_id in os.getenv('GRANT_ADMINS', '').split(',') if user_id.strip()}
+
+# Seconds a battle prompt (e.g. the RPS move buttons) stays playable
+BATTLE_SESSION_SECONDS = float(os.getenv('BATTLE_SESSION_SECONDS', '600'))
+
+# Seconds between rebuilds of the population snapshot behind "My Stats"
+STATS_REFRESH_SECONDS = float(os.getenv('STATS_REFRESH_SECONDS', '300'))
+
+# Monitoring - Prometheus text on METRICS_PORT, log summary every METRICS_LOG_INTERVAL seconds
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_LOG_INTERVAL = float(os.getenv('METRICS_LOG_INTERVAL', '0'))
+
 # Configure logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+# The job queue logs every run at INFO; TOURNAMENT_WEEKDAY already uses the v20 (cron) day numbering
+logging.getLogger('apscheduler').setLevel(logging.WARNING)
+warnings.filterwarnings('ignore', message='Prior to v20.0 the `days` parameter', category=PTBUserWarning)
 
 # Database setup
+Shard = namedtuple('Shard', 'index storage battles')
+
 class Database:
-    def __init__(self):
-        self.connection = sqlite3.connect('game_bot.db', check_same_thread=False, timeout=10)
-        self.create_tables()
+    """Player data partitioned over one or more SQLite files.
+
+    A player's rows live on the shard picked by sharding.shard_index(), and
+    each shard has its own writer thread, so write capacity grows with the
+    shard count. Tables that aren't per player live on the first shard,
+    exposed as `storage` and `battles`.
+    """
+
+    def __init__(self, path='game_bot.db', shards=1):
+        paths = sharding.shard_paths(path, shards)
+        if shards > 1 and os.path.exists(path) and not any(map(os.path.exists, paths)):
+            logger.warning(f"Starting {shards} empty shards next to the unsharded {path}, run reshard.py to move its players")
+        self.shards = []
+        for index, shard_path in enumerate(paths):
+            storage = Storage(
+                shard_path, readers=4, timeout=10,
+                schema=lambda connection, index=index: self.create_shard(connection, index, shards)
+            )
+            battles = BattleLog()
+            storage.add_flush_hook(battles.flush, battles.discard, battles.mark)
+            self.shards.append(Shard(index, storage, battles))
+        self.storage = self.shards[0].storage
+        self.battles = self.shards[0].battles
+    
+    def shard(self, user_id):
+        return self.shards[sharding.shard_index(user_id, len(self.shards))]
+    
+    async def read_all(self, fn, *args):
+        return await asyncio.gather(*(shard.storage.read(fn, *args) for shard in self.shards))
+    
+    @property
+    def statements(self):
+        return sum(shard.storage.statements for shard in self.shards)
+    
+    @property
+    def commits(self):
+        return sum(shard.storage.commits for shard in self.shards)
     
-    def create_tables(self):
-        cursor = self.connection.cursor()
+    def count_statements(self):
+        for shard in self.shards:
+            shard.storage.count_statements()
+    
+    def close(self):
+        for shard in self.shards:
+            shard.storage.close()
+    
+    def create_shard(self, connection, index, count):
+        self.create_tables(connection)
+        sharding.stamp_layout(connection, index, count)
+    
+    def create_tables(self, connection):
+        cursor = connection.cursor()
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
@@ -48,9 +194,111 @@ class Database:
                 battle_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
-        self.connection.commit()
+        BattleLog.create_schema(connection)
+        settlement.create_pvp_schema(connection)
+        tournament.create_schema(connection)
+        missions.create_schema(connection)
+        achievements.create_schema(connection)
+        casino.create_schema(connection)
+        shop.create_schema(connection)
+
+db = Database(os.getenv('DB_PATH', 'game_bot.db'), shards=SHARD_COUNT)
+leaderboard = Leaderboard()
+user_cache = UserCache(capacity=int(os.getenv('USER_CACHE_SIZE', '100000')))
+sequencer = UserSequencer()
+outbox = Outbox()
+casino_rng = casino.CasinoRng(seed=CASINO_SEED)
+battle_sessions = SessionStore(ttl=BATTLE_SESSION_SECONDS)
+admission = Admission(rate=CLICK_RATE, burst=CLICK_BURST, slots=UPDATE_CONCURRENCY, queue_limit=ADMISSION_QUEUE)
+population = PopulationStats(db, interval=STATS_REFRESH_SECONDS)
+
+# Metrics
+UPDATES_IN_FLIGHT = metrics.gauge('updates_in_flight', 'Updates currently being handled')
+UPDATE_SECONDS = metrics.histogram('update_seconds', 'End-to-end handling time per update', ['handler'])
+DB_LOCK_RETRIES = metrics.counter('db_lock_retries_total', '"database is locked" retries', ['function'])
+DB_ERRORS = metrics.counter('db_errors_total', 'Database helper calls that failed', ['function'])
+metrics.callback_metric('user_cache_size', 'Players held in the user cache', lambda: len(user_cache))
+metrics.callback_metric('user_cache_hits_total', 'User cache hits', lambda: user_cache.hits, kind='counter')
+metrics.callback_metric('user_cache_misses_total', 'User cache misses', lambda: user_cache.misses, kind='counter')
+metrics.callback_metric('user_cache_evictions_total', 'User cache evictions', lambda: user_cache.evictions, kind='counter')
+metrics.callback_metric('leaderboard_players', 'Players in the in-memory leaderboard', lambda: len(leaderboard))
+metrics.callback_metric(
+    'population_snapshot_age_seconds', 'Age of the My Stats population snapshot',
+    lambda: time.time() - population.snapshot.taken_at if population.snapshot else 0
+)
+metrics.callback_metric('outbox_pending', 'Outgoing messages waiting for delivery', lambda: outbox.pending())
+metrics.callback_metric('user_locks_active', 'Users with an update in flight or queued', lambda: sequencer.active())
+metrics.callback_metric('battle_sessions_open', 'Battle prompts waiting for a move', lambda: len(battle_sessions))
+metrics.callback_metric(
+    'battle_sessions_rejected_total', 'Moves on expired, replayed or foreign battle prompts',
+    lambda: battle_sessions.rejected, kind='counter'
+)
+metrics.callback_metric('admission_queue', 'Updates waiting for a handler slot', lambda: len(admission.slots))
+background_tasks = []
+# The application's job queue, set at startup; None when handlers run without an application
+job_queue = None
 
-db = Database()
+# Admission - clicks beyond CLICK_RATE per second (bursts of CLICK_BURST) are dropped
+# before any database work, and payloads that move coins get handler slots first
+URGENT_PAYLOADS = ('bet:', 'rps:', 'queue:', 'pvp_cancel', 'tjoin:', 'troll:', 'team:', 'claim:', 'spin:', 'buy:')
+SHED_NOTICES = {
+    'rate': "⏳ Slow down a little!",
+    'duplicate': "⏳ Already on it...",
+    'overload': "🔥 The bot is very busy, please try again in a moment",
+}
+
+def classify_update(update):
+    query = update.callback_query
+    if query is not None:
+        data = query.data or ''
+        return data, URGENT if data.startswith(URGENT_PAYLOADS) else NORMAL
+    message = update.effective_message
+    return message.text if message else '', NORMAL
+
+async def reject_update(update, reason):
+    if update.callback_query is None:
+        return
+    try:
+        await update.callback_query.answer(SHED_NOTICES[reason])
+    except Exception as e:
+        logger.debug(f"Could not answer a shed callback: {e}")
+
+# Updates run concurrently, but each user's own updates are handled one at
+# a time and in order. Only wrap the registered entry points: handlers that
+# call each other would deadlock on the user's lock. The handler slot is taken
+# under the user's lock, so a user's queued updates wait on their own lock
+# instead of holding slots other users could run in.
+def per_user(handler):
+    @wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        UPDATES_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            if user is None:
+                return await handler(update, context)
+            key, priority = classify_update(update)
+            try:
+                admission.admit(user.id, key, priority)
+            except Shed as e:
+                return await reject_update(update, e.reason)
+            try:
+                async with sequencer.hold(user.id):
+                    await admission.acquire(priority)
+                    try:
+                        admission.started(user.id, key)
+                        emit_event(user.id, 'active', missions.epoch_day())
+                        return await handler(update, context)
+                    finally:
+                        admission.release()
+            except Shed as e:
+                return await reject_update(update, e.reason)
+            finally:
+                admission.started(user.id, key)
+        finally:
+            UPDATES_IN_FLIGHT.dec()
+            UPDATE_SECONDS.observe(time.perf_counter() - start, (handler.__name__,))
+    return wrapper
 
 # Safe database execution
 def safe_db_execute(func):
@@ -59,52 +307,213 @@ def safe_db_execute(func):
             return await func(*args, **kwargs)
         except sqlite3.OperationalError as e:
             if "database is locked" in str(e):
+                DB_LOCK_RETRIES.inc(1, (func.__name__,))
                 await asyncio.sleep(0.1)
                 return await func(*args, **kwargs)
+            DB_ERRORS.inc(1, (func.__name__,))
             logger.error(f"Database error in {func.__name__}: {e}")
             return None
         except Exception as e:
+            DB_ERRORS.inc(1, (func.__name__,))
             logger.error(f"Error in {func.__name__}: {e}")
             return None
     return wrapper
 
-# User management
+# User management - these run in the storage threads, never on the event loop
+def _select_user(connection, user_id):
+    return connection.execute(
+        f'SELECT {UserRecord.COLUMNS} FROM users WHERE user_id = ?', (user_id,)
+    ).fetchone()
+
+def _create_user(connection, user_id, username):
+    connection.execute(
+        'INSERT OR IGNORE INTO users (user_id, username, coins) VALUES (?, ?, 100)',
+        (user_id, username)
+    )
+    return _select_user(connection, user_id)
+
+def _select_leaderboard(connection):
+    return connection.execute(
+        'SELECT user_id, username, coins, level, battles_won FROM users'
+    ).fetchall()
+
+def _select_top_users(connection, limit):
+    return connection.execute(
+        f'SELECT {UserRecord.COLUMNS} FROM users ORDER BY coins DESC, user_id LIMIT ?', (limit,)
+    ).fetchall()
+
+# Every committed balance change goes through here to keep memory in sync
+def balance_changed(user_id, coins, battles_won, battles_lost=None, rating=None, gems=None):
+    user_cache.update_balance(user_id, coins, battles_won, battles_lost, rating, gems)
+    leaderboard.update(user_id, coins, battles_won)
+    emit_event(user_id, 'balance', (coins, battles_won))
+
+# Player events - the single hook feeding daily missions and achievements; both
+# only buffer them in memory and write periodically
+mission_counters = MissionCounters()
+achievement_engine = AchievementEngine(db, on_reward=balance_changed, interval=EVENT_FLUSH_SECONDS)
+
+def emit_event(user_id, event, value=1):
+    if event in missions.EVENT_INDEX:
+        mission_counters.add(user_id, event, value)
+    if event in achievements.EVENTS:
+        achievement_engine.emit(user_id, event, value)
+
+metrics.callback_metric('achievement_players_loaded', 'Players whose achievement state is in memory', lambda: len(achievement_engine))
+metrics.callback_metric('achievements_unlocked_total', 'Achievements unlocked', lambda: achievement_engine.unlocked, kind='counter')
+
+def battle_played(user_id, stake, outcome):
+    emit_event(user_id, 'battle')
+    if stake:
+        emit_event(user_id, 'wager', stake)
+    if outcome == games.WIN:
+        emit_event(user_id, 'win')
+    elif outcome == games.LOSE:
+        emit_event(user_id, 'loss')
+
+async def flush_mission_counters():
+    entries = mission_counters.take()
+    by_shard = {}
+    for entry in entries:
+        by_shard.setdefault(db.shard(entry[0][0]).index, []).append(entry)
+    flushed = await asyncio.gather(*(
+        db.shards[index].storage.write(missions.flush, shard_entries) for index, shard_entries in by_shard.items()
+    ), return_exceptions=True)
+    for shard_entries, result in zip(by_shard.values(), flushed):
+        if isinstance(result, Exception):
+            logger.error(f"Mission counter flush failed: {result}")
+            mission_counters.restore(shard_entries)
+    return len(entries)
+
+async def run_mission_flush(interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await flush_mission_counters()
+        except Exception as e:
+            logger.error(f"Mission counter flush failed: {e}")
+
+async def run_backups(directory, interval, keep):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await backup.backup_shards([shard.storage.path for shard in db.shards], directory, keep)
+        except Exception as e:
+            logger.error(f"Backup failed: {e}")
+
 @safe_db_execute
 async def get_user(user_id, username=None):
-    cursor = db.connection.cursor()
-    cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-    user = cursor.fetchone()
-    
-    if not user:
-        cursor.execute(
-            'INSERT INTO users (user_id, username, coins) VALUES (?, ?, 100)',
-            (user_id, username)
-        )
-        db.connection.commit()
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        user = cursor.fetchone()
+    user = user_cache.get(user_id)
+    if user:
+        return user
     
-    return user
+    storage = db.shard(user_id).storage
+    while True:
+        # A balance write landing during the read may predate the row: read again
+        version = user_cache.begin_read(user_id)
+        try:
+            row = await storage.read(_select_user, user_id)
+            if not row:
+                row = await storage.write(_create_user, user_id, username)
+                leaderboard.update(user_id, row[2], row[5], username=row[1], level=row[4])
+        finally:
+            fresh = user_cache.end_read(user_id, version)
+        if fresh:
+            return user_cache.fill(UserRecord.from_row(row))
 
 @safe_db_execute
-async def update_coins(user_id, amount):
-    cursor = db.connection.cursor()
-    cursor.execute('UPDATE users SET coins = coins + ? WHERE user_id = ?', (amount, user_id))
-    db.connection.commit()
-    return True
+async def settle_battle(user_id, battle_type, bet_amount, outcome):
+    shard = db.shard(user_id)
+    settled = await shard.storage.write(
+        settlement.settle, shard.battles, user_id, battle_type, bet_amount, outcome
+    )
+    if settled.ok:
+        balance_changed(user_id, settled.balance, settled.battles_won, settled.battles_lost)
+        battle_played(user_id, bet_amount, games.OUTCOME_CODES[outcome])
+    return settled
+
+@safe_db_execute
+async def hold_stake(user_id, ticket_id, game_type, stake):
+    held = await db.shard(user_id).storage.write(settlement.hold_stake, ticket_id, user_id, game_type, stake)
+    if held.ok:
+        balance_changed(user_id, held.balance, held.battles_won, held.battles_lost)
+    return held
 
 @safe_db_execute
-async def get_rankings():
-    cursor = db.connection.cursor()
-    cursor.execute('''
-        SELECT user_id, username, coins, level, battles_won 
-        FROM users 
-        ORDER BY coins DESC, battles_won DESC 
-        LIMIT 10
-    ''')
-    return cursor.fetchall()
-
-# Keyboard layouts
+async def release_stake(ticket):
+    released = await db.shard(ticket.user_id).storage.write(settlement.release_stake, ticket.ticket_id)
+    if released:
+        user_id, settled = released
+        balance_changed(user_id, settled.balance, settled.battles_won, settled.battles_lost)
+    return released
+
+async def apply_match(results):
+    by_shard = {}
+    for result in results:
+        by_shard.setdefault(db.shard(result.user_id).index, []).append(result)
+    settled = {}
+    for payouts in await asyncio.gather(*(
+        db.shards[index].storage.write(settlement.settle_pvp, db.shards[index].battles, shard_results)
+        for index, shard_results in by_shard.items()
+    )):
+        settled.update(payouts)
+    for user_id, (coins, battles_won, battles_lost, rating) in settled.items():
+        balance_changed(user_id, coins, battles_won, battles_lost, rating)
+    for result in results:
+        if result.user_id in settled:
+            battle_played(result.user_id, result.stake, result.outcome)
+    return settled
+
+@safe_db_execute
+async def settle_match(results):
+    if len({db.shard(result.user_id).index for result in results}) == 1:
+        return await apply_match(results)
+    # Shards commit separately: log the decision first so a crash between
+    # the two payouts is finished on the next startup
+    match_id = results[0].ticket_id
+    await db.storage.write(settlement.record_match, match_id, results)
+    settled = await apply_match(results)
+    await db.storage.write(settlement.finish_match, match_id)
+    return settled
+
+async def recover_pvp():
+    for match_id, results in await db.storage.read(settlement.unfinished_matches):
+        await apply_match(results)
+        await db.storage.write(settlement.finish_match, match_id)
+    # Queues live in memory, so every stake still in escrow belongs to a lost ticket
+    refunded = 0
+    for released in await asyncio.gather(*(shard.storage.write(settlement.release_all_stakes) for shard in db.shards)):
+        for user_id, settled in released:
+            balance_changed(user_id, settled.balance, settled.battles_won, settled.battles_lost)
+            refunded += 1
+    return refunded
+
+@safe_db_execute
+async def get_battle_history(user_id, before=None, limit=5):
+    return await db.shard(user_id).storage.read(BattleLog.history, user_id, before, limit)
+
+# Rankings are served from memory; the leaderboard is built from every shard's players
+@safe_db_execute
+async def load_leaderboard():
+    shards = await db.read_all(_select_leaderboard)
+    leaderboard.load(row for rows in shards for row in rows)
+    return len(leaderboard)
+
+@safe_db_execute
+async def warm_user_cache(limit):
+    # Each shard returns its own top players; merge them into the overall top
+    rows = sharding.merge_top(
+        await db.read_all(_select_top_users, limit), key=lambda row: (-row[2], row[0]), limit=limit
+    )
+    for row in rows:
+        user_cache.fill(UserRecord.from_row(row))
+    return len(rows)
+
+# Callback routing
+router = CallbackRouter()
+
+# Keyboard layouts - markups are immutable, so each one is built once and reused
+@lru_cache(maxsize=None)
 def main_menu_keyboard():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("🎯 Daily Missions", callback_data="missions"),
@@ -118,9 +527,23 @@ def main_menu_keyboard():
         [InlineKeyboardButton("⚙️ Settings", callback_data="settings")]
     ])
 
+@lru_cache(maxsize=None)
 def back_button(target_menu="main"):
     return InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data=target_menu)]])
 
+@lru_cache(maxsize=1024)
+def rankings_keyboard(page, pages):
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️ Prev", callback_data=pack("rankings", page - 1)))
+    if page + 1 < pages:
+        nav.append(InlineKeyboardButton("Next ▶️", callback_data=pack("rankings", page + 1)))
+    rows = [nav] if nav else []
+    rows.append([InlineKeyboardButton("📍 Around Me", callback_data="rankings_me")])
+    rows.append([InlineKeyboardButton("🔙 Back", callback_data="main")])
+    return InlineKeyboardMarkup(rows)
+
+@lru_cache(maxsize=None)
 def battle_mode_keyboard():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("🤺 PVP Duel", callback_data="pvp_duel")],
@@ -130,6 +553,7 @@ def battle_mode_keyboard():
         [InlineKeyboardButton("🔙 Back", callback_data="main")]
     ])
 
+@lru_cache(maxsize=None)
 def pvp_game_type_keyboard():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("✂️ Rock Paper Scissors", callback_data="battle_rps")],
@@ -139,20 +563,39 @@ def pvp_game_type_keyboard():
         [InlineKeyboardButton("🔙 Back", callback_data="battle_mode")]
     ])
 
+@lru_cache(maxsize=None)
 def bet_amount_keyboard(game_type):
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("10 Coins", callback_data=f"bet_{game_type}_10"),
-         InlineKeyboardButton("25 Coins", callback_data=f"bet_{game_type}_25")],
-        [InlineKeyboardButton("50 Coins", callback_data=f"bet_{game_type}_50"),
-         InlineKeyboardButton("100 Coins", callback_data=f"bet_{game_type}_100")],
-        [InlineKeyboardButton("🔙 Back", callback_data="pvp_duel")]
-    ])
+    buttons = [InlineKeyboardButton(f"{amount} Coins", callback_data=pack("bet", game_type, amount))
+               for amount in games.BET_AMOUNTS]
+    rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    rows.append([InlineKeyboardButton("🤺 Find a player", callback_data=pack("pvp", game_type))])
+    rows.append([InlineKeyboardButton("🔙 Back", callback_data="pvp_duel")])
+    return InlineKeyboardMarkup(rows)
+
+@lru_cache(maxsize=None)
+def pvp_bet_keyboard(game_type):
+    buttons = [InlineKeyboardButton(f"{amount} Coins", callback_data=pack("queue", game_type, amount))
+               for amount in games.BET_AMOUNTS]
+    rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    rows.append([InlineKeyboardButton("🔙 Back", callback_data=f"battle_{game_type}")])
+    return InlineKeyboardMarkup(rows)
+
+@lru_cache(maxsize=None)
+def pvp_move_keyboard(stake):
+    rows = [[InlineKeyboardButton(get_emoji_move(move), callback_data=pack("queue", "rps", stake, move))]
+            for move in RPS_MOVES]
+    rows.append([InlineKeyboardButton("🔙 Back", callback_data=pack("pvp", "rps"))])
+    return InlineKeyboardMarkup(rows)
 
-def rps_keyboard(battle_id, bet_amount):
+@lru_cache(maxsize=None)
+def pvp_searching_keyboard():
+    return InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel search", callback_data="pvp_cancel")]])
+
+def rps_keyboard(token):
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🪨 Rock", callback_data=f"rps_{battle_id}_{bet_amount}_rock")],
-        [InlineKeyboardButton("📄 Paper", callback_data=f"rps_{battle_id}_{bet_amount}_paper")],
-        [InlineKeyboardButton("✂️ Scissors", callback_data=f"rps_{battle_id}_{bet_amount}_scissors")],
+        [InlineKeyboardButton("🪨 Rock", callback_data=pack("rps", token, "rock"))],
+        [InlineKeyboardButton("📄 Paper", callback_data=pack("rps", token, "paper"))],
+        [InlineKeyboardButton("✂️ Scissors", callback_data=pack("rps", token, "scissors"))],
         [InlineKeyboardButton("🔙 Back", callback_data="battle_rps")]
     ])
 
@@ -175,59 +618,93 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Use the buttons below or commands!"
     )
     
-    await update.message.reply_text(
+    await outbox.reply(update.message, 
         welcome_text,
         reply_markup=main_menu_keyboard(),
         parse_mode='Markdown'
     )
 
+@router.exact('wallet')
 async def wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     user_data = await get_user(user.id, user.username)
     
     if not user_data:
-        await update.message.reply_text("❌ Error loading wallet. Please try again.")
+        await outbox.reply(update.message, "❌ Error loading wallet. Please try again.")
         return
     
     wallet_text = (
         "💼 *YOUR WALLET*\n\n"
-        f"💰 *Coins:* {user_data[2]}\n"
-        f"💎 *Gems:* {user_data[3]}\n"
-        f"📈 *Net Worth:* {user_data[2] + (user_data[3] * 100)}\n\n"
+        f"💰 *Coins:* {user_data.coins}\n"
+        f"💎 *Gems:* {user_data.gems}\n"
+        f"📈 *Net Worth:* {user_data.coins + (user_data.gems * 100)}\n\n"
         "Earn coins by chatting and completing missions!"
     )
     
     if update.message:
-        await update.message.reply_text(wallet_text, reply_markup=back_button(), parse_mode='Markdown')
+        await outbox.reply(update.message, wallet_text, reply_markup=back_button(), parse_mode='Markdown')
     else:
-        await update.callback_query.edit_message_text(wallet_text, reply_markup=back_button(), parse_mode='Markdown')
+        await outbox.edit_query(update.callback_query, wallet_text, reply_markup=back_button(), parse_mode='Markdown')
 
 # Fixed rankings function
-async def show_rankings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+RANKINGS_PER_PAGE = 10
+
+def format_ranking_line(rank, row):
+    user_id, username, coins, level, battles_won = row
+    name = f"@{username}" if username else f"User{user_id}"
+    return f"{rank}. {name} - {coins} coins (Level {level})\n"
+
+@router.exact('rankings')
+async def show_rankings(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0, around_me=False):
+    user = update.effective_user
+    reply_markup = back_button()
     try:
-        rankings = await get_rankings()
+        if not leaderboard.loaded:
+            await load_leaderboard()
         
-        if not rankings:
+        pages = leaderboard.pages(RANKINGS_PER_PAGE)
+        page = min(max(page, 0), pages - 1)
+        
+        if not len(leaderboard):
             rankings_text = "📊 *Rankings*\n\nNo users found yet! Start chatting to appear on the leaderboard!"
+        elif around_me:
+            rankings_text = "📍 *PLAYERS AROUND YOU*\n\n"
+            for rank, row in leaderboard.around(user.id, radius=4):
+                rankings_text += format_ranking_line(rank, row)
+            reply_markup = rankings_keyboard(page, pages)
         else:
-            rankings_text = "🏆 *TOP PLAYERS RANKINGS*\n\n"
-            for idx, (user_id, username, coins, level, battles_won) in enumerate(rankings, 1):
-                name = f"@{username}" if username else f"User{user_id}"
-                rankings_text += f"{idx}. {name} - {coins} coins (Level {level})\n"
+            rankings_text = f"🏆 *TOP PLAYERS RANKINGS* (page {page + 1}/{pages})\n\n"
+            first = page * RANKINGS_PER_PAGE + 1
+            for rank, row in enumerate(leaderboard.page(page, RANKINGS_PER_PAGE), first):
+                rankings_text += format_ranking_line(rank, row)
+            reply_markup = rankings_keyboard(page, pages)
+        
+        my_rank = leaderboard.rank(user.id) if user else None
+        if my_rank:
+            rankings_text += f"\n📍 *Your rank:* #{my_rank} of {len(leaderboard)}"
         
         if update.message:
-            await update.message.reply_text(rankings_text, reply_markup=back_button(), parse_mode='Markdown')
+            await outbox.reply(update.message, rankings_text, reply_markup=reply_markup, parse_mode='Markdown')
         else:
-            await update.callback_query.edit_message_text(rankings_text, reply_markup=back_button(), parse_mode='Markdown')
+            await outbox.edit_query(update.callback_query, rankings_text, reply_markup=reply_markup, parse_mode='Markdown')
     except Exception as e:
         logger.error(f"Rankings error: {e}")
         error_text = "📊 *Rankings*\n\nLeaderboard is currently updating. Please try again!"
         if update.message:
-            await update.message.reply_text(error_text, reply_markup=back_button(), parse_mode='Markdown')
+            await outbox.reply(update.message, error_text, reply_markup=back_button(), parse_mode='Markdown')
         else:
-            await update.callback_query.edit_message_text(error_text, reply_markup=back_button(), parse_mode='Markdown')
+            await outbox.edit_query(update.callback_query, error_text, reply_markup=back_button(), parse_mode='Markdown')
+
+@router.prefix('rankings:')
+async def rankings_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page):
+    await show_rankings(update, context, page=int(page))
+
+@router.exact('rankings_me')
+async def rankings_around_me(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await show_rankings(update, context, around_me=True)
 
 # Battle system functions
+@router.exact('battle_mode')
 async def battle_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
     battle_text = (
         "⚔️ *BATTLE MODE*\n\n"
@@ -239,8 +716,9 @@ async def battle_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     query = update.callback_query
-    await query.edit_message_text(battle_text, reply_markup=battle_mode_keyboard(), parse_mode='Markdown')
+    await outbox.edit_query(query, battle_text, reply_markup=battle_mode_keyboard(), parse_mode='Markdown')
 
+@router.exact('pvp_duel')
 async def pvp_duel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     duel_text = (
         "🤺 *PVP DUEL*\n\n"
@@ -252,14 +730,16 @@ async def pvp_duel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     query = update.callback_query
-    await query.edit_message_text(duel_text, reply_markup=pvp_game_type_keyboard(), parse_mode='Markdown')
+    await outbox.edit_query(query, duel_text, reply_markup=pvp_game_type_keyboard(), parse_mode='Markdown')
 
+@router.exact('battle_rps')
 async def start_battle_rps(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.callback_query.from_user
     user_data = await get_user(user.id, user.username)
     
-    if user_data[2] < 10:
-        await update.callback_query.edit_message_text(
+    if user_data.coins < 10:
+        await outbox.edit_query(
+            update.callback_query,
             "❌ You need at least 10 coins to battle!\nEarn coins by chatting or completing missions.",
             reply_markup=back_button("battle_mode")
         )
@@ -269,112 +749,811 @@ async def start_battle_rps(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "✂️ *ROCK PAPER SCISSORS BATTLE*\n\n"
         "Choose your bet amount:\n\n"
         "Win double your bet if you win the battle!\n"
-        f"Your current balance: {user_data[2]} coins"
+        f"Your current balance: {user_data.coins} coins"
     )
     
     query = update.callback_query
-    await query.edit_message_text(battle_text, reply_markup=bet_amount_keyboard("rps"), parse_mode='Markdown')
+    await outbox.edit_query(query, battle_text, reply_markup=bet_amount_keyboard("rps"), parse_mode='Markdown')
 
 # Rock Paper Scissors game
-async def handle_rps_battle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+RPS_MOVES = games.RPS_MOVES
+
+@router.prefix('bet:rps:')
+async def handle_rps_bet(update: Update, context: ContextTypes.DEFAULT_TYPE, bet_amount):
     query = update.callback_query
     user = query.from_user
-    data = query.data
+    bet_amount = int(bet_amount)
+    user_data = await get_user(user.id, user.username)
     
-    if data.startswith('bet_rps_'):
-        bet_amount = int(data.split('_')[2])
-        user_data = await get_user(user.id, user.username)
-        
-        if user_data[2] < bet_amount:
-            await query.edit_message_text(
-                f"❌ You don't have enough coins!\nNeed: {bet_amount}, Have: {user_data[2]}",
-                reply_markup=back_button("battle_rps")
+    if user_data.coins < bet_amount:
+        await outbox.edit_query(
+            query,
+            f"❌ You don't have enough coins!\nNeed: {bet_amount}, Have: {user_data.coins}",
+            reply_markup=back_button("battle_rps")
+        )
+        return
+    
+    # The stake stays server side; the buttons only carry a one-time session token
+    token = battle_sessions.open(user.id, 'rps', bet_amount)
+    
+    battle_text = (
+        f"✂️ *ROCK PAPER SCISSORS BATTLE*\n\n"
+        f"💰 *Bet Amount:* {bet_amount} coins\n"
+        f"💼 *Your Balance:* {user_data.coins} coins\n\n"
+        f"Choose your move:"
+    )
+    
+    await outbox.edit_query(query, battle_text, reply_markup=rps_keyboard(token), parse_mode='Markdown')
+
+@router.prefix('rps:')
+async def handle_rps_move(update: Update, context: ContextTypes.DEFAULT_TYPE, token, user_move=None, *_):
+    query = update.callback_query
+    user = query.from_user
+    # Buttons from before sessions carry more fields and never match an open session
+    session = battle_sessions.consume(token, user.id, 'rps') if user_move in RPS_MOVES else None
+    if session is None:
+        await outbox.edit_query(
+            query,
+            "⌛ This battle has expired or was already played.",
+            reply_markup=back_button("battle_rps")
+        )
+        return
+    bet_amount = session.stake
+    
+    opponent_move = random.choice(RPS_MOVES)
+    
+    result = games.determine_rps_winner(user_move, opponent_move)
+    settled = await settle_battle(user.id, 'rps', bet_amount, result)
+    
+    if settled is None:
+        await outbox.edit_query(
+            query,
+            "❌ Battle could not be settled. Please try again!",
+            reply_markup=back_button("battle_mode")
+        )
+        return
+    
+    if not settled.ok:
+        await outbox.edit_query(
+            query,
+            "❌ Not enough coins for this bet!",
+            reply_markup=back_button("battle_mode")
+        )
+        return
+    
+    if result == "win":
+        result_text = "🎉 *YOU WIN!*"
+        final_reward = bet_amount
+    elif result == "lose":
+        result_text = "😞 *You lose...*"
+        final_reward = -bet_amount
+    else:
+        result_text = "🤝 *It's a tie!*"
+        final_reward = 0
+    
+    battle_result_text = (
+        f"✂️ *BATTLE RESULTS*\n\n"
+        f"Your move: {get_emoji_move(user_move)}\n"
+        f"Opponent move: {get_emoji_move(opponent_move)}\n\n"
+        f"{result_text}\n"
+        f"💰 *Net Change:* {final_reward} coins\n"
+        f"💼 *New Balance:* {settled.balance} coins"
+    )
+    
+    await outbox.edit_query(query, battle_result_text, reply_markup=back_button("battle_mode"), parse_mode='Markdown')
+
+# Player vs player - stakes are held in escrow while the matchmaker looks for an opponent
+PVP_GAMES = {'rps': '✂️ Rock Paper Scissors', 'dice': '🎲 Dice Battle', 'stats': '📊 Stats Combat'}
+
+def display_name(user_id, username):
+    return escape_markdown(f"@{username}" if username else f"User{user_id}")
+
+@router.prefix('pvp:')
+async def pvp_bets(update: Update, context: ContextTypes.DEFAULT_TYPE, game_type):
+    query = update.callback_query
+    if game_type not in PVP_GAMES:
+        return
+    user = query.from_user
+    user_data = await get_user(user.id, user.username)
+    
+    pvp_text = (
+        f"🤺 *{PVP_GAMES[game_type]} vs PLAYERS*\n\n"
+        "Your stake is held while we find an opponent with a similar rating. "
+        "The winner takes both stakes, a tie refunds them.\n\n"
+        f"🏅 *Your rating:* {user_data.rating}\n"
+        f"💼 *Your balance:* {user_data.coins} coins"
+    )
+    await outbox.edit_query(query, pvp_text, reply_markup=pvp_bet_keyboard(game_type), parse_mode='Markdown')
+
+@router.prefix('queue:')
+async def join_queue(update: Update, context: ContextTypes.DEFAULT_TYPE, game_type, stake, move=None):
+    query = update.callback_query
+    user = query.from_user
+    stake = int(stake)
+    if game_type not in PVP_GAMES or stake not in games.BET_AMOUNTS:
+        return
+    if game_type == 'rps' and move is None:
+        await outbox.edit_query(
+            query,
+            f"✂️ *ROCK PAPER SCISSORS vs PLAYERS*\n\n💰 *Stake:* {stake} coins\n\nPick your move, then we find you an opponent:",
+            reply_markup=pvp_move_keyboard(stake),
+            parse_mode='Markdown'
+        )
+        return
+    if game_type == 'rps' and move not in RPS_MOVES:
+        return
+    
+    if matchmaker.waiting(user.id):
+        await outbox.edit_query(
+            query,
+            "⏳ You are already searching for an opponent.",
+            reply_markup=pvp_searching_keyboard()
+        )
+        return
+    
+    user_data = await get_user(user.id, user.username)
+    if game_type == 'stats':
+        # Stats combat compares power as it was when the player queued
+        move = games.combat_power(user_data.coins, user_data.level)
+    
+    ticket_id = random.getrandbits(62)
+    held = await hold_stake(user.id, ticket_id, game_type, stake)
+    if held is None or not held.ok:
+        balance = held.balance if held else user_data.coins
+        await outbox.edit_query(
+            query,
+            f"❌ Not enough coins! Need: {stake}, Have: {balance}",
+            reply_markup=back_button(f"battle_{game_type}")
+        )
+        return
+    
+    message = query.message
+    ticket = Ticket(
+        ticket_id, user.id, user.username, game_type, stake, user_data.rating, move=move,
+        bot=query.get_bot(), chat_id=message.chat_id, message_id=message.message_id
+    )
+    opponent = matchmaker.join(ticket)
+    if opponent is not None:
+        await resolve_match(opponent, ticket)
+        return
+    
+    await outbox.edit_query(
+        query,
+        f"🔍 *Searching for an opponent...*\n\n"
+        f"{PVP_GAMES[game_type]} - {stake} coins\n"
+        f"🏅 *Your rating:* {user_data.rating}\n\n"
+        f"Your stake is refunded if nobody is found within {PVP_QUEUE_TIMEOUT:.0f} seconds.",
+        reply_markup=pvp_searching_keyboard(),
+        parse_mode='Markdown'
+    )
+
+@router.exact('pvp_cancel')
+async def cancel_queue(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    ticket = matchmaker.cancel(query.from_user.id)
+    if ticket is None:
+        text = "No active search - your match may already have been played."
+    elif await release_stake(ticket):
+        text = f"❌ Search cancelled. {ticket.stake} coins refunded."
+    else:
+        text = "❌ Search cancelled. Your stake will be refunded shortly."
+    await outbox.edit_query(query, text, reply_markup=back_button("pvp_duel"))
+
+def play_match(first, second):
+    """Outcome for `first` and a line per player describing the game."""
+    if first.game == 'rps':
+        outcome = games.rps_outcome(RPS_MOVES.index(first.move), RPS_MOVES.index(second.move))
+        shown = (get_emoji_move(first.move), get_emoji_move(second.move))
+        label = "move"
+    elif first.game == 'dice':
+        rolls = (random.randint(1, games.DICE_SIDES), random.randint(1, games.DICE_SIDES))
+        outcome = games.dice_outcome(*rolls)
+        shown = rolls
+        label = "roll"
+    else:
+        outcome = games.stats_outcome(first.move, second.move)
+        shown = (first.move, second.move)
+        label = "power"
+    lines = {
+        first.user_id: f"Your {label}: {shown[0]}\nOpponent {label}: {shown[1]}",
+        second.user_id: f"Your {label}: {shown[1]}\nOpponent {label}: {shown[0]}",
+    }
+    return outcome, lines
+
+async def resolve_match(first, second):
+    outcome, lines = play_match(first, second)
+    results = [
+        settlement.PvpResult(ticket.ticket_id, ticket.user_id, opponent.user_id, ticket.game, ticket.stake,
+                             ticket_outcome,
+                             rate(ticket.rating, opponent.rating, (ticket_outcome + 1) / 2) - ticket.rating)
+        for ticket, opponent, ticket_outcome in ((first, second, outcome), (second, first, -outcome))
+    ]
+    settled = await settle_match(results)
+
+    sends = []
+    for ticket, opponent, result in zip((first, second), (second, first), results):
+        if not settled or ticket.user_id not in settled:
+            text = "❌ The match could not be settled. Your stake is safe and will be refunded."
+        else:
+            coins, _, _, rating = settled[ticket.user_id]
+            headline = {games.WIN: "🎉 *YOU WIN!*", games.LOSE: "😞 *You lose...*", games.TIE: "🤝 *It's a tie!*"}
+            text = (
+                f"🤺 *PVP RESULTS* - {PVP_GAMES[ticket.game]}\n"
+                f"vs {display_name(opponent.user_id, opponent.username)} (rating {opponent.rating})\n\n"
+                f"{lines[ticket.user_id]}\n\n"
+                f"{headline[result.outcome]}\n"
+                f"💰 *Net Change:* {games.net_change(ticket.stake, result.outcome)} coins\n"
+                f"💼 *New Balance:* {coins} coins\n"
+                f"🏅 *Rating:* {rating} ({result.rating_change:+d})"
             )
-            return
-        
-        battle_id = f"rps_{user.id}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-        
-        battle_text = (
-            f"✂️ *ROCK PAPER SCISSORS BATTLE*\n\n"
-            f"💰 *Bet Amount:* {bet_amount} coins\n"
-            f"💼 *Your Balance:* {user_data[2]} coins\n\n"
-            f"Choose your move:"
+        sends.append(outbox.edit(
+            ticket.bot, ticket.chat_id, ticket.message_id, text,
+            reply_markup=back_button("pvp_duel"), parse_mode='Markdown'
+        ))
+    for sent in await asyncio.gather(*sends, return_exceptions=True):
+        if isinstance(sent, Exception):
+            logger.warning(f"Could not deliver PvP result: {sent}")
+
+async def expire_ticket(ticket):
+    await release_stake(ticket)
+    fields = ("queue", ticket.game, ticket.stake) + ((ticket.move,) if ticket.game == 'rps' else ())
+    retry = pack(*fields)
+    await outbox.edit(
+        ticket.bot, ticket.chat_id, ticket.message_id,
+        f"⌛ No opponent found. Your {ticket.stake} coins were refunded.",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔁 Search again", callback_data=retry)],
+            [InlineKeyboardButton("🔙 Back", callback_data="pvp_duel")],
+        ])
+    )
+
+matchmaker = Matchmaker(
+    on_match=resolve_match, on_expire=expire_ticket,
+    window=PVP_RATING_WINDOW, widen_rate=PVP_WINDOW_GROWTH, timeout=PVP_QUEUE_TIMEOUT
+)
+metrics.callback_metric('pvp_waiting', 'Players waiting in PvP queues', lambda: len(matchmaker))
+
+# Tournaments - bracket state lives on the first shard and rounds close on the job queue
+tournament_entrants = {}
+# Registrations still being written, for each tournament open for registration
+tournament_joins = {}
+notification_tasks = set()
+
+def format_countdown(seconds):
+    if seconds < 60:
+        return f"{max(0, int(seconds))}s"
+    minutes = int(seconds // 60)
+    if minutes >= 24 * 60:
+        return f"{minutes // (24 * 60)}d {minutes % (24 * 60) // 60}h"
+    if minutes >= 60:
+        return f"{minutes // 60}h {minutes % 60}m"
+    return f"{minutes}m"
+
+@lru_cache(maxsize=1024)
+def tournament_keyboard(label=None, data=None):
+    rows = [[InlineKeyboardButton(label, callback_data=data)]] if label else []
+    rows.append([InlineKeyboardButton("🔄 Refresh", callback_data="tournament")])
+    rows.append([InlineKeyboardButton("🔙 Back", callback_data="battle_mode")])
+    return InlineKeyboardMarkup(rows)
+
+@lru_cache(maxsize=None)
+def open_tournament_keyboard():
+    return InlineKeyboardMarkup([[InlineKeyboardButton("🏆 Open tournament", callback_data="tournament")]])
+
+def schedule_tournament(tournament_id, callback, when, round_no=None):
+    if job_queue is None:
+        return
+    name = f"tournament:{tournament_id}"
+    for job in job_queue.get_jobs_by_name(name):
+        job.schedule_removal()
+    job_queue.run_once(callback, max(0.0, when - time.time()), data=(tournament_id, round_no), name=name)
+
+def notify_players(bot, messages):
+    """Send {user_id: text} in the background; players who never started the bot can't be reached."""
+    if bot is None or not messages:
+        return
+    async def deliver():
+        sends = [outbox.send(bot, user_id, text, reply_markup=open_tournament_keyboard(), parse_mode='Markdown')
+                 for user_id, text in messages.items()]
+        failed = sum(isinstance(sent, Exception) for sent in await asyncio.gather(*sends, return_exceptions=True))
+        if failed:
+            logger.info(f"{failed} of {len(sends)} tournament notifications could not be delivered")
+    task = asyncio.create_task(deliver())
+    notification_tasks.add(task)
+    task.add_done_callback(notification_tasks.discard)
+
+def round_messages(round_no, pairs, usernames, deadline):
+    closes = datetime.fromtimestamp(deadline, timezone.utc).strftime('%H:%M UTC')
+    messages = {}
+    for first, second in pairs:
+        if second is None:
+            messages[first] = f"🏆 *Tournament round {round_no}*\n\n🎟️ You have a bye and win this round."
+            continue
+        for user_id, opponent in ((first, second), (second, first)):
+            messages[user_id] = (
+                f"🏆 *Tournament round {round_no}*\n\n"
+                f"🆚 {display_name(opponent, usernames.get(opponent))}\n"
+                f"Roll before {closes} or you lose the match!"
+            )
+    return messages
+
+async def open_tournament(name, format, entry_fee, starts_at):
+    tournament_id = await db.storage.write(tournament.create, name, format, entry_fee, starts_at)
+    tournament_joins[tournament_id] = set()
+    tournament_entrants[tournament_id] = 0
+    schedule_tournament(tournament_id, start_tournament_job, starts_at)
+    logger.info(f"Tournament {tournament_id} ({name}) open for registration")
+    return tournament_id
+
+async def start_tournament(tournament_id, bot=None):
+    # Close registration and let entries already being written land before reading them
+    joins = tournament_joins.pop(tournament_id, set())
+    await asyncio.gather(*joins, return_exceptions=True)
+    entries = [entry for rows in await db.read_all(tournament.entrants, tournament_id) for entry in rows]
+    tournament_entrants.pop(tournament_id, None)
+    
+    if len(entries) < tournament.MIN_PLAYERS:
+        refunds = await db.storage.write(tournament.cancel, tournament_id, entries)
+        if refunds is not None:
+            await pay_tournament(tournament_id)
+            notify_players(bot, {
+                user_id: f"🏆 The tournament was cancelled for lack of players. Your {fee} coins entry fee was refunded."
+                for user_id, _, fee in refunds
+            })
+        return
+    
+    # Seeds follow the rankings; players off the leaderboard come last
+    seeded = sorted(((user_id, username) for user_id, username, _ in entries),
+                    key=lambda entry: (leaderboard.rank(entry[0]) or math.inf, entry[0]))
+    deadline = time.time() + TOURNAMENT_ROUND_MINUTES * 60
+    pairs = await db.storage.write(tournament.start, tournament_id, seeded, deadline)
+    if pairs is None:
+        return
+    logger.info(f"Tournament {tournament_id} started with {len(seeded)} players")
+    schedule_tournament(tournament_id, close_round_job, deadline, 1)
+    notify_players(bot, round_messages(1, pairs, dict(seeded), deadline))
+
+async def close_tournament_round(tournament_id, round_no, bot=None):
+    deadline = time.time() + TOURNAMENT_ROUND_MINUTES * 60
+    closed = await db.storage.write(tournament.close_round, tournament_id, round_no, deadline)
+    if closed is None:
+        return
+    kind, rows, usernames = closed
+    if kind == 'round':
+        schedule_tournament(tournament_id, close_round_job, deadline, round_no + 1)
+        notify_players(bot, round_messages(round_no + 1, rows, usernames, deadline))
+        return
+    await pay_tournament(tournament_id)
+    logger.info(f"Tournament {tournament_id} finished, {len(rows)} prizes paid")
+    notify_players(bot, {
+        user_id: f"🏆 *Tournament finished!*\n\nYou placed #{place} and won {amount} coins."
+        for user_id, place, amount in rows
+    })
+
+async def pay_tournament(tournament_id):
+    # One batched job per shard; entries already paid are skipped, so this is safe to repeat
+    by_shard = {}
+    for user_id, place, amount in await db.storage.read(tournament.unpaid_prizes, tournament_id):
+        by_shard.setdefault(db.shard(user_id).index, []).append((user_id, amount))
+    for paid in await asyncio.gather(*(
+        db.shards[index].storage.write(tournament.pay_prizes, tournament_id, prizes)
+        for index, prizes in by_shard.items()
+    )):
+        for user_id, coins, battles_won in paid:
+            balance_changed(user_id, coins, battles_won)
+    await db.storage.write(tournament.finish, tournament_id)
+
+async def recover_tournaments():
+    resumed = await db.storage.read(tournament.active)
+    for current in resumed:
+        if current.status == 'registration':
+            tournament_joins[current.tournament_id] = set()
+            tournament_entrants[current.tournament_id] = sum(
+                await db.read_all(tournament.count_entrants, current.tournament_id)
+            )
+            schedule_tournament(current.tournament_id, start_tournament_job, current.starts_at)
+        elif current.status == 'running':
+            schedule_tournament(current.tournament_id, close_round_job, current.deadline, current.round)
+        else:
+            await pay_tournament(current.tournament_id)
+    return len(resumed)
+
+# Job queue callbacks
+async def start_tournament_job(context: ContextTypes.DEFAULT_TYPE):
+    tournament_id, _ = context.job.data
+    await start_tournament(tournament_id, context.bot)
+
+async def close_round_job(context: ContextTypes.DEFAULT_TYPE):
+    tournament_id, round_no = context.job.data
+    await close_tournament_round(tournament_id, round_no, context.bot)
+
+async def weekly_tournament_job(context: ContextTypes.DEFAULT_TYPE):
+    if await db.storage.read(tournament.active):
+        logger.info("Skipping this week's tournament, the previous one is still running")
+        return
+    starts_at = time.time() + TOURNAMENT_REGISTRATION_HOURS * 3600
+    name = f"Weekly Tournament {datetime.fromtimestamp(starts_at, timezone.utc):%b %d}"
+    await open_tournament(name, TOURNAMENT_FORMAT, TOURNAMENT_ENTRY_FEE, starts_at)
+
+def format_tournament_match(user_id, match):
+    if match is None:
+        return "You are not playing in this round.\n"
+    round_no, player1, player2, roll1, roll2, winner, name1, name2 = match
+    if player2 is None:
+        return "🎟️ You have a bye this round.\n"
+    mine, theirs = (roll1, roll2) if user_id == player1 else (roll2, roll1)
+    opponent, opponent_name = (player2, name2) if user_id == player1 else (player1, name1)
+    text = f"🆚 *Your match:* {display_name(opponent, opponent_name)}\n"
+    if mine is None:
+        return text + "🎲 Roll before the round closes or you lose the match!\n"
+    if theirs is None:
+        return text + f"🎲 You rolled {mine}, waiting for your opponent.\n"
+    return text + f"🎲 You rolled {mine}, your opponent rolled {theirs}.\n"
+
+@router.exact('tournament')
+async def tournament_screen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user = query.from_user
+    current = await db.storage.read(tournament.latest)
+    
+    if current is None:
+        await outbox.edit_query(
+            query,
+            "🏆 *TOURNAMENT*\n\nNo tournament is scheduled yet. A new one opens every week!",
+            reply_markup=back_button("battle_mode"),
+            parse_mode='Markdown'
         )
-        
-        await query.edit_message_text(battle_text, reply_markup=rps_keyboard(battle_id, bet_amount), parse_mode='Markdown')
-    
-    elif data.startswith('rps_'):
-        parts = data.split('_')
-        if len(parts) >= 5:
-            user_id = parts[1]
-            bet_amount = int(parts[3])
-            user_move = parts[4]
-            
-            user_data = await get_user(user.id, user.username)
-            
-            if user_data[2] < bet_amount:
-                await query.edit_message_text(
-                    "❌ Not enough coins for this bet!",
-                    reply_markup=back_button("battle_mode")
-                )
-                return
-            
-            await update_coins(user.id, -bet_amount)
-            
-            opponent_moves = ['rock', 'paper', 'scissors']
-            opponent_move = random.choice(opponent_moves)
-            
-            result = determine_rps_winner(user_move, opponent_move)
-            
-            if result == "win":
-                reward = bet_amount * 2
-                result_text = "🎉 *YOU WIN!*"
-                await update_coins(user.id, reward)
-                final_reward = reward - bet_amount
-            elif result == "lose":
-                reward = 0
-                result_text = "😞 *You lose...*"
-                final_reward = -bet_amount
-            else:
-                reward = bet_amount
-                result_text = "🤝 *It's a tie!*"
-                await update_coins(user.id, reward)
-                final_reward = 0
-            
-            user_data = await get_user(user.id, user.username)
-            
-            battle_result_text = (
-                f"✂️ *BATTLE RESULTS*\n\n"
-                f"Your move: {get_emoji_move(user_move)}\n"
-                f"Opponent move: {get_emoji_move(opponent_move)}\n\n"
-                f"{result_text}\n"
-                f"💰 *Net Change:* {final_reward} coins\n"
-                f"💼 *New Balance:* {user_data[2]} coins"
+        return
+    
+    now = time.time()
+    label = data = None
+    tournament_text = (
+        f"🏆 *{current.name.upper()}*\n"
+        f"{tournament.FORMATS.get(current.format, current.format)} - entry fee {current.entry_fee} coins\n\n"
+    )
+    if current.status == 'registration':
+        entrants = tournament_entrants.get(current.tournament_id, 0)
+        tournament_text += (
+            f"📝 *Registration open* - starts in {format_countdown(current.starts_at - now)}\n"
+            f"👥 *Entrants:* {entrants}\n"
+            f"💰 *Prize pool:* {entrants * current.entry_fee} coins\n\n"
+        )
+        if await db.shard(user.id).storage.read(tournament.is_registered, current.tournament_id, user.id):
+            tournament_text += "✅ You are registered. Good luck!"
+        else:
+            tournament_text += "Seeding follows the rankings, so a higher rank means an easier bracket."
+            label, data = f"✍️ Join for {current.entry_fee} coins", pack("tjoin", current.tournament_id)
+    elif current.status == 'running':
+        match = await db.storage.read(tournament.current_match, current.tournament_id, user.id)
+        tournament_text += (
+            f"⚔️ *Round {current.round} of {current.rounds}* - closes in {format_countdown(current.deadline - now)}\n"
+            f"👥 {current.players} players, 💰 prize pool {current.players * current.entry_fee} coins\n\n"
+            f"{format_tournament_match(user.id, match)}\n*Leaders:*\n"
+        )
+        for user_id, username, wins, _ in await db.storage.read(tournament.top_players, current.tournament_id):
+            tournament_text += f"• {display_name(user_id, username)} - {wins} wins\n"
+        if match and match[2] is not None and (match[3] if user.id == match[1] else match[4]) is None:
+            label, data = "🎲 Roll", pack("troll", current.tournament_id, current.round)
+    elif current.status == 'cancelled':
+        tournament_text += "❌ Cancelled for lack of players. Entry fees were refunded."
+    else:
+        tournament_text += "🏁 *Final standings:*\n"
+        for user_id, username, place, amount in await db.storage.read(tournament.top_players, current.tournament_id):
+            tournament_text += f"{place}. {display_name(user_id, username)} - {amount} coins\n"
+    
+    await outbox.edit_query(query, tournament_text, reply_markup=tournament_keyboard(label, data), parse_mode='Markdown')
+
+@router.prefix('tjoin:')
+async def tournament_join(update: Update, context: ContextTypes.DEFAULT_TYPE, tournament_id):
+    query = update.callback_query
+    user = query.from_user
+    tournament_id = int(tournament_id)
+    await get_user(user.id, user.username)
+    
+    joins = tournament_joins.get(tournament_id)
+    current = await db.storage.read(tournament.get, tournament_id) if joins is not None else None
+    if current is None or current.status != 'registration' or tournament_joins.get(tournament_id) is not joins:
+        await outbox.edit_query(query, "❌ Registration for this tournament is closed.", reply_markup=back_button("tournament"))
+        return
+    
+    # Tracked so the start of the tournament waits for this entry to land
+    entry = asyncio.ensure_future(db.shard(user.id).storage.write(
+        tournament.register, tournament_id, user.id, user.username, current.entry_fee
+    ))
+    joins.add(entry)
+    try:
+        registered = await entry
+    finally:
+        joins.discard(entry)
+    
+    if registered is not None:
+        ok, coins, battles_won = registered
+        if not ok:
+            await outbox.edit_query(
+                query,
+                f"❌ Not enough coins! Need: {current.entry_fee}, Have: {coins}",
+                reply_markup=back_button("tournament")
             )
-            
-            await query.edit_message_text(battle_result_text, reply_markup=back_button("battle_mode"), parse_mode='Markdown')
+            return
+        balance_changed(user.id, coins, battles_won)
+        tournament_entrants[tournament_id] = tournament_entrants.get(tournament_id, 0) + 1
+    await tournament_screen(update, context)
+
+@router.prefix('troll:')
+async def tournament_roll(update: Update, context: ContextTypes.DEFAULT_TYPE, tournament_id, round_no):
+    user = update.callback_query.from_user
+    tournament_id, round_no = int(tournament_id), int(round_no)
+    rolled = await db.storage.write(
+        tournament.submit_roll, tournament_id, round_no, user.id, random.randint(1, games.DICE_SIDES)
+    )
+    if rolled is not None and rolled[1] == 0:
+        # Every match of the round has both rolls, no need to wait for the deadline
+        schedule_tournament(tournament_id, close_round_job, time.time(), round_no)
+    await tournament_screen(update, context)
+
+async def new_tournament(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in TOURNAMENT_ADMINS:
+        return
+    usage = "Usage: /newtournament [single|swiss] [entry fee] [registration minutes]"
+    args = context.args
+    try:
+        format = args[0] if args else TOURNAMENT_FORMAT
+        entry_fee = int(args[1]) if len(args) > 1 else TOURNAMENT_ENTRY_FEE
+        minutes = float(args[2]) if len(args) > 2 else TOURNAMENT_REGISTRATION_HOURS * 60
+    except ValueError:
+        await outbox.reply(update.message, usage)
+        return
+    if format not in tournament.FORMATS or entry_fee < 0 or minutes < 0:
+        await outbox.reply(update.message, usage)
+        return
+    
+    starts_at = time.time() + minutes * 60
+    name = f"{tournament.FORMATS[format]} Cup {datetime.fromtimestamp(starts_at, timezone.utc):%b %d %H:%M}"
+    await open_tournament(name, format, entry_fee, starts_at)
+    await outbox.reply(
+        update.message,
+        f"🏆 {name} is open for registration, starting in {format_countdown(minutes * 60)}.",
+        reply_markup=open_tournament_keyboard()
+    )
+
+# Team battles - group members attack for a team; counters stay in memory until the window closes
+TEAM_BATTLE_HINT = "\n\nTap a team to join it, then keep tapping to attack!"
+
+@lru_cache(maxsize=256)
+def team_battle_keyboard(battle_id):
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(f"⚔️ {TEAMS[RED]}", callback_data=pack("team", battle_id, RED)),
+        InlineKeyboardButton(f"⚔️ {TEAMS[BLUE]}", callback_data=pack("team", battle_id, BLUE)),
+    ]])
+
+def format_team_scoreboard(battle, final=False):
+    if final:
+        lines = ["🏁 *TEAM BATTLE OVER*", ""]
+    else:
+        lines = [f"👥 *TEAM BATTLE* - ends in {format_countdown(battle.ends_at - time.monotonic())}", ""]
+    for team in (RED, BLUE):
+        lines.append(f"{TEAMS[team]}: *{battle.scores[team]}* damage ({battle.members[team]} players)")
+    total = sum(battle.scores)
+    red = round(10 * battle.scores[RED] / total) if total else 5
+    lines.append("🟥" * red + "🟦" * (10 - red))
+    top = battle.top()
+    if top:
+        lines.append("\n⭐ *Top fighters:*")
+        for user_id, username, team, damage in top:
+            lines.append(f"{TEAMS[team].split()[0]} {display_name(user_id, username)} - {damage}")
+    return "\n".join(lines)
+
+async def refresh_team_scoreboard(battle):
+    await outbox.edit(
+        battle.bot, battle.chat_id, battle.message_id, format_team_scoreboard(battle) + TEAM_BATTLE_HINT,
+        reply_markup=team_battle_keyboard(battle.battle_id), parse_mode='Markdown'
+    )
+
+@safe_db_execute
+async def settle_team_battle(results):
+    # One batched write per shard holding any of the fighters
+    by_shard = {}
+    for result in results:
+        by_shard.setdefault(db.shard(result[0]).index, []).append(result)
+    outcomes = {user_id: outcome for user_id, _, outcome in results}
+    paid = 0
+    for rows in await asyncio.gather(*(
+        db.shards[index].storage.write(settlement.settle_team_battle, db.shards[index].battles, shard_results)
+        for index, shard_results in by_shard.items()
+    )):
+        for user_id, coins, battles_won, battles_lost in rows:
+            balance_changed(user_id, coins, battles_won, battles_lost)
+            battle_played(user_id, 0, games.OUTCOME_CODES[outcomes[user_id]])
+            paid += 1
+    return paid
+
+async def close_team_battle(battle):
+    winner = battle.winner()
+    results = []
+    for user_id, team, actions, damage in battle.contributors():
+        if winner is None:
+            results.append((user_id, TEAM_PLAY_REWARD, 'tie'))
+        elif team == winner:
+            results.append((user_id, TEAM_WIN_REWARD, 'win'))
+        else:
+            results.append((user_id, TEAM_PLAY_REWARD, 'lose'))
+    
+    text = format_team_scoreboard(battle, final=True) + "\n\n"
+    if not results:
+        text += "Nobody fought - no rewards this time."
+    elif await settle_team_battle(results) is None:
+        text += "❌ Rewards could not be paid. Please contact an admin."
+    else:
+        text += "🤝 *It's a draw!*\n" if winner is None else f"🏆 *{TEAMS[winner]} wins!*\n"
+        text += f"{battle.actions} attacks by {len(results)} fighters. "
+        text += f"Winners earn {TEAM_WIN_REWARD} coins, everyone else who fought {TEAM_PLAY_REWARD}."
+    logger.info(f"Team battle {battle.battle_id} in chat {battle.chat_id} closed: {battle.scores}, {len(results)} fighters")
+    await outbox.edit(battle.bot, battle.chat_id, battle.message_id, text, parse_mode='Markdown')
+
+team_battles = TeamBattles(
+    on_refresh=refresh_team_scoreboard, on_close=close_team_battle,
+    refresh=TEAM_SCOREBOARD_SECONDS, cooldown=TEAM_ACTION_COOLDOWN
+)
+metrics.callback_metric('team_battles_active', 'Team battles running', lambda: len(team_battles))
+metrics.callback_metric('team_battle_actions_total', 'Team battle attacks counted', lambda: team_battles.actions, kind='counter')
+
+def is_group(chat):
+    return chat is not None and chat.type in ('group', 'supergroup')
+
+async def open_team_battle(bot, chat_id, seconds):
+    """Start a battle with its scoreboard message; False if the chat already has one."""
+    battle = team_battles.start(chat_id, seconds, bot)
+    if battle is None:
+        return False
+    try:
+        message = await outbox.send(
+            bot, chat_id, format_team_scoreboard(battle) + TEAM_BATTLE_HINT,
+            reply_markup=team_battle_keyboard(battle.battle_id), parse_mode='Markdown'
+        )
+    except Exception:
+        team_battles.discard(battle)
+        raise
+    battle.message_id = message.message_id
+    team_battles.run(battle)
+    return True
+
+@router.exact('team_battle')
+async def team_battle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    team_text = (
+        "👥 *TEAM BATTLE*\n\n"
+        f"Two teams, one chat, {TEAM_BATTLE_MINUTES:g} minutes. Tap a team to join it, then keep tapping to attack. "
+        f"Every fighter on the winning team earns {TEAM_WIN_REWARD} coins, everyone else {TEAM_PLAY_REWARD}.\n\n"
+    )
+    if is_group(query.message.chat if query.message else None):
+        team_text += "Start one right here!"
+        reply_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("⚔️ Start a team battle", callback_data="team_start")],
+            [InlineKeyboardButton("🔙 Back", callback_data="battle_mode")],
+        ])
+    else:
+        team_text += "Add me to a group chat and send /teambattle there to start one."
+        reply_markup = back_button("battle_mode")
+    await outbox.edit_query(query, team_text, reply_markup=reply_markup, parse_mode='Markdown')
+
+@router.exact('team_start')
+async def team_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if not is_group(query.message.chat if query.message else None):
+        await outbox.edit_query(query, "👥 Team battles run in group chats.", reply_markup=back_button("battle_mode"))
+        return
+    if not await open_team_battle(query.get_bot(), query.message.chat_id, TEAM_BATTLE_MINUTES * 60):
+        await outbox.edit_query(query, "👥 A team battle is already running in this chat!", reply_markup=back_button("battle_mode"))
+
+async def start_team_battle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    if not is_group(update.effective_chat):
+        await outbox.reply(message, "👥 Team battles run in group chats. Add me to a group and send /teambattle there!")
+        return
+    minutes = TEAM_BATTLE_MINUTES
+    if context.args:
+        try:
+            minutes = min(max(float(context.args[0]), 1), 60)
+        except ValueError:
+            pass
+    if not await open_team_battle(message.get_bot(), message.chat_id, minutes * 60):
+        await outbox.reply(message, "👥 A team battle is already running in this chat!")
+
+@router.prefix('team:')
+async def team_attack(update: Update, context: ContextTypes.DEFAULT_TYPE, battle_id, team):
+    query = update.callback_query
+    team = int(team)
+    battle = team_battles.get(query.message.chat_id, int(battle_id)) if query.message else None
+    if battle is None or battle.closed or team not in (RED, BLUE):
+        return
+    user = query.from_user
+    if battle.team_of(user.id) is None:
+        # Joining makes sure the player exists; attacks after that never touch the database
+        if not await get_user(user.id, user.username):
+            return
+        battle.join(user.id, user.username, team)
+    team_battles.contribute(battle, user.id, random.randint(1, games.DICE_SIDES))
+
+# Battle history
+BATTLE_NAMES = {
+    'rps': '✂️ RPS', 'dice': '🎲 Dice', 'stats': '📊 Stats',
+    'pvp_rps': '🤺 RPS', 'pvp_dice': '🤺 Dice', 'pvp_stats': '🤺 Stats', 'team': '👥 Team',
+}
+
+def battle_history_keyboard(older_cursor, paged):
+    rows = []
+    nav = []
+    if paged:
+        nav.append(InlineKeyboardButton("⏮ Latest", callback_data="battle_history"))
+    if older_cursor:
+        nav.append(InlineKeyboardButton("Older ⏭", callback_data=pack("history", older_cursor)))
+    if nav:
+        rows.append(nav)
+    rows.append([InlineKeyboardButton("🔙 Back", callback_data="battle_mode")])
+    return InlineKeyboardMarkup(rows)
+
+def format_battle_line(user_id, entry):
+    if entry.winner_id == user_id:
+        mark = "✅"
+    elif entry.winner_id is None:
+        mark = "🤝"
+    else:
+        mark = "❌"
+    name = BATTLE_NAMES.get(entry.battle_type, entry.battle_type)
+    return f"{mark} {name} - bet {entry.bet_amount}, {entry.net_change:+d} coins ({entry.battle_date[:16]})\n"
+
+@router.exact('battle_history')
+@router.prefix('history:')
+async def battle_history(update: Update, context: ContextTypes.DEFAULT_TYPE, before=None):
+    query = update.callback_query
+    before = int(before) if before is not None else None
+    user = query.from_user
+    user_data = await get_user(user.id, user.username)
+    page = await get_battle_history(user.id, before)
+    
+    if not user_data or page is None:
+        await outbox.edit_query(
+            query,
+            "❌ Error loading battle history. Please try again.",
+            reply_markup=back_button("battle_mode")
+        )
+        return
+    
+    entries, has_older = page
+    played = user_data.battles_won + user_data.battles_lost
+    win_rate = user_data.battles_won * 100 // played if played else 0
+    
+    history_text = (
+        "📜 *BATTLE HISTORY*\n\n"
+        f"🏅 *Won:* {user_data.battles_won} | 💀 *Lost:* {user_data.battles_lost} | 📈 *Win rate:* {win_rate}%\n\n"
+    )
+    if entries:
+        for entry in entries:
+            history_text += format_battle_line(user.id, entry)
+    else:
+        history_text += "No battles yet! Start a PVP Duel to make history."
+    
+    older_cursor = entries[-1].battle_id if has_older else None
+    await outbox.edit_query(
+        query,
+        history_text,
+        reply_markup=battle_history_keyboard(older_cursor, before is not None),
+        parse_mode='Markdown'
+    )
 
 def get_emoji_move(move):
     moves = {'rock': '🪨 Rock', 'paper': '📄 Paper', 'scissors': '✂️ Scissors'}
     return moves.get(move, move)
 
-def determine_rps_winner(player_move, opponent_move):
-    if player_move == opponent_move:
-        return "tie"
-    elif (player_move == 'rock' and opponent_move == 'scissors') or \
-         (player_move == 'scissors' and opponent_move == 'paper') or \
-         (player_move == 'paper' and opponent_move == 'rock'):
-        return "win"
-    else:
-        return "lose"
-
 # Dice battle game
+@router.exact('battle_dice')
 async def start_battle_dice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.callback_query.from_user
     user_data = await get_user(user.id, user.username)
     
-    if user_data[2] < 10:
-        await update.callback_query.edit_message_text(
+    if user_data.coins < 10:
+        await outbox.edit_query(
+            update.callback_query,
             "❌ You need at least 10 coins to battle!",
             reply_markup=back_button("battle_mode")
         )
@@ -384,66 +1563,64 @@ async def start_battle_dice(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "🎲 *DICE BATTLE*\n\n"
         "Choose your bet amount:\n\n"
         "Highest roll wins double your bet!\n"
-        f"Your current balance: {user_data[2]} coins"
+        f"Your current balance: {user_data.coins} coins"
     )
     
     query = update.callback_query
-    await query.edit_message_text(dice_text, reply_markup=bet_amount_keyboard("dice"), parse_mode='Markdown')
+    await outbox.edit_query(query, dice_text, reply_markup=bet_amount_keyboard("dice"), parse_mode='Markdown')
 
-async def handle_dice_battle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@router.prefix('bet:dice:')
+async def handle_dice_battle(update: Update, context: ContextTypes.DEFAULT_TYPE, bet_amount):
     query = update.callback_query
     user = query.from_user
-    data = query.data
+    bet_amount = int(bet_amount)
     
-    if data.startswith('bet_dice_'):
-        bet_amount = int(data.split('_')[2])
-        user_data = await get_user(user.id, user.username)
-        
-        if user_data[2] < bet_amount:
-            await query.edit_message_text(
-                f"❌ Not enough coins! Need: {bet_amount}, Have: {user_data[2]}",
-                reply_markup=back_button("battle_dice")
-            )
-            return
-        
-        await update_coins(user.id, -bet_amount)
-        
-        player_roll = random.randint(1, 6)
-        opponent_roll = random.randint(1, 6)
-        
-        if player_roll > opponent_roll:
-            result = "🎉 *YOU WIN!*"
-            reward = bet_amount * 2
-            await update_coins(user.id, reward)
-            net_gain = reward - bet_amount
-        elif player_roll < opponent_roll:
-            result = "😞 *You lose...*"
-            net_gain = -bet_amount
-        else:
-            result = "🤝 *It's a tie!*"
-            await update_coins(user.id, bet_amount)
-            net_gain = 0
-        
-        user_data = await get_user(user.id, user.username)
-        
-        dice_text = (
-            "🎲 *DICE BATTLE RESULTS*\n\n"
-            f"**You rolled:** {player_roll}\n"
-            f"**Opponent rolled:** {opponent_roll}\n\n"
-            f"{result}\n"
-            f"💰 *Net Change:* {net_gain} coins\n"
-            f"💼 *New Balance:* {user_data[2]} coins"
+    player_roll = random.randint(1, games.DICE_SIDES)
+    opponent_roll = random.randint(1, games.DICE_SIDES)
+    
+    code = games.dice_outcome(player_roll, opponent_roll)
+    outcome = games.OUTCOME_NAMES[code]
+    result = {games.WIN: "🎉 *YOU WIN!*", games.LOSE: "😞 *You lose...*", games.TIE: "🤝 *It's a tie!*"}[code]
+    net_gain = games.net_change(bet_amount, code)
+    
+    settled = await settle_battle(user.id, 'dice', bet_amount, outcome)
+    
+    if settled is None:
+        await outbox.edit_query(
+            query,
+            "❌ Battle could not be settled. Please try again!",
+            reply_markup=back_button("battle_dice")
         )
-        
-        await query.edit_message_text(dice_text, reply_markup=back_button("battle_mode"), parse_mode='Markdown')
+        return
+    
+    if not settled.ok:
+        await outbox.edit_query(
+            query,
+            f"❌ Not enough coins! Need: {bet_amount}, Have: {settled.balance}",
+            reply_markup=back_button("battle_dice")
+        )
+        return
+    
+    dice_text = (
+        "🎲 *DICE BATTLE RESULTS*\n\n"
+        f"**You rolled:** {player_roll}\n"
+        f"**Opponent rolled:** {opponent_roll}\n\n"
+        f"{result}\n"
+        f"💰 *Net Change:* {net_gain} coins\n"
+        f"💼 *New Balance:* {settled.balance} coins"
+    )
+    
+    await outbox.edit_query(query, dice_text, reply_markup=back_button("battle_mode"), parse_mode='Markdown')
 
 # Stats combat
+@router.exact('battle_stats')
 async def start_battle_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.callback_query.from_user
     user_data = await get_user(user.id, user.username)
     
-    if user_data[2] < 10:
-        await update.callback_query.edit_message_text(
+    if user_data.coins < 10:
+        await outbox.edit_query(
+            update.callback_query,
             "❌ You need at least 10 coins to battle!",
             reply_markup=back_button("battle_mode")
         )
@@ -454,189 +1631,573 @@ async def start_battle_stats(update: Update, context: ContextTypes.DEFAULT_TYPE)
         "Choose your bet amount:\n\n"
         "Combat power = (Coins/10) + (Level×5)\n"
         "Higher power wins!\n"
-        f"Your current balance: {user_data[2]} coins"
+        f"Your current balance: {user_data.coins} coins"
     )
     
     query = update.callback_query
-    await query.edit_message_text(stats_text, reply_markup=bet_amount_keyboard("stats"), parse_mode='Markdown')
+    await outbox.edit_query(query, stats_text, reply_markup=bet_amount_keyboard("stats"), parse_mode='Markdown')
 
-async def handle_stats_battle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@router.prefix('bet:stats:')
+async def handle_stats_battle(update: Update, context: ContextTypes.DEFAULT_TYPE, bet_amount):
     query = update.callback_query
     user = query.from_user
-    data = query.data
+    bet_amount = int(bet_amount)
     
-    if data.startswith('bet_stats_'):
-        bet_amount = int(data.split('_')[2])
-        user_data = await get_user(user.id, user.username)
-        
-        if user_data[2] < bet_amount:
-            await query.edit_message_text(
-                f"❌ Not enough coins! Need: {bet_amount}, Have: {user_data[2]}",
-                reply_markup=back_button("battle_stats")
-            )
-            return
-        
-        await update_coins(user.id, -bet_amount)
-        
-        user_power = user_data[2] // 10 + user_data[4] * 5
-        opponent_power = random.randint(50, 150)
-        
-        if user_power > opponent_power:
-            result = "🎉 *VICTORY!*"
-            reward = bet_amount * 2
-            await update_coins(user.id, reward)
-            net_gain = reward - bet_amount
-        elif user_power < opponent_power:
-            result = "😞 *Defeat...*"
-            net_gain = -bet_amount
-        else:
-            result = "🤝 *Draw!*"
-            await update_coins(user.id, bet_amount)
-            net_gain = 0
-        
-        user_data = await get_user(user.id, user.username)
-        
-        stats_text = (
-            "📊 *STATS COMBAT RESULTS*\n\n"
-            f"**Your Combat Power:** {user_power}\n"
-            f"**Opponent Power:** {opponent_power}\n\n"
-            f"{result}\n"
-            f"💰 *Net Change:* {net_gain} coins\n"
-            f"💼 *New Balance:* {user_data[2]} coins\n\n"
-            f"💪 Based on your level and wealth!"
+    user_data = await get_user(user.id, user.username)
+    
+    if user_data.coins < bet_amount:
+        await outbox.edit_query(
+            query,
+            f"❌ Not enough coins! Need: {bet_amount}, Have: {user_data.coins}",
+            reply_markup=back_button("battle_stats")
         )
-        
-        await query.edit_message_text(stats_text, reply_markup=back_button("battle_mode"), parse_mode='Markdown')
-
-# SIMPLIFIED FIXED callback handler - NO LAMBDA ERRORS
-async def handle_button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    data = query.data
+        return
     
-    await query.answer()
+    user_power = games.combat_power(user_data.coins, user_data.level)
+    opponent_power = random.randint(*games.STATS_OPPONENT_POWER)
     
-    # Handle different button clicks
-    if data == 'main':
-        await query.edit_message_text(
-            "🤖 *SAMURAI NETWORK - Main Menu*", 
-            reply_markup=main_menu_keyboard(),
-            parse_mode='Markdown'
-        )
-    elif data == 'wallet':
-        await wallet(update, context)
-    elif data == 'rankings':
-        await show_rankings(update, context)
-    elif data == 'stats':
-        await query.edit_message_text(
-            "📊 *Your Stats*\n\nFeature coming soon!", 
-            reply_markup=back_button(),
-            parse_mode='Markdown'
-        )
-    elif data == 'battle_mode':
-        await battle_mode(update, context)
-    elif data == 'pvp_duel':
-        await pvp_duel(update, context)
-    elif data == 'battle_rps':
-        await start_battle_rps(update, context)
-    elif data == 'battle_dice':
-        await start_battle_dice(update, context)
-    elif data == 'battle_stats':
-        await start_battle_stats(update, context)
-    elif data == 'team_battle':
-        await query.edit_message_text(
-            "👥 *Team Battle*\n\nTeam features coming soon!", 
-            reply_markup=back_button("battle_mode"),
-            parse_mode='Markdown'
-        )
-    elif data == 'tournament':
-        await query.edit_message_text(
-            "🏆 *Tournament*\n\nTournament mode launching soon!", 
-            reply_markup=back_button("battle_mode"),
-            parse_mode='Markdown'
-        )
-    elif data == 'battle_history':
-        await query.edit_message_text(
-            "📜 *Battle History*\n\nYour battle records will appear here!", 
-            reply_markup=back_button("battle_mode"),
-            parse_mode='Markdown'
-        )
-    elif data == 'shop':
-        await query.edit_message_text(
-            "🛍️ *Shop*\n\nAwesome items coming soon!", 
-            reply_markup=back_button(),
-            parse_mode='Markdown'
-        )
-    elif data == 'casino':
-        await query.edit_message_text(
-            "🎰 *Casino*\n\nTry your luck at various games!", 
-            reply_markup=back_button(),
-            parse_mode='Markdown'
+    code = games.stats_outcome(user_power, opponent_power)
+    outcome = games.OUTCOME_NAMES[code]
+    result = {games.WIN: "🎉 *VICTORY!*", games.LOSE: "😞 *Defeat...*", games.TIE: "🤝 *Draw!*"}[code]
+    net_gain = games.net_change(bet_amount, code)
+    
+    settled = await settle_battle(user.id, 'stats', bet_amount, outcome)
+    
+    if settled is None:
+        await outbox.edit_query(
+            query,
+            "❌ Battle could not be settled. Please try again!",
+            reply_markup=back_button("battle_stats")
         )
-    elif data == 'missions':
-        await query.edit_message_text(
-            "🎯 *Daily Missions*\n\nComplete missions to earn rewards!", 
-            reply_markup=back_button(),
-            parse_mode='Markdown'
+        return
+    
+    if not settled.ok:
+        await outbox.edit_query(
+            query,
+            f"❌ Not enough coins! Need: {bet_amount}, Have: {settled.balance}",
+            reply_markup=back_button("battle_stats")
         )
-    elif data == 'achievements':
-        await query.edit_message_text(
-            "🎖️ *Achievements*\n\nUnlock achievements for special rewards!", 
-            reply_markup=back_button(),
-            parse_mode='Markdown'
+        return
+    
+    stats_text = (
+        "📊 *STATS COMBAT RESULTS*\n\n"
+        f"**Your Combat Power:** {user_power}\n"
+        f"**Opponent Power:** {opponent_power}\n\n"
+        f"{result}\n"
+        f"💰 *Net Change:* {net_gain} coins\n"
+        f"💼 *New Balance:* {settled.balance} coins\n\n"
+        f"💪 Based on your level and wealth!"
+    )
+    
+    await outbox.edit_query(query, stats_text, reply_markup=back_button("battle_mode"), parse_mode='Markdown')
+
+# Main menu and placeholder screens
+@router.exact('main')
+async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await outbox.edit_query(
+        update.callback_query,
+        "🤖 *SAMURAI NETWORK - Main Menu*", 
+        reply_markup=main_menu_keyboard(),
+        parse_mode='Markdown'
+    )
+
+# My Stats - compares the player with everyone else using the population snapshot
+def format_coin_histogram(histogram, coins, width=10):
+    total = sum(count for _, _, count in histogram) or 1
+    peak = max(count for _, _, count in histogram) or 1
+    lines = []
+    for i, (low, high, count) in enumerate(histogram):
+        last = i == len(histogram) - 1
+        label = f"{low}+" if last else f"{low}-{high - 1}"
+        bar = "█" * max(1 if count else 0, round(width * count / peak))
+        mine = " ◀ you" if low <= coins and (coins < high or last) else ""
+        lines.append(f"{label:>10} {bar:<{width}} {100 * count / total:4.1f}%{mine}")
+    return "\n".join(lines)
+
+def format_relative(value, median, unit=""):
+    if value > median:
+        return f"{value - median:g}{unit} above median"
+    if value < median:
+        return f"{median - value:g}{unit} below median"
+    return "right at the median"
+
+@router.exact('stats')
+async def my_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user = update.effective_user
+    user_data = await get_user(user.id, user.username)
+    snapshot = await population.current()
+    
+    if not user_data or not len(snapshot):
+        await outbox.edit_query(query, "📊 *Your Stats*\n\nStats are not available yet. Please try again!",
+                                reply_markup=back_button(), parse_mode='Markdown')
+        return
+    
+    coins_median = PopulationSnapshot.median(snapshot.coins)
+    level_median = PopulationSnapshot.median(snapshot.levels)
+    stats_text = (
+        "📊 *YOUR STATS*\n\n"
+        f"💰 *Coins:* {user_data.coins} - top {100 - PopulationSnapshot.percentile(snapshot.coins, user_data.coins):.0f}%\n"
+        f"   {format_relative(user_data.coins, round(coins_median))}\n"
+        f"⭐ *Level:* {user_data.level} - better than {PopulationSnapshot.percentile(snapshot.levels, user_data.level):.0f}%\n"
+        f"   {format_relative(user_data.level, round(level_median))}\n"
+    )
+    
+    played = user_data.battles_won + user_data.battles_lost
+    if played:
+        win_rate = user_data.battles_won / played
+        rate_median = PopulationSnapshot.median(snapshot.win_rates)
+        stats_text += (
+            f"⚔️ *Win rate:* {win_rate:.0%} ({user_data.battles_won}W/{user_data.battles_lost}L) - "
+            f"better than {PopulationSnapshot.percentile(snapshot.win_rates, win_rate):.0f}%\n"
+            f"   {format_relative(round(win_rate * 100), round(rate_median * 100), '%')}\n"
         )
-    elif data == 'settings':
-        await query.edit_message_text(
-            "⚙️ *Settings*\n\nConfigure your preferences!", 
-            reply_markup=back_button(),
-            parse_mode='Markdown'
+    else:
+        stats_text += "⚔️ *Win rate:* no battles yet\n"
+    
+    age = max(0, int(time.time() - snapshot.taken_at) // 60)
+    stats_text += (
+        f"\n📈 *Coin distribution* ({len(snapshot)} players)\n"
+        f"```\n{format_coin_histogram(snapshot.coin_histogram(), user_data.coins)}\n```\n"
+        f"_Updated {age} min ago_"
+    )
+    
+    await outbox.edit_query(query, stats_text, reply_markup=back_button(), parse_mode='Markdown')
+
+# Daily missions - progress is the stored counters for today plus what is still buffered
+def format_mission_line(mission, count, claimed):
+    if claimed:
+        return f"✅ {mission.title} - claimed\n"
+    done = min(count, mission.target)
+    filled = done * 8 // mission.target
+    status = "🎁 ready to claim!" if done == mission.target else f"{done}/{mission.target}"
+    return f"{mission.title}\n   {'▰' * filled}{'▱' * (8 - filled)} {status} (+{mission.reward} coins)\n"
+
+@lru_cache(maxsize=64)
+def missions_keyboard(ready):
+    rows = [[InlineKeyboardButton(f"🎁 Claim {missions.MISSIONS_BY_KEY[key][1].reward} coins - {missions.MISSIONS_BY_KEY[key][1].title}",
+                                  callback_data=pack("claim", key))] for key in ready]
+    rows.append([InlineKeyboardButton("🔄 Refresh", callback_data="missions")])
+    rows.append([InlineKeyboardButton("🔙 Back", callback_data="main")])
+    return InlineKeyboardMarkup(rows)
+
+@router.exact('missions')
+async def missions_screen(update: Update, context: ContextTypes.DEFAULT_TYPE, notice=""):
+    user = update.effective_user
+    day = missions.epoch_day()
+    stored, claimed = await db.shard(user.id).storage.read(missions.progress, user.id, day)
+    counts = missions.combine(stored, mission_counters.peek(user.id, day))
+    
+    missions_text = f"🎯 *DAILY MISSIONS*\n\n{notice}"
+    ready = []
+    for bit, mission in enumerate(missions.MISSIONS):
+        count = counts[missions.EVENT_INDEX[mission.event]]
+        done = claimed & (1 << bit)
+        missions_text += format_mission_line(mission, count, done)
+        if not done and count >= mission.target:
+            ready.append(mission.key)
+    missions_text += f"\n⏳ New missions in {format_countdown(missions.seconds_until_rollover())}"
+    
+    reply_markup = missions_keyboard(tuple(ready))
+    if update.message:
+        await outbox.reply(update.message, missions_text, reply_markup=reply_markup, parse_mode='Markdown')
+    else:
+        await outbox.edit_query(update.callback_query, missions_text, reply_markup=reply_markup, parse_mode='Markdown')
+
+@router.prefix('claim:')
+async def claim_mission(update: Update, context: ContextTypes.DEFAULT_TYPE, key):
+    if key not in missions.MISSIONS_BY_KEY:
+        return
+    user = update.callback_query.from_user
+    day = missions.epoch_day()
+    # The claim writes the player's buffered counts itself, so it never misses recent progress
+    pending = mission_counters.take_user(user.id, day)
+    try:
+        paid = await db.shard(user.id).storage.write(missions.claim, user.id, day, key, pending)
+    except Exception:
+        if pending:
+            mission_counters.restore([((user.id, day), pending)])
+        raise
+    notice = ""
+    if paid:
+        balance_changed(user.id, *paid)
+        notice = f"🎉 +{missions.MISSIONS_BY_KEY[key][1].reward} coins! New balance: {paid[0]} coins\n\n"
+    await missions_screen(update, context, notice=notice)
+
+def format_achievement_line(rule, value, unlocked):
+    reward = f" (+{rule.reward} coins)" if rule.reward else ""
+    if unlocked:
+        return f"✅ {rule.title} - {rule.description}\n"
+    return f"🔒 {rule.title} - {rule.description}\n   {min(value or 0, rule.threshold):,}/{rule.threshold:,}{reward}\n"
+
+@router.exact('achievements')
+async def achievements_screen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    user_data = await get_user(user.id, user.username)
+    state = await achievement_engine.state(user.id)
+    if user_data:
+        # Balances that haven't changed since a rule was added still get evaluated
+        emit_event(user.id, 'balance', (user_data.coins, user_data.battles_won))
+
+    text = f"🎖️ *ACHIEVEMENTS* ({len(state.unlocked)}/{len(achievements.RULES)})\n\n"
+    for rule in achievements.RULES:
+        value = getattr(user_data, rule.metric, None) if hasattr(UserRecord, rule.metric) else state.metric(rule.metric)
+        text += format_achievement_line(rule, value, rule.key in state.unlocked)
+    text += f"\n🔥 Win streak: {state.win_streak} (best {state.best_streak})\n📅 Days in a row: {state.login_streak}"
+
+    await outbox.edit_query(update.callback_query, text, reply_markup=back_button(), parse_mode='Markdown')
+
+# Casino - each game is a payout table lookup on a seeded draw; a spin settles in one write
+CASINO_OPTION_LABELS = {
+    'heads': "🪙 Heads", 'tails': "🦅 Tails", 'red': "🔴 Red", 'black': "⚫ Black", 'odd': "Odd", 'even': "Even",
+    'low': "1-18", 'high': "19-36", 'zero': "🟢 Zero", 'spin': "🎰 Spin",
+}
+
+@lru_cache(maxsize=None)
+def casino_keyboard():
+    rows = [[InlineKeyboardButton(game.title, callback_data=pack("casino", game.key))] for game in casino.GAMES.values()]
+    rows.append([InlineKeyboardButton("🔙 Back", callback_data="main")])
+    return InlineKeyboardMarkup(rows)
+
+@lru_cache(maxsize=None)
+def casino_game_keyboard(game_key):
+    game = casino.GAMES[game_key]
+    rows = [[InlineKeyboardButton(f"{CASINO_OPTION_LABELS[option]} · {stake}", callback_data=pack("spin", game_key, option, stake))
+             for stake in casino.STAKES] for option in game.options]
+    rows.append([InlineKeyboardButton("🔙 Back", callback_data="casino")])
+    return InlineKeyboardMarkup(rows)
+
+@router.exact('casino')
+async def casino_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    casino_text = "🎰 *CASINO*\n\nPick a game:\n\n"
+    for game in casino.GAMES.values():
+        best = max(casino.expected_return(game, option) for option in game.options)
+        casino_text += f"• {game.title} - returns {best:.1%} of stakes on average\n"
+    await outbox.edit_query(update.callback_query, casino_text, reply_markup=casino_keyboard(), parse_mode='Markdown')
+
+@router.prefix('casino:')
+async def casino_game(update: Update, context: ContextTypes.DEFAULT_TYPE, game_key):
+    game = casino.GAMES.get(game_key)
+    if game is None:
+        return
+    user = update.callback_query.from_user
+    user_data = await get_user(user.id, user.username)
+    game_text = f"{game.title}\n\nPick your bet and stake.\n💼 *Balance:* {user_data.coins} coins"
+    await outbox.edit_query(update.callback_query, game_text, reply_markup=casino_game_keyboard(game.key), parse_mode='Markdown')
+
+@safe_db_execute
+async def settle_spin(user_id, game, option, stake):
+    draw, position = casino_rng.draw(game.key)
+    paid = casino.payout(game, option, draw, stake)
+    row = await db.shard(user_id).storage.write(
+        casino.spin, user_id, game.key, option, stake, paid, casino_rng.seed, position
+    )
+    if row:
+        balance_changed(user_id, *row)
+        emit_event(user_id, 'wager', stake)
+    return draw, paid, row
+
+@router.prefix('spin:')
+async def casino_spin(update: Update, context: ContextTypes.DEFAULT_TYPE, game_key, option, stake):
+    query = update.callback_query
+    user = query.from_user
+    game = casino.GAMES.get(game_key)
+    stake = int(stake)
+    if game is None or option not in game.payouts or stake not in casino.STAKES:
+        return
+    
+    spun = await settle_spin(user.id, game, option, stake)
+    if spun is None:
+        await outbox.edit_query(query, "❌ The spin could not be settled. Please try again!", reply_markup=back_button("casino"))
+        return
+    draw, paid, row = spun
+    if row is None:
+        await outbox.edit_query(
+            query, f"❌ You don't have enough coins!\nNeed: {stake}", reply_markup=back_button("casino")
         )
-    elif data == 'battle_quick':
-        await query.edit_message_text(
-            "⚡ *Quick Draw*\n\nQuick draw battles coming soon!", 
-            reply_markup=back_button("pvp_duel"),
+        return
+    
+    if paid > stake:
+        result_text = f"🎉 *You win {paid} coins!*"
+    elif paid == stake:
+        result_text = "🤝 *Stake returned*"
+    else:
+        result_text = "😞 *No luck this time...*"
+    spin_text = (
+        f"{game.title}\n\n"
+        f"{game.describe(draw)}\n\n"
+        f"{result_text}\n"
+        f"💰 *Net Change:* {paid - stake} coins\n"
+        f"💼 *New Balance:* {row[0]} coins"
+    )
+    await outbox.edit_query(query, spin_text, reply_markup=casino_game_keyboard(game.key), parse_mode='Markdown')
+
+# Shop - the catalogue never changes at runtime, so its keyboards are built once
+@lru_cache(maxsize=None)
+def shop_keyboard():
+    rows = [[InlineKeyboardButton(f"{item.title} ×{quantity} · {shop.price_label(item, quantity)}",
+                                  callback_data=pack("buy", item.key, quantity))
+             for quantity in shop.QUANTITIES] for item in shop.FOR_SALE]
+    rows.append([InlineKeyboardButton("🎒 My Inventory", callback_data="inventory")])
+    rows.append([InlineKeyboardButton("🔙 Back", callback_data="main")])
+    return InlineKeyboardMarkup(rows)
+
+@lru_cache(maxsize=None)
+def inventory_keyboard():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🛍️ Shop", callback_data="shop"), InlineKeyboardButton("🔙 Back", callback_data="main")]
+    ])
+
+@router.exact('shop')
+async def shop_screen(update: Update, context: ContextTypes.DEFAULT_TYPE, notice=""):
+    user = update.effective_user
+    user_data = await get_user(user.id, user.username)
+    shop_text = f"🛍️ *SHOP*\n\n{notice}"
+    for item in shop.FOR_SALE:
+        shop_text += f"{item.title} - {shop.price_label(item)}\n   _{item.description}_\n"
+    shop_text += f"\n💼 *Balance:* {user_data.coins} coins, {user_data.gems} gems"
+    
+    if update.message:
+        await outbox.reply(update.message, shop_text, reply_markup=shop_keyboard(), parse_mode='Markdown')
+    else:
+        await outbox.edit_query(update.callback_query, shop_text, reply_markup=shop_keyboard(), parse_mode='Markdown')
+
+@safe_db_execute
+async def buy_item(user_id, item, quantity):
+    purchase = await db.shard(user_id).storage.write(shop.buy, user_id, item, quantity)
+    if purchase.ok:
+        balance_changed(user_id, purchase.coins, purchase.battles_won, gems=purchase.gems)
+    return purchase
+
+@router.prefix('buy:')
+async def shop_buy(update: Update, context: ContextTypes.DEFAULT_TYPE, key, quantity):
+    item = shop.ITEMS.get(key)
+    quantity = int(quantity)
+    if item not in shop.FOR_SALE or quantity not in shop.QUANTITIES:
+        return
+    user = update.callback_query.from_user
+    purchase = await buy_item(user.id, item, quantity)
+    if purchase is None:
+        notice = "❌ The purchase could not be completed. Please try again!\n\n"
+    elif not purchase.ok:
+        notice = f"❌ You can't afford {quantity}× {item.title} ({shop.price_label(item, quantity)}).\n\n"
+    else:
+        notice = f"✅ Bought {quantity}× {item.title}!\n\n"
+    await shop_screen(update, context, notice=notice)
+
+@router.exact('inventory')
+async def inventory_screen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.callback_query.from_user
+    owned = await db.shard(user.id).storage.read(shop.inventory, user.id)
+    
+    inventory_text = "🎒 *YOUR INVENTORY*\n\n"
+    if not owned:
+        inventory_text += "Nothing here yet - visit the shop!"
+    for item_id, count in owned:
+        item = shop.ITEMS_BY_ID.get(item_id)
+        if item is not None:
+            inventory_text += f"{item.title} ×{count}\n"
+    await outbox.edit_query(update.callback_query, inventory_text, reply_markup=inventory_keyboard(), parse_mode='Markdown')
+
+async def grant_rewards(user_ids, item=None, count=0, gems=0):
+    """Give an item and/or gems to many players, one batched write per shard."""
+    by_shard = {}
+    for user_id in user_ids:
+        by_shard.setdefault(db.shard(user_id).index, []).append(user_id)
+    for rows in await asyncio.gather(*(
+        db.shards[index].storage.write(shop.grant, shard_users, item, count, gems)
+        for index, shard_users in by_shard.items()
+    )):
+        for user_id, coins, user_gems, battles_won in rows:
+            balance_changed(user_id, coins, battles_won, gems=user_gems)
+    return len(user_ids)
+
+async def grant(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in GRANT_ADMINS:
+        return
+    usage = "Usage: /grant <item|gems> <amount> <top N | user ids...>"
+    args = context.args
+    try:
+        reward, amount = args[0], int(args[1])
+        if args[2] == 'top':
+            user_ids = [row[0] for row in leaderboard.top(int(args[3]))]
+        else:
+            user_ids = sorted({int(user_id) for user_id in args[2:]})
+    except (IndexError, ValueError):
+        await outbox.reply(update.message, usage)
+        return
+    if amount <= 0 or (reward != 'gems' and reward not in shop.ITEMS):
+        await outbox.reply(update.message, usage)
+        return
+    
+    if reward == 'gems':
+        granted = await grant_rewards(user_ids, gems=amount)
+        label = f"{amount} 💎"
+    else:
+        granted = await grant_rewards(user_ids, shop.ITEMS[reward], amount)
+        label = f"{amount}× {shop.ITEMS[reward].title}"
+    logger.info(f"Granted {label} to {granted} players")
+    await outbox.reply(update.message, f"🎁 Granted {label} to {granted} players.")
+
+PLACEHOLDER_SCREENS = {
+    'settings': ("⚙️ *Settings*\n\nConfigure your preferences!", "main"),
+    'battle_quick': ("⚡ *Quick Draw*\n\nQuick draw battles coming soon!", "pvp_duel"),
+}
+
+def placeholder_screen(text, target_menu):
+    async def show(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await outbox.edit_query(
+            update.callback_query,
+            text,
+            reply_markup=back_button(target_menu),
             parse_mode='Markdown'
         )
-    elif data.startswith('rps_'):
-        await handle_rps_battle(update, context)
-    elif data.startswith('bet_dice_'):
-        await handle_dice_battle(update, context)
-    elif data.startswith('bet_stats_'):
-        await handle_stats_battle(update, context)
+    return show
+
+for payload, (text, target_menu) in PLACEHOLDER_SCREENS.items():
+    router.add(payload, placeholder_screen(text, target_menu))
+
+# Callback handler - every payload is dispatched through the router table
+async def handle_button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+    # Buttons from before an update may carry payloads that no longer exist
+    await router.dispatch(update, context, fallback=main_menu)
+
+# Chat messages only count towards missions; they never touch the database or the user's lock
+async def count_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user:
+        emit_event(update.effective_user.id, 'message')
 
 # Error handler
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.error(f"Exception while handling an update: {context.error}")
     try:
         if update and update.callback_query:
-            await update.callback_query.edit_message_text(
+            await outbox.edit_query(
+                update.callback_query,
                 "❌ An error occurred. Please try again!",
                 reply_markup=back_button()
             )
     except Exception as e:
         logger.error(f"Error in error handler: {e}")
 
+async def on_startup(application: Application):
+    global job_queue
+    background_tasks.append(asyncio.create_task(metrics.monitor_event_loop()))
+    if METRICS_PORT:
+        background_tasks.append(await metrics.start_metrics_server(METRICS_PORT))
+    background_tasks.append(asyncio.create_task(population.run()))
+    logger.info(f"Casino RNG seed {casino_rng.seed}")
+    background_tasks.append(asyncio.create_task(run_mission_flush(EVENT_FLUSH_SECONDS)))
+    background_tasks.append(asyncio.create_task(achievement_engine.run()))
+    if BACKUP_DIR:
+        background_tasks.append(asyncio.create_task(run_backups(BACKUP_DIR, BACKUP_INTERVAL_HOURS * 3600, BACKUP_KEEP)))
+    if METRICS_LOG_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(metrics.log_summary(METRICS_LOG_INTERVAL, {
+            'updates': UPDATE_SECONDS,
+            'db': DB_JOB_SECONDS,
+            'telegram': TELEGRAM_SECONDS,
+            'loop lag': metrics.EVENT_LOOP_LAG,
+        })))
+    
+    # Build the in-memory leaderboard once; updates keep it current afterwards
+    players = await load_leaderboard()
+    logger.info(f"Leaderboard loaded with {players} players")
+    
+    refunded = await recover_pvp()
+    if refunded:
+        logger.info(f"Refunded {refunded} PvP stakes left in escrow by the last run")
+    background_tasks.append(asyncio.create_task(matchmaker.run()))
+    
+    # Tournaments resume from their stored round; jobs are rescheduled from the saved deadlines
+    job_queue = application.job_queue if application else None
+    if application and job_queue is None:
+        logger.warning("Job queue unavailable, install python-telegram-bot[job-queue] to run tournaments")
+    resumed = await recover_tournaments()
+    if resumed:
+        logger.info(f"Resumed {resumed} tournaments")
+    if job_queue is not None and TOURNAMENT_WEEKDAY >= 0:
+        job_queue.run_daily(
+            weekly_tournament_job, dtime(hour=TOURNAMENT_HOUR, tzinfo=timezone.utc),
+            days=(TOURNAMENT_WEEKDAY,), name='weekly_tournament'
+        )
+    
+    # Pre-warm so the first updates after a deploy don't pay for cold caches
+    cached = await warm_user_cache(WARM_USERS)
+    main_menu_keyboard()
+    battle_mode_keyboard()
+    pvp_game_type_keyboard()
+    for game_type in ('rps', 'dice', 'stats'):
+        bet_amount_keyboard(game_type)
+    for target_menu in ('main', 'battle_mode', 'pvp_duel', 'battle_rps', 'battle_dice', 'battle_stats', 'tournament'):
+        back_button(target_menu)
+    logger.info(f"Warmed user cache with {cached} players")
+
+async def on_shutdown(application: Application):
+    # Write the mission progress and achievements still buffered in memory before the storage closes
+    await flush_mission_counters()
+    await achievement_engine.process()
+
+def webhook_available():
+    try:
+        import tornado  # noqa: F401 - installed by python-telegram-bot[webhooks]
+    except ImportError:
+        return False
+    return True
+
 def main():
     # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        # Admission hands out the UPDATE_CONCURRENCY slots by priority, so it must see the queue
+        .concurrent_updates(UPDATE_CONCURRENCY + ADMISSION_QUEUE)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     
     # Add handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("wallet", wallet))
-    application.add_handler(CommandHandler("rankings", show_rankings))
-    application.add_handler(CallbackQueryHandler(handle_button_click))
+    application.add_handler(CommandHandler("start", per_user(start)))
+    application.add_handler(CommandHandler("wallet", per_user(wallet)))
+    application.add_handler(CommandHandler("rankings", per_user(show_rankings)))
+    application.add_handler(CommandHandler("newtournament", per_user(new_tournament)))
+    application.add_handler(CommandHandler("teambattle", per_user(start_team_battle)))
+    application.add_handler(CommandHandler("missions", per_user(missions_screen)))
+    application.add_handler(CommandHandler("shop", per_user(shop_screen)))
+    application.add_handler(CommandHandler("grant", per_user(grant)))
+    application.add_handler(CallbackQueryHandler(per_user(handle_button_click)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, count_message))
     
     # Add error handler
     application.add_error_handler(error_handler)
     
     # Start the bot
-    print("🤖 Bot is running with enhanced battle system...")
+    use_webhook = bool(WEBHOOK_URL)
+    if use_webhook and not webhook_available():
+        logger.warning("WEBHOOK_URL is set but webhook support is not installed, falling back to polling")
+        use_webhook = False
+    
+    mode = f"webhook on port {PORT}" if use_webhook else "polling"
+    print(f"🤖 Bot is running with enhanced battle system ({mode}, {UPDATE_CONCURRENCY} concurrent updates)...")
     
     # Run with better error handling
     try:
-        application.run_polling()
+        if use_webhook:
+            application.run_webhook(
+                listen='0.0.0.0',
+                port=PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET
+            )
+        else:
+            application.run_polling()
     except Exception as e:
         logger.error(f"Bot crashed: {e}")
         print(f"❌ Bot crashed: {e}")
+    finally:
+        db.close()
 
 if __name__ == '__main__':
     main()
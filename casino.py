@@ -0,0 +1,170 @@
+"""Casino games: payout lookup tables and a block-generated, seeded RNG.
+
+Every game reduces a spin to one uniform draw in range(outcomes). The
+payout of each (option, draw) pair is computed once at import into a
+table of returns in hundredths of the stake, so settling a spin is a
+table lookup with no game logic. Draws come from one NumPy PCG64 stream
+per game, spawned from a single seed and generated in blocks; a spin
+records the seed and its position in the game's stream, and audit()
+regenerates the same draw from those two numbers.
+"""
+import itertools
+import secrets
+from collections import namedtuple
+
+import numpy as np
+
+BLOCK_SIZE = 4096
+STAKES = (10, 25, 50)
+
+Game = namedtuple('Game', 'key title outcomes options payouts describe')
+
+
+def _coinflip():
+    faces = ('🪙 Heads', '🦅 Tails')
+    # 1.94x for the called side: 97% return
+    payouts = {option: tuple(194 if draw == side else 0 for draw in range(2))
+               for side, option in enumerate(('heads', 'tails'))}
+    return Game('flip', '🪙 Coin Flip', 2, ('heads', 'tails'), payouts, lambda draw: faces[draw])
+
+
+RED_NUMBERS = frozenset((1, 3, 5, 7, 9, 12, 14, 16, 18, 19, 21, 23, 25, 27, 30, 32, 34, 36))
+
+
+def _roulette():
+    # European wheel, pockets 0-36; even-money bets return 2x, zero returns 36x
+    bets = {
+        'red': lambda n: n in RED_NUMBERS,
+        'black': lambda n: n and n not in RED_NUMBERS,
+        'odd': lambda n: n % 2 == 1,
+        'even': lambda n: n and n % 2 == 0,
+        'low': lambda n: 1 <= n <= 18,
+        'high': lambda n: n >= 19,
+        'zero': lambda n: n == 0,
+    }
+    payouts = {option: tuple((3600 if option == 'zero' else 200) if wins(n) else 0 for n in range(37))
+               for option, wins in bets.items()}
+
+    def describe(n):
+        return f"{'🟢' if n == 0 else '🔴' if n in RED_NUMBERS else '⚫'} {n}"
+    return Game('roulette', '🎡 Roulette', 37, tuple(bets), payouts, describe)
+
+
+# Reel strip shared by the three reels: rarer symbols pay more
+SLOT_STRIP = ('🍒',) * 5 + ('🍋',) * 4 + ('🔔',) * 3 + ('⭐',) * 2 + ('💎', '7️⃣')
+SLOT_TRIPLES = {'🍒': 500, '🍋': 1000, '🔔': 2500, '⭐': 5000, '💎': 25000, '7️⃣': 50000}
+SLOT_PAIR_CHERRIES = 100
+
+
+def _slots():
+    reels = len(SLOT_STRIP)
+    table = []
+    for combo in itertools.product(SLOT_STRIP, repeat=3):
+        if combo[0] == combo[1] == combo[2]:
+            table.append(SLOT_TRIPLES[combo[0]])
+        elif combo.count('🍒') == 2:
+            table.append(SLOT_PAIR_CHERRIES)
+        else:
+            table.append(0)
+
+    def describe(draw):
+        return ' | '.join(SLOT_STRIP[draw // reels ** (2 - i) % reels] for i in range(3))
+    return Game('slots', '🎰 Slots', reels ** 3, ('spin',), {'spin': tuple(table)}, describe)
+
+
+GAMES = {game.key: game for game in (_coinflip(), _roulette(), _slots())}
+
+
+def expected_return(game, option):
+    """Average return per coin staked, from the payout table."""
+    return sum(game.payouts[option]) / game.outcomes / 100
+
+
+def payout(game, option, draw, stake):
+    return stake * game.payouts[option][draw] // 100
+
+
+class DrawStream:
+    """Uniform draws in range(outcomes) handed out from NumPy-generated blocks."""
+
+    __slots__ = ('generator', 'outcomes', 'block_size', 'position', '_block', '_next')
+
+    def __init__(self, generator, outcomes, block_size=BLOCK_SIZE):
+        self.generator = generator
+        self.outcomes = outcomes
+        self.block_size = block_size
+        self.position = 0
+        self._block = []
+        self._next = 0
+
+    def draw(self):
+        """(draw, position in the stream)."""
+        if self._next == len(self._block):
+            self._block = self.generator.integers(0, self.outcomes, self.block_size).tolist()
+            self._next = 0
+        draw = self._block[self._next]
+        self._next += 1
+        self.position += 1
+        return draw, self.position - 1
+
+
+def _streams(seed, block_size):
+    children = np.random.SeedSequence(seed).spawn(len(GAMES))
+    return {key: DrawStream(np.random.Generator(np.random.PCG64(child)), game.outcomes, block_size)
+            for (key, game), child in zip(GAMES.items(), children)}
+
+
+class CasinoRng:
+    """The process's casino randomness: one seed, one draw stream per game."""
+
+    def __init__(self, seed=None, block_size=BLOCK_SIZE):
+        # 63 bits so the seed fits an SQLite INTEGER
+        self.seed = secrets.randbits(63) if seed is None else seed
+        self.block_size = block_size
+        self._streams = _streams(self.seed, block_size)
+
+    def draw(self, game_key):
+        return self._streams[game_key].draw()
+
+
+def audit(seed, game_key, position, block_size=BLOCK_SIZE):
+    """Regenerate the draw a spin logged as (seed, position)."""
+    stream = _streams(seed, block_size)[game_key]
+    blocks, offset = divmod(position, block_size)
+    for _ in range(blocks):
+        stream.generator.integers(0, stream.outcomes, block_size)
+    return int(stream.generator.integers(0, stream.outcomes, block_size)[offset])
+
+
+def create_schema(connection):
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS casino_spins (
+            spin_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            game TEXT NOT NULL,
+            option TEXT NOT NULL,
+            stake INTEGER NOT NULL,
+            payout INTEGER NOT NULL,
+            seed INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            spin_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def spin(connection, user_id, game_key, option, stake, paid, seed, position):
+    """Storage write job: settle a drawn spin in one conditional balance update.
+
+    Returns (coins, battles_won), or None when the stake isn't covered.
+    """
+    row = connection.execute(
+        'UPDATE users SET coins = coins + ? WHERE user_id = ? AND coins >= ? RETURNING coins, battles_won',
+        (paid - stake, user_id, stake)
+    ).fetchone()
+    if row is not None:
+        connection.execute(
+            'INSERT INTO casino_spins (user_id, game, option, stake, payout, seed, position) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (user_id, game_key, option, stake, paid, seed, position)
+        )
+    return row
@@ -0,0 +1,53 @@
+"""Rules of the battle games, shared by the bot and the economy simulator.
+
+Outcomes are encoded as WIN = 1, TIE = 0, LOSE = -1, which is also the
+multiplier applied to the stake: a win pays the stake back twice, a tie
+refunds it. Every rule is plain arithmetic, so it works the same on one
+Python int and on whole NumPy arrays of battles.
+"""
+
+WIN, TIE, LOSE = 1, 0, -1
+OUTCOME_NAMES = {WIN: 'win', TIE: 'tie', LOSE: 'lose'}
+OUTCOME_CODES = {name: code for code, name in OUTCOME_NAMES.items()}
+
+# Each move beats the one before it, wrapping around
+RPS_MOVES = ('rock', 'paper', 'scissors')
+
+DICE_SIDES = 6
+
+# Stats combat: the bot's power is drawn uniformly from this range (inclusive)
+STATS_OPPONENT_POWER = (50, 150)
+
+# Stakes offered by the bet keyboards
+BET_AMOUNTS = (10, 25, 50, 100)
+MIN_BET = BET_AMOUNTS[0]
+
+
+def compare(value, opponent_value):
+    """WIN, TIE or LOSE for the higher value winning."""
+    return (value > opponent_value) * 1 - (value < opponent_value) * 1
+
+
+def rps_outcome(move, opponent_move):
+    """Outcome for two move indices into RPS_MOVES."""
+    return (move - opponent_move + 1) % 3 - 1
+
+
+def determine_rps_winner(player_move, opponent_move):
+    return OUTCOME_NAMES[rps_outcome(RPS_MOVES.index(player_move), RPS_MOVES.index(opponent_move))]
+
+
+def dice_outcome(roll, opponent_roll):
+    return compare(roll, opponent_roll)
+
+
+def combat_power(coins, level):
+    return coins // 10 + level * 5
+
+
+def stats_outcome(power, opponent_power):
+    return compare(power, opponent_power)
+
+
+def net_change(stake, outcome):
+    return stake * outcome
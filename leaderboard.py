@@ -0,0 +1,79 @@
+from sortedcontainers import SortedList
+
+
+class Leaderboard:
+    """In-memory index of every player in rankings order.
+
+    Players are kept in a sorted list keyed on (-coins, -battles_won, user_id),
+    the same order as the rankings query, so top-N, rank-of-user and pages
+    are O(log n) lookups instead of a full table scan and sort. Rows come
+    back in the rankings query shape: (user_id, username, coins, level,
+    battles_won).
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._order = SortedList()
+        self._players = {}
+
+    def __len__(self):
+        return len(self._order)
+
+    def load(self, rows):
+        self._order = SortedList()
+        self._players = {}
+        for user_id, username, coins, level, battles_won in rows:
+            key = (-coins, -battles_won, user_id)
+            self._players[user_id] = [key, username, level]
+            self._order.add(key)
+        self.loaded = True
+
+    def update(self, user_id, coins, battles_won, username=None, level=None):
+        key = (-coins, -battles_won, user_id)
+        player = self._players.get(user_id)
+        if player is None:
+            self._players[user_id] = [key, username, level or 1]
+            self._order.add(key)
+            return
+        if player[0] != key:
+            self._order.remove(player[0])
+            self._order.add(key)
+            player[0] = key
+        if username is not None:
+            player[1] = username
+        if level is not None:
+            player[2] = level
+
+    def remove(self, user_id):
+        player = self._players.pop(user_id, None)
+        if player is not None:
+            self._order.remove(player[0])
+
+    def rank(self, user_id):
+        player = self._players.get(user_id)
+        if player is None:
+            return None
+        return self._order.index(player[0]) + 1
+
+    def top(self, limit=10, offset=0):
+        return [self._row(key) for key in self._order.islice(offset, offset + limit)]
+
+    def page(self, page, per_page=10):
+        return self.top(per_page, page * per_page)
+
+    def pages(self, per_page=10):
+        return max(1, -(-len(self._order) // per_page))
+
+    def around(self, user_id, radius=2):
+        """Players ranked next to user_id as (rank, row) pairs."""
+        rank = self.rank(user_id)
+        if rank is None:
+            return []
+        start = max(0, rank - 1 - radius)
+        keys = self._order.islice(start, rank + radius)
+        return [(start + i + 1, self._row(key)) for i, key in enumerate(keys)]
+
+    def _row(self, key):
+        coins, battles_won, user_id = -key[0], -key[1], key[2]
+        _, username, level = self._players[user_id]
+        return (user_id, username, coins, level, battles_won)
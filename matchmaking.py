@@ -0,0 +1,210 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from sortedcontainers import SortedList
+
+logger = logging.getLogger(__name__)
+
+# Elo
+DEFAULT_RATING = 1000
+K_FACTOR = 32
+
+
+def expected_score(rating, opponent_rating):
+    return 1 / (1 + 10 ** ((opponent_rating - rating) / 400))
+
+
+def rate(rating, opponent_rating, score):
+    """New Elo rating after one game; score is 1 for a win, 0.5 for a tie, 0 for a loss."""
+    return round(rating + K_FACTOR * (score - expected_score(rating, opponent_rating)))
+
+
+class Ticket:
+    """One player waiting in a queue, with the stake already held in escrow."""
+
+    __slots__ = ('ticket_id', 'user_id', 'username', 'game', 'stake', 'rating', 'move',
+                 'joined', 'bot', 'chat_id', 'message_id', 'active')
+
+    def __init__(self, ticket_id, user_id, username, game, stake, rating, move=None,
+                 bot=None, chat_id=None, message_id=None, joined=None):
+        self.ticket_id = ticket_id
+        self.user_id = user_id
+        self.username = username
+        self.game = game
+        self.stake = stake
+        self.rating = rating
+        self.move = move
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.joined = time.monotonic() if joined is None else joined
+        self.active = True
+
+    @property
+    def key(self):
+        return (self.rating, self.ticket_id)
+
+
+class Matchmaker:
+    """Rating-bucketed queues for player-vs-player battles.
+
+    Players queue per (game, stake) in a SortedList ordered by rating, so a
+    newcomer is compared with its two rating neighbours in O(log n). The
+    acceptable rating gap starts at `window` and widens by `widen_rate`
+    points per second of the longer wait. Two waiting players can only ever
+    become the best match for each other while they are neighbours, so
+    each adjacent pair goes on a heap with the time its gap becomes
+    acceptable, and a second heap holds queue timeouts; the background
+    task sleeps until the earliest of the two instead of rescanning queues.
+    Heap entries are invalidated lazily when a ticket leaves its queue.
+
+    on_match(first, second) and on_expire(ticket) are coroutines run as
+    tasks; the escrow lives in the database, not here.
+    """
+
+    def __init__(self, on_match, on_expire, window=100, widen_rate=10, timeout=120):
+        self.on_match = on_match
+        self.on_expire = on_expire
+        self.window = window
+        self.widen_rate = widen_rate
+        self.timeout = timeout
+        self.matched = 0
+        self.expired = 0
+        self._queues = {}
+        self._tickets = {}
+        self._pairs = []
+        self._deadlines = []
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._tasks = set()
+
+    def __len__(self):
+        return len(self._tickets)
+
+    def waiting(self, user_id):
+        return self._tickets.get(user_id)
+
+    def queue_sizes(self):
+        return {key: len(queue) for key, queue in self._queues.items() if queue}
+
+    # Queue operations
+    def join(self, ticket):
+        """Queue a ticket; returns the opponent's ticket if matched right away."""
+        if ticket.user_id in self._tickets:
+            raise ValueError(f"User {ticket.user_id} is already queued")
+        queue = self._queues.setdefault((ticket.game, ticket.stake), SortedList(key=lambda t: t.key))
+
+        now = time.monotonic()
+        best = None
+        index = queue.bisect_left(ticket)
+        for neighbour in (queue[index - 1] if index else None, queue[index] if index < len(queue) else None):
+            if neighbour is None or neighbour.user_id == ticket.user_id:
+                continue
+            gap = abs(neighbour.rating - ticket.rating)
+            if gap <= self._window(neighbour, now) and (best is None or gap < abs(best.rating - ticket.rating)):
+                best = neighbour
+        if best is not None:
+            self._remove(best)
+            self.matched += 1
+            return best
+
+        queue.add(ticket)
+        self._tickets[ticket.user_id] = ticket
+        heapq.heappush(self._deadlines, (ticket.joined + self.timeout, next(self._sequence), ticket))
+        index = queue.index(ticket)
+        if index:
+            self._push_pair(queue[index - 1], ticket)
+        if index + 1 < len(queue):
+            self._push_pair(ticket, queue[index + 1])
+        self._wakeup.set()
+        return None
+
+    def cancel(self, user_id):
+        ticket = self._tickets.get(user_id)
+        if ticket is not None:
+            self._remove(ticket)
+        return ticket
+
+    def _remove(self, ticket):
+        ticket.active = False
+        self._tickets.pop(ticket.user_id, None)
+        queue = self._queues[(ticket.game, ticket.stake)]
+        index = queue.index(ticket)
+        queue.pop(index)
+        # The tickets on either side are neighbours now
+        if 0 < index < len(queue):
+            self._push_pair(queue[index - 1], queue[index])
+
+    def _window(self, ticket, now):
+        return self.window + self.widen_rate * (now - ticket.joined)
+
+    def _push_pair(self, lower, upper):
+        gap = abs(upper.rating - lower.rating)
+        oldest = min(lower.joined, upper.joined)
+        if gap <= self.window:
+            due = oldest
+        elif self.widen_rate:
+            due = oldest + (gap - self.window) / self.widen_rate
+        else:
+            return
+        if due - oldest < self.timeout:
+            heapq.heappush(self._pairs, (due, next(self._sequence), lower, upper))
+            self._wakeup.set()
+
+    # Timers
+    def poll(self, now=None):
+        """Pop every pair that became acceptable and every ticket that timed out."""
+        now = time.monotonic() if now is None else now
+        matches, expired = [], []
+        while self._pairs and self._pairs[0][0] <= now:
+            _, _, lower, upper = heapq.heappop(self._pairs)
+            if lower.active and upper.active:
+                self._remove(lower)
+                self._remove(upper)
+                self.matched += 1
+                matches.append((lower, upper))
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, _, ticket = heapq.heappop(self._deadlines)
+            if ticket.active:
+                self._remove(ticket)
+                self.expired += 1
+                expired.append(ticket)
+        return matches, expired
+
+    def next_due(self):
+        while self._pairs and not (self._pairs[0][2].active and self._pairs[0][3].active):
+            heapq.heappop(self._pairs)
+        while self._deadlines and not self._deadlines[0][2].active:
+            heapq.heappop(self._deadlines)
+        due = [heap[0][0] for heap in (self._pairs, self._deadlines) if heap]
+        return min(due) if due else None
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            due = self.next_due()
+            now = time.monotonic()
+            if due is None or due > now:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=None if due is None else due - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            matches, expired = self.poll(now)
+            for first, second in matches:
+                self._spawn(self.on_match(first, second))
+            for ticket in expired:
+                self._spawn(self.on_expire(ticket))
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._finished)
+
+    def _finished(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Matchmaking callback failed: {task.exception()}")
@@ -0,0 +1,294 @@
+import asyncio
+import bisect
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from 100µs to 10s
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def labels(self, *values):
+        return _Child(self, tuple(str(value) for value in values))
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+
+class _Child:
+    __slots__ = ('metric', 'values')
+
+    def __init__(self, metric, values):
+        self.metric = metric
+        self.values = values
+
+    def inc(self, amount=1):
+        self.metric.inc(amount, self.values)
+
+    def dec(self, amount=1):
+        self.metric.dec(amount, self.values)
+
+    def set(self, value):
+        self.metric.set(value, self.values)
+
+    def observe(self, value):
+        self.metric.observe(value, self.values)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        return self._values.get(labels, 0)
+
+    def total(self):
+        return sum(self._values.values())
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}')
+        return lines
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+
+class CallbackMetric(_Metric):
+    """Value read from a function at scrape time, e.g. cache sizes."""
+
+    def __init__(self, name, documentation, function, kind='gauge'):
+        super().__init__(name, documentation)
+        self.function = function
+        self.kind = kind
+
+    def render(self):
+        return self.header() + [f'{self.name} {_format_value(self.function())}']
+
+
+def bucket_quantile(bounds, counts, q):
+    """Upper bound of the bucket holding quantile q, or None for no observations."""
+    total = sum(counts)
+    if not total:
+        return None
+    threshold = q * total
+    running = 0
+    for bound, count in zip(bounds, counts):
+        running += count
+        if running >= threshold:
+            return bound
+    return math.inf
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, labels=()):
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self):
+        return sum(series[2] for series in self._values.values())
+
+    def bucket_counts(self):
+        """Observations per bucket, merged over all label sets."""
+        merged = [0] * len(self.buckets)
+        with self._lock:
+            series = [list(counts) for counts, _, _ in self._values.values()]
+        for counts in series:
+            for i, count in enumerate(counts):
+                merged[i] += count
+        return merged
+
+    def quantile(self, q, since=None):
+        """Approximate quantile over all label sets, as a bucket upper bound.
+
+        With `since`, an earlier bucket_counts() snapshot, only observations
+        made after it count. None when there are no observations.
+        """
+        counts = self.bucket_counts()
+        if since is not None:
+            counts = [count - before for count, before in zip(counts, since)]
+        return bucket_quantile(self.buckets, counts, q)
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            items = sorted((labels, (list(counts), total, count))
+                           for labels, (counts, total, count) in self._values.items())
+        for labels, (counts, total, count) in items:
+            running = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                running += bucket_count
+                bucket_labels = _format_labels(self.labelnames, labels, ('le', _format_value(float(bound))))
+                lines.append(f'{self.name}_bucket{bucket_labels} {running}')
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{label_text} {_format_value(total)}')
+            lines.append(f'{self.name}_count{label_text} {count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def callback_metric(name, documentation, function, kind='gauge'):
+    return REGISTRY.register(CallbackMetric(name, documentation, function, kind))
+
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+# Event loop lag: how late a short sleep wakes up
+EVENT_LOOP_LAG = histogram('event_loop_lag_seconds', 'Delay between a timer being due and running')
+
+
+async def monitor_event_loop(interval=0.5):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - start - interval))
+
+
+# Prometheus text endpoint
+async def _serve_metrics(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readline(), timeout=5)
+        # Drain headers; the request line is all we route on
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', REGISTRY.render().encode()
+        else:
+            status, body = '404 Not Found', b'Not Found\n'
+        writer.write(
+            f'HTTP/1.1 {status}\r\n'
+            'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            'Connection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(port, host='0.0.0.0'):
+    server = await asyncio.start_server(_serve_metrics, host, port)
+    logger.info(f"Metrics available on http://{host}:{port}/metrics")
+    return server
+
+
+def summary_line(sections, previous):
+    """One health summary line; `previous` maps each label to the bucket counts at the last line and is updated."""
+    parts = []
+    for label, metric in sections.items():
+        counts = metric.bucket_counts()
+        interval = [count - before for count, before in zip(counts, previous.get(label) or [0] * len(counts))]
+        previous[label] = counts
+        if not sum(interval):
+            parts.append(f"{label}: 0 obs, p50/p99 n/a")
+            continue
+        p50, p99 = (bucket_quantile(metric.buckets, interval, q) for q in (0.5, 0.99))
+        parts.append(f"{label}: {sum(interval)} obs, p50<={p50 * 1000:g}ms p99<={p99 * 1000:g}ms")
+    return "Metrics | " + " | ".join(parts)
+
+
+async def log_summary(interval, sections):
+    """Log a one-line health summary every `interval` seconds.
+
+    `sections` maps a label to a histogram; each line shows how many
+    observations arrived since the last summary and their p50/p99.
+    """
+    previous = {label: metric.bucket_counts() for label, metric in sections.items()}
+    while True:
+        await asyncio.sleep(interval)
+        logger.info(summary_line(sections, previous))
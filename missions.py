@@ -0,0 +1,136 @@
+"""Daily missions: buffered event counters with a lazy day rollover.
+
+Every player has one missions row holding the counters of a single day,
+stamped with its epoch day (days since 1970-01-01 UTC). Nothing is reset
+at midnight: a row whose stamp is not today reads as all zeros, and the
+first flush of the new day overwrites it. Events are counted in memory
+and flushed periodically as one upsert per player per flush.
+"""
+import time
+from collections import namedtuple
+
+EVENTS = ('battle', 'win', 'wager', 'message')
+EVENT_INDEX = {event: i for i, event in enumerate(EVENTS)}
+
+Mission = namedtuple('Mission', 'key title event target reward')
+
+MISSIONS = (
+    Mission('play', '⚔️ Play 5 battles', 'battle', 5, 30),
+    Mission('win', '🏅 Win 3 battles', 'win', 3, 50),
+    Mission('wager', '💰 Wager 200 coins', 'wager', 200, 40),
+    Mission('chat', '💬 Send 20 messages', 'message', 20, 20),
+)
+# Mission key -> (bit in the claimed mask, mission)
+MISSIONS_BY_KEY = {mission.key: (bit, mission) for bit, mission in enumerate(MISSIONS)}
+
+SECONDS_PER_DAY = 86400
+
+# Counters restart when the stored day is older; increments for an older
+# day than the stored one arrive too late and are dropped
+UPSERT = (
+    f"INSERT INTO missions (user_id, day, {', '.join(EVENTS)}) VALUES (?, ?{', ?' * len(EVENTS)}) "
+    f"ON CONFLICT (user_id) DO UPDATE SET "
+    + ''.join(f'{event} = CASE WHEN day = excluded.day THEN {event} + excluded.{event} ELSE excluded.{event} END, '
+              for event in EVENTS)
+    + 'claimed = CASE WHEN day = excluded.day THEN claimed ELSE 0 END, day = excluded.day '
+    'WHERE excluded.day >= day'
+)
+
+
+def epoch_day(now=None):
+    return int((time.time() if now is None else now) // SECONDS_PER_DAY)
+
+
+def seconds_until_rollover(now=None):
+    now = time.time() if now is None else now
+    return SECONDS_PER_DAY - now % SECONDS_PER_DAY
+
+
+class MissionCounters:
+    """Per-player event counts not yet written, keyed by (user_id, day)."""
+
+    def __init__(self):
+        self.pending = {}
+        self.flushed = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, user_id, event, amount=1, day=None):
+        key = (user_id, epoch_day() if day is None else day)
+        counts = self.pending.get(key)
+        if counts is None:
+            counts = self.pending[key] = [0] * len(EVENTS)
+        counts[EVENT_INDEX[event]] += amount
+
+    def peek(self, user_id, day):
+        return self.pending.get((user_id, day))
+
+    def take(self):
+        entries, self.pending = self.pending, {}
+        return list(entries.items())
+
+    def take_user(self, user_id, day):
+        return self.pending.pop((user_id, day), None)
+
+    def restore(self, entries):
+        """Put back entries whose write failed, merging with anything counted since."""
+        for key, counts in entries:
+            current = self.pending.setdefault(key, [0] * len(EVENTS))
+            for i, count in enumerate(counts):
+                current[i] += count
+
+
+def create_schema(connection):
+    connection.execute(f'''
+        CREATE TABLE IF NOT EXISTS missions (
+            user_id INTEGER PRIMARY KEY,
+            day INTEGER NOT NULL,
+            {', '.join(f'{event} INTEGER DEFAULT 0' for event in EVENTS)},
+            claimed INTEGER DEFAULT 0
+        )
+    ''')
+
+
+def flush(connection, entries):
+    """Storage write job: add buffered [((user_id, day), counts)] to the stored counters."""
+    connection.executemany(UPSERT, [(user_id, day, *counts) for (user_id, day), counts in entries])
+    return len(entries)
+
+
+def progress(connection, user_id, day):
+    """(counts, claimed mask) stored for the day; zeros when the row is from an earlier day."""
+    row = connection.execute(
+        f"SELECT day, {', '.join(EVENTS)}, claimed FROM missions WHERE user_id = ?", (user_id,)
+    ).fetchone()
+    if row is None or row[0] != day:
+        return [0] * len(EVENTS), 0
+    return list(row[1:-1]), row[-1]
+
+
+def combine(stored, pending):
+    if not pending:
+        return stored
+    return [count + extra for count, extra in zip(stored, pending)]
+
+
+def claim(connection, user_id, day, key, pending=None):
+    """Claim a completed mission's reward in one write job.
+
+    The player's unflushed counts go in first, then the claimed bit is set
+    only if the mission is complete and unclaimed today, and the reward is
+    added in the same transaction. Returns (coins, battles_won) or None.
+    """
+    if pending:
+        flush(connection, [((user_id, day), pending)])
+    bit, mission = MISSIONS_BY_KEY[key]
+    claimed = connection.execute(
+        f'UPDATE missions SET claimed = claimed | ? '
+        f'WHERE user_id = ? AND day = ? AND claimed & ? = 0 AND {mission.event} >= ? RETURNING claimed',
+        (1 << bit, user_id, day, 1 << bit, mission.target)
+    ).fetchall()
+    if not claimed:
+        return None
+    return connection.execute(
+        'UPDATE users SET coins = coins + ? WHERE user_id = ? RETURNING coins, battles_won', (mission.reward, user_id)
+    ).fetchone()
@@ -0,0 +1,279 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from telegram.error import BadRequest, RetryAfter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_SECONDS = metrics.histogram(
+    'telegram_request_seconds', 'Duration of outgoing Telegram API calls', ['method']
+)
+TELEGRAM_ERRORS = metrics.counter(
+    'telegram_errors_total', 'Failed outgoing Telegram API calls', ['method', 'error']
+)
+OUTBOX_EVENTS = metrics.counter(
+    'outbox_events_total', 'Outbox decisions: coalesced edits, skipped edits, flood retries', ['event']
+)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        # Seconds until one token is available
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def try_take(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        while not self.try_take():
+            await asyncio.sleep(self.delay())
+
+
+class _Job:
+    __slots__ = ('kind', 'bot', 'chat_id', 'message_id', 'text', 'kwargs', 'futures')
+
+    def __init__(self, kind, bot, chat_id, message_id, text, kwargs):
+        self.kind = kind
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.kwargs = kwargs
+        self.futures = []
+
+
+class _Chat:
+    __slots__ = ('jobs', 'worker')
+
+    def __init__(self):
+        self.jobs = OrderedDict()
+        self.worker = None
+
+
+class Outbox:
+    """Rate-limited outbound queue for messages and edits.
+
+    Every chat has its own queue drained by one worker task, paced by a
+    per-chat token bucket and a bot-wide one, mirroring Telegram's flood
+    limits. A queued edit of a message that already has an edit waiting is
+    folded into it, so only the latest content goes out. Edits identical to
+    what was last sent for that message are skipped without a request, and
+    RetryAfter responses pause all sending for the time Telegram asks.
+    Callers await the delivery result as before.
+    """
+
+    def __init__(self, global_rate=30, private_rate=1.0, group_rate=20 / 60,
+                 chat_burst=3, max_retries=3, remembered=50_000):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.remembered = remembered
+        self.sent = 0
+        self.coalesced = 0
+        self.skipped = 0
+        self.retries = 0
+        self._chats = {}
+        self._buckets = OrderedDict()
+        self._last_content = OrderedDict()
+        self._paused_until = 0.0
+        self._sequence = 0
+
+    # Public API
+    async def edit(self, bot, chat_id, message_id, text, **kwargs):
+        return await self._enqueue('edit', bot, chat_id, message_id, text, kwargs)
+
+    async def send(self, bot, chat_id, text, **kwargs):
+        return await self._enqueue('send', bot, chat_id, None, text, kwargs)
+
+    async def edit_query(self, query, text, **kwargs):
+        message = query.message
+        if message is None:
+            # Inline-mode messages have no chat to queue on
+            return await query.edit_message_text(text, **kwargs)
+        return await self.edit(query.get_bot(), message.chat_id, message.message_id, text, **kwargs)
+
+    async def reply(self, message, text, **kwargs):
+        return await self.send(message.get_bot(), message.chat_id, text, **kwargs)
+
+    def pending(self):
+        return sum(len(chat.jobs) for chat in self._chats.values())
+
+    def stats(self):
+        return {
+            'pending': self.pending(),
+            'active_chats': len(self._chats),
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'skipped': self.skipped,
+            'retries': self.retries,
+        }
+
+    # Queueing
+    def _enqueue(self, kind, bot, chat_id, message_id, text, kwargs):
+        future = asyncio.get_running_loop().create_future()
+        chat = self._chats.get(chat_id)
+
+        if kind == 'edit':
+            key = ('edit', message_id)
+            job = chat.jobs.get(key) if chat is not None else None
+            if job is not None:
+                job.text = text
+                job.kwargs = kwargs
+                job.futures.append(future)
+                self.coalesced += 1
+                OUTBOX_EVENTS.inc(1, ('coalesced',))
+                return future
+            if self._last_content.get((chat_id, message_id)) == self._content(text, kwargs):
+                self.skipped += 1
+                OUTBOX_EVENTS.inc(1, ('skipped',))
+                future.set_result(True)
+                return future
+        else:
+            self._sequence += 1
+            key = ('send', self._sequence)
+
+        if chat is None:
+            chat = self._chats[chat_id] = _Chat()
+        job = _Job(kind, bot, chat_id, message_id, text, kwargs)
+        job.futures.append(future)
+        chat.jobs[key] = job
+        if chat.worker is None:
+            chat.worker = asyncio.create_task(self._drain(chat_id, chat))
+        return future
+
+    async def _drain(self, chat_id, chat):
+        try:
+            while chat.jobs:
+                await self._chat_bucket(chat_id).acquire()
+                await self._acquire_global()
+                # Pop only now: edits queued while we waited get folded in
+                _, job = chat.jobs.popitem(last=False)
+                await self._deliver(job)
+        finally:
+            chat.worker = None
+            if chat.jobs:
+                chat.worker = asyncio.create_task(self._drain(chat_id, chat))
+            else:
+                self._chats.pop(chat_id, None)
+
+    async def _acquire_global(self):
+        while True:
+            paused = self._paused_until - time.monotonic()
+            if paused > 0:
+                await asyncio.sleep(paused)
+                continue
+            await self.global_bucket.acquire()
+            return
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            rate = self.group_rate if chat_id < 0 else self.private_rate
+            bucket = self._buckets[chat_id] = TokenBucket(rate, self.chat_burst)
+            if len(self._buckets) > self.remembered:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(chat_id)
+        return bucket
+
+    # Delivery
+    async def _deliver(self, job):
+        content = self._content(job.text, job.kwargs)
+        if job.kind == 'edit' and self._last_content.get((job.chat_id, job.message_id)) == content:
+            self.skipped += 1
+            OUTBOX_EVENTS.inc(1, ('skipped',))
+            self._resolve(job, result=True)
+            return
+
+        method = 'edit_message_text' if job.kind == 'edit' else 'send_message'
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            try:
+                if job.kind == 'edit':
+                    result = await job.bot.edit_message_text(
+                        job.text, chat_id=job.chat_id, message_id=job.message_id, **job.kwargs
+                    )
+                else:
+                    result = await job.bot.send_message(job.chat_id, job.text, **job.kwargs)
+            except RetryAfter as e:
+                TELEGRAM_ERRORS.inc(1, (method, 'RetryAfter'))
+                OUTBOX_EVENTS.inc(1, ('retry_after',))
+                wait = e.retry_after
+                if isinstance(wait, timedelta):
+                    wait = wait.total_seconds()
+                self.retries += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + wait)
+                logger.warning(f"Flood limit hit in chat {job.chat_id}, retrying in {wait}s")
+                if attempt == self.max_retries:
+                    self._resolve(job, error=e)
+                    return
+                await self._acquire_global()
+            except BadRequest as e:
+                TELEGRAM_SECONDS.observe(time.perf_counter() - start, (method,))
+                if 'not modified' in str(e).lower():
+                    self.skipped += 1
+                    OUTBOX_EVENTS.inc(1, ('not_modified',))
+                    self._remember(job.chat_id, job.message_id, content)
+                    self._resolve(job, result=True)
+                else:
+                    TELEGRAM_ERRORS.inc(1, (method, 'BadRequest'))
+                    self._resolve(job, error=e)
+                return
+            except Exception as e:
+                TELEGRAM_ERRORS.inc(1, (method, type(e).__name__))
+                self._resolve(job, error=e)
+                return
+            else:
+                TELEGRAM_SECONDS.observe(time.perf_counter() - start, (method,))
+                self.sent += 1
+                message_id = job.message_id if job.kind == 'edit' else getattr(result, 'message_id', None)
+                if message_id is not None:
+                    self._remember(job.chat_id, message_id, content)
+                self._resolve(job, result=result)
+                return
+
+    def _remember(self, chat_id, message_id, content):
+        key = (chat_id, message_id)
+        self._last_content[key] = content
+        self._last_content.move_to_end(key)
+        if len(self._last_content) > self.remembered:
+            self._last_content.popitem(last=False)
+
+    @staticmethod
+    def _content(text, kwargs):
+        return (text, kwargs.get('reply_markup'), kwargs.get('parse_mode'))
+
+    @staticmethod
+    def _resolve(job, result=None, error=None):
+        for future in job.futures:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
@@ -0,0 +1,137 @@
+import asyncio
+import itertools
+import logging
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Coin histogram edges follow a 1-2.5-5 series so a skewed economy stays readable
+_COIN_STEPS = (1, 2.5, 5)
+
+
+class PopulationSnapshot:
+    """Sorted NumPy copies of the users columns at one point in time.
+
+    Built off the event loop; afterwards every lookup is a binary search
+    (np.searchsorted) against the sorted arrays, so a stats screen costs
+    O(log n) no matter how many players there are. Win rates only cover
+    players with at least one finished battle.
+    """
+
+    def __init__(self, coins, levels, win_rates, taken_at=None):
+        self.coins = np.sort(coins)
+        self.levels = np.sort(levels)
+        self.win_rates = np.sort(win_rates)
+        self.taken_at = taken_at or time.time()
+        self.coin_edges = self._coin_edges(self.coins)
+        self.coin_counts = np.diff(np.searchsorted(self.coins, self.coin_edges, side='left'))
+
+    def __len__(self):
+        return len(self.coins)
+
+    @staticmethod
+    def select_columns(connection):
+        """Storage read job: the users columns as an (n, 4) int64 array."""
+        cursor = connection.execute(
+            'SELECT COALESCE(coins, 0), COALESCE(level, 1), '
+            'COALESCE(battles_won, 0), COALESCE(battles_lost, 0) FROM users'
+        )
+        values = np.fromiter(itertools.chain.from_iterable(cursor), dtype=np.int64)
+        return values.reshape(-1, 4)
+
+    @classmethod
+    def build(cls, parts):
+        """Snapshot from the select_columns() arrays of every shard."""
+        columns = np.concatenate(parts) if parts else np.empty((0, 4), dtype=np.int64)
+        won, lost = columns[:, 2], columns[:, 3]
+        played = won + lost
+        battled = played > 0
+        win_rates = won[battled] / played[battled]
+        return cls(columns[:, 0], columns[:, 1], win_rates)
+
+    @staticmethod
+    def _coin_edges(coins):
+        top = int(coins[-1]) + 1 if len(coins) else 1
+        edges = [0]
+        for magnitude in itertools.count():
+            for step in _COIN_STEPS:
+                edge = int(step * 10 ** magnitude)
+                if edge > edges[-1]:
+                    edges.append(edge)
+                if edge >= top:
+                    return np.array(edges, dtype=np.int64)
+
+    # Per-player lookups
+    @staticmethod
+    def percentile(values, value):
+        """Share of players below `value` in 0..100, counting ties as half."""
+        if not len(values):
+            return 0.0
+        below = np.searchsorted(values, value, side='left')
+        not_above = np.searchsorted(values, value, side='right')
+        return 100.0 * (below + not_above) / 2 / len(values)
+
+    @staticmethod
+    def median(values):
+        return float(np.median(values)) if len(values) else 0.0
+
+    def coin_histogram(self, max_bins=8):
+        """[(low, high, count)] with empty ends dropped and sparse ends folded together."""
+        occupied = np.nonzero(self.coin_counts)[0]
+        if not len(occupied):
+            return []
+        first, last = occupied[0], occupied[-1] + 1
+        edges = self.coin_edges[first:last + 1].tolist()
+        counts = self.coin_counts[first:last].tolist()
+        while len(counts) > max_bins:
+            if counts[0] + counts[1] <= counts[-2] + counts[-1]:
+                counts[0:2] = [counts[0] + counts[1]]
+                del edges[1]
+            else:
+                counts[-2:] = [counts[-2] + counts[-1]]
+                del edges[-2]
+        return [(edges[i], edges[i + 1], counts[i]) for i in range(len(counts))]
+
+
+class PopulationStats:
+    """Holds the current snapshot and refreshes it in the background."""
+
+    def __init__(self, db, interval=300):
+        self.db = db
+        self.interval = interval
+        self.snapshot = None
+        self.refreshes = 0
+        self._refreshing = None
+
+    async def refresh(self):
+        # Concurrent callers share one refresh instead of each scanning the table
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(self._refresh())
+            self._refreshing.add_done_callback(self._refresh_done)
+        return await asyncio.shield(self._refreshing)
+
+    def _refresh_done(self, task):
+        self._refreshing = None
+
+    async def _refresh(self):
+        started = time.perf_counter()
+        parts = await self.db.read_all(PopulationSnapshot.select_columns)
+        self.snapshot = await asyncio.to_thread(PopulationSnapshot.build, parts)
+        self.refreshes += 1
+        logger.info(f"Population snapshot of {len(self.snapshot)} players built in {time.perf_counter() - started:.2f}s")
+        return self.snapshot
+
+    async def current(self):
+        if self.snapshot is None:
+            return await self.refresh()
+        return self.snapshot
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Population snapshot refresh failed: {e}")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,198 @@
+"""Offline resharding: copies a shard set into a new one with a different shard count.
+
+Usage:
+    python reshard.py --path game_bot.db --from-shards 1 --to-shards 4
+
+Stop the bot first. The source files are only read; the target files must
+not exist yet. Per-player tables (sharding.SHARD_KEYS) are redistributed by
+player id, every other table is copied to the first target shard. Each
+shard numbers AUTOINCREMENT ids on its own, so per-player tables are
+copied without them and the target shards assign new ones. Row counts
+are checked at the end. Once it succeeds, start the bot with
+SHARD_COUNT set to the new count; the old files can be removed after that.
+
+The bot keeps the same DB_PATH: a single file database game_bot.db becomes
+game_bot.shard0-of-4.db ... game_bot.shard3-of-4.db next to it. Use
+--target to write the new set under a different name.
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+import sharding
+
+logger = logging.getLogger('reshard')
+
+BATCH_SIZE = 10_000
+
+# Bookkeeping tables that are rebuilt, not copied
+SKIPPED_TABLES = ('sqlite_sequence', 'shard_layout')
+
+
+def open_source(path):
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Source shard {path} does not exist")
+    return sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+
+
+def open_target(path, index, count, schema):
+    if os.path.exists(path):
+        raise FileExistsError(f"Target shard {path} already exists")
+    connection = sqlite3.connect(path, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=OFF')
+    connection.execute('BEGIN')
+    for statement in schema:
+        connection.execute(statement)
+    sharding.stamp_layout(connection, index, count)
+    return connection
+
+
+def read_schema(connection):
+    """CREATE statements of the source, tables before indexes."""
+    rows = connection.execute(
+        "SELECT type, name, sql FROM sqlite_master "
+        "WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+        "ORDER BY CASE type WHEN 'table' THEN 0 ELSE 1 END, rowid"
+    ).fetchall()
+    return [sql for kind, name, sql in rows if name not in SKIPPED_TABLES]
+
+
+def read_tables(connection):
+    rows = connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+    ).fetchall()
+    return [name for name, in rows if name not in SKIPPED_TABLES]
+
+
+def autoincrement_column(connection, table):
+    """The AUTOINCREMENT primary key column of a table, or None."""
+    sql = connection.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone()[0]
+    if 'AUTOINCREMENT' not in sql.upper():
+        return None
+    for _, name, _, _, _, pk in connection.execute(f'PRAGMA table_info("{table}")'):
+        if pk:
+            return name
+
+
+def copy_table(source, targets, table, target_count):
+    key = sharding.SHARD_KEYS.get(table)
+    columns = [row[1] for row in source.execute(f'PRAGMA table_info("{table}")')]
+    generated = autoincrement_column(source, table) if key else None
+    if generated:
+        # Ids from different source shards collide; the targets renumber them
+        columns.remove(generated)
+    column_list = ', '.join(f'"{column}"' for column in columns)
+    placeholders = ', '.join('?' for _ in columns)
+    cursor = source.execute(f'SELECT {column_list} FROM "{table}"')
+    insert = f'INSERT INTO "{table}" ({column_list}) VALUES ({placeholders})'
+
+    key_index = columns.index(key) if key else None
+    copied = [0] * len(targets)
+    while True:
+        rows = cursor.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        if key_index is None:
+            targets[0].executemany(insert, rows)
+            copied[0] += len(rows)
+            continue
+        buckets = [[] for _ in targets]
+        for row in rows:
+            owner = row[key_index]
+            buckets[sharding.shard_index(owner, target_count) if owner is not None else 0].append(row)
+        for i, bucket in enumerate(buckets):
+            if bucket:
+                targets[i].executemany(insert, bucket)
+                copied[i] += len(bucket)
+    return copied
+
+
+def count_rows(connections, table):
+    return sum(connection.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0] for connection in connections)
+
+
+def reshard(path, from_shards, to_shards, target=None):
+    source_paths = sharding.shard_paths(path, from_shards)
+    target_paths = sharding.shard_paths(target or path, to_shards)
+    overlap = set(map(os.path.abspath, source_paths)) & set(map(os.path.abspath, target_paths))
+    if overlap:
+        raise ValueError(f"Source and target share files: {sorted(overlap)}; pass --target")
+
+    sources = [open_source(source_path) for source_path in source_paths]
+    for index, source in enumerate(sources):
+        # Databases from before sharding are a single unstamped file
+        if not sharding.check_layout(source, index, from_shards) and from_shards != 1:
+            raise ValueError(f"{source_paths[index]} is not stamped as shard {index} of {from_shards}")
+    schema = read_schema(sources[0])
+    tables = read_tables(sources[0])
+    targets = []
+    try:
+        for index, target_path in enumerate(target_paths):
+            targets.append(open_target(target_path, index, to_shards, schema))
+
+        for table in tables:
+            started = time.perf_counter()
+            copied = [0] * to_shards
+            for source in sources:
+                for i, count in enumerate(copy_table(source, targets, table, to_shards)):
+                    copied[i] += count
+            logger.info(f"{table}: {sum(copied)} rows in {time.perf_counter() - started:.1f}s, per shard {copied}")
+
+        for table in tables:
+            expected, found = count_rows(sources, table), count_rows(targets, table)
+            if expected != found:
+                raise RuntimeError(f"{table}: copied {found} rows, source has {expected}")
+
+        for connection in targets:
+            connection.execute('COMMIT')
+    except BaseException:
+        for connection in targets:
+            connection.close()
+        for target_path in target_paths[:len(targets)]:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(target_path + suffix):
+                    os.remove(target_path + suffix)
+        raise
+    finally:
+        for source in sources:
+            source.close()
+
+    for connection in targets:
+        connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        connection.close()
+    return target_paths
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--path', default=os.getenv('DB_PATH', 'game_bot.db'), help='DB_PATH of the bot')
+    parser.add_argument('--from-shards', type=int, default=1, help='current SHARD_COUNT')
+    parser.add_argument('--to-shards', type=int, required=True, help='new SHARD_COUNT')
+    parser.add_argument('--target', help='DB_PATH for the new shard set (defaults to --path)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    if args.from_shards < 1 or args.to_shards < 1:
+        logger.error("Shard counts must be at least 1")
+        return 2
+    try:
+        paths = reshard(args.path, args.from_shards, args.to_shards, args.target)
+    except (OSError, ValueError, RuntimeError, sqlite3.Error) as e:
+        logger.error(f"Resharding failed: {e}")
+        return 1
+    logger.info(f"Wrote {len(paths)} shards: {', '.join(paths)}")
+    logger.info(f"Start the bot with SHARD_COUNT={args.to_shards}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+import logging
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+HANDLER_SECONDS = metrics.histogram(
+    'callback_handler_seconds', 'Time spent in each callback handler', ['handler']
+)
+UNROUTED = metrics.counter('callback_unrouted_total', 'Callbacks with no matching route')
+
+# callback_data codec: "<prefix>:<field>:<field>..." in at most 64 bytes
+SEPARATOR = ':'
+MAX_CALLBACK_DATA = 64
+
+
+def pack(*fields):
+    data = SEPARATOR.join(str(field) for field in fields)
+    if len(data.encode('utf-8')) > MAX_CALLBACK_DATA:
+        raise ValueError(f"callback_data too long: {data!r}")
+    return data
+
+
+def unpack(data):
+    return data.split(SEPARATOR) if data else []
+
+
+class _Node:
+    __slots__ = ('children', 'handler')
+
+    def __init__(self):
+        self.children = {}
+        self.handler = None
+
+
+class CallbackRouter:
+    """Dispatch table for callback_data payloads.
+
+    Plain payloads ("wallet") are an O(1) dict lookup. Parameterized
+    payloads are registered by prefix ("bet:dice:") in a character trie;
+    the longest registered prefix wins and the rest of the payload is
+    unpacked into positional string arguments for the handler.
+    """
+
+    def __init__(self):
+        self._exact = {}
+        self._root = _Node()
+
+    def add(self, payload, handler):
+        self._exact[payload] = handler
+
+    def add_prefix(self, prefix, handler):
+        node = self._root
+        for char in prefix:
+            node = node.children.setdefault(char, _Node())
+        node.handler = handler
+
+    def exact(self, *payloads):
+        def register(handler):
+            for payload in payloads:
+                self.add(payload, handler)
+            return handler
+        return register
+
+    def prefix(self, *prefixes):
+        def register(handler):
+            for prefix in prefixes:
+                self.add_prefix(prefix, handler)
+            return handler
+        return register
+
+    def payloads(self):
+        return list(self._exact)
+
+    def prefixes(self):
+        found = []
+        stack = [('', self._root)]
+        while stack:
+            prefix, node = stack.pop()
+            if node.handler is not None:
+                found.append(prefix)
+            for char, child in node.children.items():
+                stack.append((prefix + char, child))
+        return sorted(found)
+
+    def resolve(self, data):
+        handler = self._exact.get(data)
+        if handler is not None:
+            return handler, ()
+
+        node = self._root
+        match, end = None, 0
+        for i, char in enumerate(data):
+            node = node.children.get(char)
+            if node is None:
+                break
+            if node.handler is not None:
+                match, end = node.handler, i + 1
+        if match is None:
+            return None, ()
+        return match, unpack(data[end:])
+
+    async def dispatch(self, update, context, fallback=None):
+        data = update.callback_query.data or ''
+        handler, args = self.resolve(data)
+        if handler is None:
+            UNROUTED.inc()
+            logger.warning(f"No route for callback data {data!r}")
+            if fallback is not None:
+                await fallback(update, context)
+            return
+        start = time.perf_counter()
+        try:
+            await handler(update, context, *args)
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, (handler.__name__,))
@@ -0,0 +1,75 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LOCK_WAIT = metrics.histogram('user_lock_wait_seconds', 'Time an update waited for the same user\'s previous one')
+
+
+class UserSequencer:
+    """Serializes work per user while different users run in parallel.
+
+    Each active user gets an asyncio.Lock, created on first use and dropped
+    as soon as nobody holds or waits on it, so memory follows the number of
+    users with updates in flight rather than the user base. asyncio.Lock
+    wakes waiters in FIFO order, which keeps a user's updates in arrival
+    order. Time spent waiting for the lock is recorded for monitoring.
+    """
+
+    def __init__(self, slow_wait=0.5):
+        self.slow_wait = slow_wait
+        self.acquisitions = 0
+        self.contended = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._locks = {}
+
+    @asynccontextmanager
+    async def hold(self, user_id):
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            lock = entry[0]
+            if lock.locked():
+                start = time.perf_counter()
+                async with lock:
+                    self._record(user_id, time.perf_counter() - start)
+                    yield
+            else:
+                async with lock:
+                    self._record(user_id, 0.0)
+                    yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user_id]
+
+    def _record(self, user_id, waited):
+        LOCK_WAIT.observe(waited)
+        self.acquisitions += 1
+        if not waited:
+            return
+        self.contended += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        if waited >= self.slow_wait:
+            logger.warning(f"User {user_id} waited {waited * 1000:.0f} ms for their previous update")
+
+    def active(self):
+        return len(self._locks)
+
+    def stats(self):
+        return {
+            'active_users': len(self._locks),
+            'acquisitions': self.acquisitions,
+            'contended': self.contended,
+            'total_wait_seconds': self.total_wait,
+            'max_wait_seconds': self.max_wait,
+            'mean_contended_wait_seconds': self.total_wait / self.contended if self.contended else 0.0,
+        }
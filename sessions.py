@@ -0,0 +1,94 @@
+import secrets
+import time
+
+
+class Session:
+    __slots__ = ('token', 'user_id', 'kind', 'stake', 'expires')
+
+    def __init__(self, token, user_id, kind, stake, expires):
+        self.token = token
+        self.user_id = user_id
+        self.kind = kind
+        self.stake = stake
+        self.expires = expires
+
+
+class SessionStore:
+    """Short-lived prompts that a button press refers to by token.
+
+    The keyboard only carries the token; the stake and owner stay here and
+    a session is popped the first time it is used, so replaying an old
+    keyboard finds nothing. Expiry runs on a hashed timing wheel: sessions
+    sit in the bucket of the tick they expire in, and moving the clock
+    forward drops whole buckets, so no call ever scans every session. At
+    most `capacity` sessions are kept; beyond that the ones closest to
+    expiring are dropped first.
+    """
+
+    def __init__(self, ttl=600.0, tick=1.0, capacity=500_000):
+        self.ttl = ttl
+        self.tick = tick
+        self.capacity = capacity
+        self.opened = 0
+        self.expired = 0
+        self.rejected = 0
+        self._sessions = {}
+        self._wheel = [set() for _ in range(int(ttl / tick) + 2)]
+        self._now_tick = self._tick_of(time.monotonic())
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def open(self, user_id, kind, stake):
+        now = time.monotonic()
+        self._advance(now)
+        while len(self._sessions) >= self.capacity:
+            self._evict_one()
+        token = secrets.token_urlsafe(6)
+        while token in self._sessions:
+            token = secrets.token_urlsafe(6)
+        session = Session(token, user_id, kind, stake, now + self.ttl)
+        self._sessions[token] = session
+        self._bucket(session.expires).add(token)
+        self.opened += 1
+        return token
+
+    def consume(self, token, user_id, kind):
+        """The session behind `token` if it belongs to the user and is still open; it is removed."""
+        now = time.monotonic()
+        self._advance(now)
+        session = self._sessions.get(token)
+        if session is None or session.user_id != user_id or session.kind != kind or session.expires <= now:
+            self.rejected += 1
+            return None
+        del self._sessions[token]
+        self._bucket(session.expires).discard(token)
+        return session
+
+    def _tick_of(self, moment):
+        return int(moment // self.tick)
+
+    def _bucket(self, expires):
+        return self._wheel[self._tick_of(expires) % len(self._wheel)]
+
+    def _advance(self, now):
+        target = self._tick_of(now)
+        # After a long idle gap one lap of the wheel has seen every bucket
+        start = max(self._now_tick, target - len(self._wheel))
+        for tick in range(start, target):
+            self._expire(self._wheel[tick % len(self._wheel)], now)
+        self._now_tick = max(self._now_tick, target)
+
+    def _expire(self, bucket, now):
+        for token in [token for token in bucket if self._sessions[token].expires <= now]:
+            bucket.discard(token)
+            del self._sessions[token]
+            self.expired += 1
+
+    def _evict_one(self):
+        for offset in range(len(self._wheel)):
+            bucket = self._wheel[(self._now_tick + offset) % len(self._wheel)]
+            if bucket:
+                del self._sessions[bucket.pop()]
+                self.expired += 1
+                return
@@ -0,0 +1,184 @@
+import json
+from collections import namedtuple
+
+import games
+
+# Result of a settlement: ok is False when the balance could not cover the
+# stake, in which case nothing was written and balance is the current one.
+Settlement = namedtuple('Settlement', 'ok balance battles_won battles_lost')
+
+# winner_id values for battles against the bot
+HOUSE_ID = 0
+
+OUTCOME_DELTA = games.OUTCOME_CODES
+
+
+def battle_winner(user_id, outcome):
+    if outcome == 'win':
+        return user_id
+    if outcome == 'lose':
+        return HOUSE_ID
+    return None
+
+
+def settle(connection, battle_log, user_id, battle_type, stake, outcome):
+    """Settle one battle against the bot as a single statement group.
+
+    Runs inside a storage write job: the balance check, the net delta and
+    the win/loss counters are one conditional UPDATE, so a concurrent
+    settlement can never overdraw the player, and the battle row is
+    buffered in battle_log to land in the same group commit.
+    """
+    delta = games.net_change(stake, OUTCOME_DELTA[outcome])
+    rows = connection.execute(
+        'UPDATE users SET coins = coins + ?, '
+        'battles_won = battles_won + ?, battles_lost = battles_lost + ? '
+        'WHERE user_id = ? AND coins >= ? '
+        'RETURNING coins, battles_won, battles_lost',
+        (delta, int(outcome == 'win'), int(outcome == 'lose'), user_id, stake)
+    ).fetchall()
+
+    if not rows:
+        current = connection.execute(
+            'SELECT coins, battles_won, battles_lost FROM users WHERE user_id = ?', (user_id,)
+        ).fetchone() or (0, 0, 0)
+        return Settlement(False, *current)
+
+    battle_log.record(user_id, None, battle_type, stake, battle_winner(user_id, outcome), delta)
+    return Settlement(True, *rows[0])
+
+
+# Player vs player: stakes are held in escrow while a player waits in the
+# matchmaking queue, so a match can always be paid out without re-checking
+# balances. An escrow row exists exactly until its ticket is paid out or
+# refunded, which makes both operations safe to retry.
+PvpResult = namedtuple('PvpResult', 'ticket_id user_id opponent_id game stake outcome rating_change')
+
+
+def create_pvp_schema(connection):
+    columns = {row[1] for row in connection.execute('PRAGMA table_info(users)')}
+    if 'rating' not in columns:
+        connection.execute('ALTER TABLE users ADD COLUMN rating INTEGER DEFAULT 1000')
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS pvp_escrow (
+            ticket_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            game TEXT NOT NULL,
+            stake INTEGER NOT NULL,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Decided cross-shard matches whose payouts may not have landed on every shard yet
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS pvp_matches (
+            match_id INTEGER PRIMARY KEY,
+            results TEXT NOT NULL
+        )
+    ''')
+
+
+def hold_stake(connection, ticket_id, user_id, game, stake):
+    """Move a stake from the player's balance into escrow."""
+    rows = connection.execute(
+        'UPDATE users SET coins = coins - ? WHERE user_id = ? AND coins >= ? '
+        'RETURNING coins, battles_won, battles_lost',
+        (stake, user_id, stake)
+    ).fetchall()
+    if not rows:
+        current = connection.execute(
+            'SELECT coins, battles_won, battles_lost FROM users WHERE user_id = ?', (user_id,)
+        ).fetchone() or (0, 0, 0)
+        return Settlement(False, *current)
+    connection.execute(
+        'INSERT INTO pvp_escrow (ticket_id, user_id, game, stake) VALUES (?, ?, ?, ?)',
+        (ticket_id, user_id, game, stake)
+    )
+    return Settlement(True, *rows[0])
+
+
+def release_stake(connection, ticket_id):
+    """Refund an escrowed stake; None if it was already paid out or refunded."""
+    held = connection.execute(
+        'DELETE FROM pvp_escrow WHERE ticket_id = ? RETURNING user_id, stake', (ticket_id,)
+    ).fetchall()
+    if not held:
+        return None
+    user_id, stake = held[0]
+    rows = connection.execute(
+        'UPDATE users SET coins = coins + ? WHERE user_id = ? RETURNING coins, battles_won, battles_lost',
+        (stake, user_id)
+    ).fetchall()
+    return (user_id, Settlement(True, *rows[0])) if rows else None
+
+
+def release_all_stakes(connection):
+    """Refund every escrow row, for tickets lost with the in-memory queues on restart."""
+    tickets = [ticket_id for ticket_id, in connection.execute('SELECT ticket_id FROM pvp_escrow').fetchall()]
+    released = (release_stake(connection, ticket_id) for ticket_id in tickets)
+    return [refund for refund in released if refund]
+
+
+def settle_pvp(connection, battle_log, results):
+    """Pay out the players of a decided match that live on this shard.
+
+    A win pays back twice the stake, a tie refunds it and a loss pays
+    nothing; rating changes are added to the stored rating, so a player who
+    queued again before this match was settled keeps both updates. Results
+    whose escrow row is already gone were settled before and are skipped.
+    Returns {user_id: (coins, battles_won, battles_lost, rating)}.
+    """
+    settled = {}
+    for result in results:
+        result = PvpResult(*result)
+        held = connection.execute('DELETE FROM pvp_escrow WHERE ticket_id = ?', (result.ticket_id,)).rowcount
+        if not held:
+            continue
+        rows = connection.execute(
+            'UPDATE users SET coins = coins + ?, '
+            'battles_won = battles_won + ?, battles_lost = battles_lost + ?, rating = rating + ? '
+            'WHERE user_id = ? RETURNING coins, battles_won, battles_lost, rating',
+            (result.stake * (1 + result.outcome), int(result.outcome == games.WIN),
+             int(result.outcome == games.LOSE), result.rating_change, result.user_id)
+        ).fetchall()
+        if not rows:
+            continue
+        winner = {games.WIN: result.user_id, games.LOSE: result.opponent_id}.get(result.outcome)
+        battle_log.record(result.user_id, result.opponent_id, f'pvp_{result.game}', result.stake,
+                          winner, games.net_change(result.stake, result.outcome))
+        settled[result.user_id] = rows[0]
+    return settled
+
+
+def record_match(connection, match_id, results):
+    connection.execute(
+        'INSERT INTO pvp_matches (match_id, results) VALUES (?, ?)', (match_id, json.dumps(results))
+    )
+
+
+def finish_match(connection, match_id):
+    connection.execute('DELETE FROM pvp_matches WHERE match_id = ?', (match_id,))
+
+
+def unfinished_matches(connection):
+    return [(match_id, [PvpResult(*result) for result in json.loads(results)])
+            for match_id, results in connection.execute('SELECT match_id, results FROM pvp_matches')]
+
+
+def settle_team_battle(connection, battle_log, results):
+    """Pay the rewards of a closed team battle to this shard's players in one batch.
+
+    results are (user_id, reward, outcome) with outcome 'win', 'lose' or
+    'tie'. Returns [(user_id, coins, battles_won, battles_lost)].
+    """
+    connection.executemany(
+        'UPDATE users SET coins = coins + ?, battles_won = battles_won + ?, battles_lost = battles_lost + ? '
+        'WHERE user_id = ?',
+        [(reward, int(outcome == 'win'), int(outcome == 'lose'), user_id) for user_id, reward, outcome in results]
+    )
+    for user_id, reward, outcome in results:
+        battle_log.record(user_id, None, 'team', 0, battle_winner(user_id, outcome), reward)
+    return connection.execute(
+        'SELECT user_id, coins, battles_won, battles_lost FROM users '
+        'WHERE user_id IN (SELECT value FROM json_each(?))',
+        (json.dumps([user_id for user_id, _, _ in results]),)
+    ).fetchall()
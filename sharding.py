@@ -0,0 +1,75 @@
+import heapq
+import os
+from itertools import islice
+
+# Per-player tables and the column that decides which shard a row lives on.
+# Every other table is global and lives on shard 0.
+SHARD_KEYS = {
+    'users': 'user_id',
+    'battles': 'player1_id',
+    'pvp_escrow': 'user_id',
+    'tournament_entries': 'user_id',
+    'missions': 'user_id',
+    'achievements': 'user_id',
+    'achievement_state': 'user_id',
+    'casino_spins': 'user_id',
+    'inventory': 'user_id',
+}
+
+_MASK = (1 << 64) - 1
+
+
+def shard_index(user_id, count):
+    """Shard holding a player's rows.
+
+    Fibonacci hashing spreads sequential Telegram ids evenly; the result
+    only depends on the id and the shard count, so every process agrees.
+    """
+    if count == 1:
+        return 0
+    return (((user_id * 0x9E3779B97F4A7C15) & _MASK) >> 32) % count
+
+
+def shard_paths(path, count):
+    """File names of a shard set: game_bot.db, or game_bot.shard0-of-4.db ... when sharded.
+
+    The count is part of the name so sets of different sizes never share files.
+    """
+    if count == 1:
+        return [path]
+    base, ext = os.path.splitext(path)
+    return [f'{base}.shard{i}-of-{count}{ext or ".db"}' for i in range(count)]
+
+
+def stamp_layout(connection, index, count):
+    """Record which shard a file is, and refuse to open it as a different one.
+
+    Opening a 4-shard set with SHARD_COUNT=2 would route players to the
+    wrong files and silently create duplicates, so this raises instead.
+    """
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS shard_layout (shard_index INTEGER NOT NULL, shard_count INTEGER NOT NULL)'
+    )
+    if not check_layout(connection, index, count):
+        connection.execute('INSERT INTO shard_layout VALUES (?, ?)', (index, count))
+
+
+def check_layout(connection, index, count):
+    """True if the file is stamped as this shard, False if it isn't stamped yet."""
+    exists = connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'shard_layout'"
+    ).fetchone()
+    row = connection.execute('SELECT shard_index, shard_count FROM shard_layout').fetchone() if exists else None
+    if row is None:
+        return False
+    if tuple(row) != (index, count):
+        raise ValueError(
+            f"Database file is shard {row[0]} of {row[1]}, expected shard {index} of {count}; "
+            f"run reshard.py to change the shard count"
+        )
+    return True
+
+
+def merge_top(results, key, limit):
+    """K-way merge of per-shard result lists that are each already sorted by `key`."""
+    return list(islice(heapq.merge(*results, key=key), limit))
@@ -0,0 +1,106 @@
+"""Shop catalogue and player inventories.
+
+The catalogue is fixed at import and exposed through read-only mappings,
+so screens and keyboards built from it can be cached for the life of the
+process. Inventories are one row per (player, item) in a WITHOUT ROWID
+table keyed on both: the primary key is the table, so listing a player's
+items is a single range read of that key.
+"""
+import json
+from collections import namedtuple
+from types import MappingProxyType
+
+# Items costing neither coins nor gems are not for sale, only granted as rewards
+Item = namedtuple('Item', 'item_id key title description coins gems')
+
+CATALOGUE = (
+    Item(1, 'potion', '🧪 Focus Potion', "A samurai's brew before battle", 50, 0),
+    Item(2, 'katana', '🗡️ Katana', 'Folded a thousand times', 500, 0),
+    Item(3, 'armor', '🥋 Lacquered Armor', 'Worn by the honored few', 1500, 0),
+    Item(4, 'banner', '🎏 Clan Banner', 'Shows your colors in every duel', 0, 5),
+    Item(5, 'scroll', '🐉 Dragon Scroll', 'Secrets of the ancient masters', 0, 25),
+    Item(6, 'crown', '👑 Shogun Crown', 'Only awarded at special events', 0, 0),
+)
+ITEMS = MappingProxyType({item.key: item for item in CATALOGUE})
+ITEMS_BY_ID = MappingProxyType({item.item_id: item for item in CATALOGUE})
+FOR_SALE = tuple(item for item in CATALOGUE if item.coins or item.gems)
+
+QUANTITIES = (1, 5)
+
+# Result of a purchase: ok is False when the player couldn't afford it, in
+# which case nothing was written and the balances are the current ones.
+Purchase = namedtuple('Purchase', 'ok coins gems battles_won')
+
+
+def price_label(item, quantity=1):
+    if item.gems:
+        return f"{item.gems * quantity} 💎"
+    return f"{item.coins * quantity} 🪙"
+
+
+def create_schema(connection):
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS inventory (
+            user_id INTEGER NOT NULL,
+            item_id INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, item_id)
+        ) WITHOUT ROWID
+    ''')
+
+
+def inventory(connection, user_id):
+    """[(item_id, count)] a player owns."""
+    return connection.execute(
+        'SELECT item_id, count FROM inventory WHERE user_id = ? AND count > 0', (user_id,)
+    ).fetchall()
+
+
+def buy(connection, user_id, item, quantity):
+    """Storage write job: debit the price and add the items in one transaction.
+
+    The balance check and the debit of both currencies are one conditional
+    UPDATE. Returns a Purchase.
+    """
+    coins, gems = item.coins * quantity, item.gems * quantity
+    row = connection.execute(
+        'UPDATE users SET coins = coins - ?, gems = gems - ? '
+        'WHERE user_id = ? AND coins >= ? AND gems >= ? RETURNING coins, gems, battles_won',
+        (coins, gems, user_id, coins, gems)
+    ).fetchone()
+    if row is None:
+        row = connection.execute(
+            'SELECT coins, gems, battles_won FROM users WHERE user_id = ?', (user_id,)
+        ).fetchone() or (0, 0, 0)
+        return Purchase(False, *row)
+    connection.execute(
+        'INSERT INTO inventory (user_id, item_id, count) VALUES (?, ?, ?) '
+        'ON CONFLICT (user_id, item_id) DO UPDATE SET count = count + excluded.count',
+        (user_id, item.item_id, quantity)
+    )
+    return Purchase(True, *row)
+
+
+def grant(connection, user_ids, item=None, count=0, gems=0):
+    """Storage write job: give an item and/or gems to many players at once.
+
+    Both are single set-based statements over the id list, so granting to
+    thousands of players is one transaction with two statements. Players
+    not on this shard are skipped. Returns [(user_id, coins, gems,
+    battles_won)] of the players whose gems changed.
+    """
+    ids = json.dumps(list(user_ids))
+    if item is not None and count:
+        connection.execute(
+            'INSERT INTO inventory (user_id, item_id, count) '
+            'SELECT user_id, ?, ? FROM users WHERE user_id IN (SELECT value FROM json_each(?)) '
+            'ON CONFLICT (user_id, item_id) DO UPDATE SET count = count + excluded.count',
+            (item.item_id, count, ids)
+        )
+    if not gems:
+        return []
+    return connection.execute(
+        'UPDATE users SET gems = gems + ? WHERE user_id IN (SELECT value FROM json_each(?)) '
+        'RETURNING user_id, coins, gems, battles_won',
+        (gems, ids)
+    ).fetchall()
@@ -0,0 +1,271 @@
+"""Monte Carlo economy simulator for the battle games.
+
+Usage:
+    python simulate.py --players 200000 --days 30 --battles-per-day 20 --output economy.json
+    python simulate.py --db game_bot.db --shards 1 --days 7
+
+Plays every battle of a simulated player population against the house
+with the exact rules of games.py, vectorized with NumPy: each round, every
+player with battles left that day plays one, so balances evolve battle by
+battle the way they do in the bot (stats combat depends on the current
+balance). Bets the balance can't cover are refused, like settlement does.
+
+Reports the player EV per coin wagered (the house edge is its negative)
+by game, bet size and balance band, and the total coin supply at the end
+of every simulated day. Starting balances come from a lognormal
+population or, with --db, from the players of a real database.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import games
+import sharding
+
+GAMES = ('rps', 'dice', 'stats')
+RPS, DICE, STATS = range(len(GAMES))
+
+# Balance bands (coins before the battle) for the EV breakdown
+BALANCE_BANDS = (0, 100, 250, 500, 1000, 2500, 5000, 10_000)
+
+BETS = np.array(games.BET_AMOUNTS, dtype=np.int64)
+
+
+class Tally:
+    """Battles, stakes and net player result per (game, bet, balance band) cell."""
+
+    def __init__(self):
+        self.shape = (len(GAMES), len(BETS), len(BALANCE_BANDS))
+        size = int(np.prod(self.shape))
+        self.battles = np.zeros(size, dtype=np.int64)
+        self.wagered = np.zeros(size, dtype=np.int64)
+        self.net = np.zeros(size, dtype=np.int64)
+        self.refused = 0
+
+    def add(self, game, bet_index, balance, stake, net):
+        band = np.searchsorted(BALANCE_BANDS, balance, side='right') - 1
+        cell = np.ravel_multi_index((game, bet_index, band), self.shape)
+        size = len(self.battles)
+        self.battles += np.bincount(cell, minlength=size)
+        self.wagered += np.bincount(cell, weights=stake, minlength=size).astype(np.int64)
+        self.net += np.bincount(cell, weights=net, minlength=size).astype(np.int64)
+
+    def summary(self, axes):
+        """EV rows grouped by the named axes ('game', 'bet', 'band')."""
+        names = ('game', 'bet', 'band')
+        drop = tuple(i for i, name in enumerate(names) if name not in axes)
+        battles = self.battles.reshape(self.shape).sum(axis=drop)
+        wagered = self.wagered.reshape(self.shape).sum(axis=drop)
+        net = self.net.reshape(self.shape).sum(axis=drop)
+        labels = {
+            'game': GAMES,
+            'bet': [str(bet) for bet in BETS],
+            'band': [band_label(i) for i in range(len(BALANCE_BANDS))],
+        }
+        rows = []
+        for index in np.ndindex(battles.shape):
+            if not battles[index]:
+                continue
+            key = [labels[name][i] for name, i in zip((n for n in names if n in axes), index)]
+            rows.append({
+                **dict(zip((n for n in names if n in axes), key)),
+                'battles': int(battles[index]),
+                'wagered': int(wagered[index]),
+                'net': int(net[index]),
+                'ev_per_coin': net[index] / wagered[index] if wagered[index] else 0.0,
+            })
+        return rows
+
+
+def band_label(i):
+    low = BALANCE_BANDS[i]
+    if i + 1 == len(BALANCE_BANDS):
+        return f"{low}+"
+    return f"{low}-{BALANCE_BANDS[i + 1] - 1}"
+
+
+def play_round(rng, coins, levels, active, game_weights, bet_weights, tally):
+    """One battle for every active player; updates coins in place."""
+    count = len(active)
+    balance = coins[active]
+    game = rng.choice(len(GAMES), size=count, p=game_weights)
+    bet_index = rng.choice(len(BETS), size=count, p=bet_weights)
+    stake = BETS[bet_index]
+
+    accepted = balance >= stake
+    tally.refused += count - int(accepted.sum())
+    active, balance, game, bet_index, stake = (
+        active[accepted], balance[accepted], game[accepted], bet_index[accepted], stake[accepted]
+    )
+
+    outcome = np.empty(len(active), dtype=np.int64)
+    mask = game == RPS
+    size = int(mask.sum())
+    outcome[mask] = games.rps_outcome(rng.integers(0, 3, size), rng.integers(0, 3, size))
+    mask = game == DICE
+    size = int(mask.sum())
+    outcome[mask] = games.dice_outcome(
+        rng.integers(1, games.DICE_SIDES + 1, size), rng.integers(1, games.DICE_SIDES + 1, size)
+    )
+    mask = game == STATS
+    low, high = games.STATS_OPPONENT_POWER
+    outcome[mask] = games.stats_outcome(
+        games.combat_power(balance[mask], levels[active[mask]]),
+        rng.integers(low, high + 1, int(mask.sum()))
+    )
+
+    net = games.net_change(stake, outcome)
+    coins[active] += net
+    tally.add(game, bet_index, balance, stake, net)
+    return len(active)
+
+
+def simulate(coins, levels, days, battles_per_day, game_weights, bet_weights, seed):
+    rng = np.random.default_rng(seed)
+    coins = coins.astype(np.int64).copy()
+    levels = levels.astype(np.int64)
+    tally = Tally()
+    supply = [{'day': 0, 'coins': int(coins.sum()), 'median': float(np.median(coins)),
+               'broke': int((coins < games.MIN_BET).sum())}]
+    played = 0
+    for day in range(1, days + 1):
+        # Each player's battle count for the day, then one round per battle slot
+        planned = rng.poisson(battles_per_day, len(coins))
+        order = np.argsort(planned)[::-1]
+        ranked = planned[order]
+        for slot in range(int(ranked[0]) if len(ranked) else 0):
+            active = order[:np.searchsorted(-ranked, -slot, side='left')]
+            played += play_round(rng, coins, levels, active, game_weights, bet_weights, tally)
+        supply.append({'day': day, 'coins': int(coins.sum()), 'median': float(np.median(coins)),
+                       'broke': int((coins < games.MIN_BET).sum())})
+    return coins, tally, supply, played
+
+
+def lognormal_population(rng, players, median_coins, sigma):
+    coins = np.maximum(0, rng.lognormal(np.log(median_coins), sigma, players)).astype(np.int64)
+    levels = rng.integers(1, 31, players)
+    return coins, levels
+
+
+def database_population(path, shards):
+    import sqlite3
+
+    from population import PopulationSnapshot
+
+    parts = []
+    for shard_path in sharding.shard_paths(path, shards):
+        connection = sqlite3.connect(f'file:{shard_path}?mode=ro', uri=True)
+        try:
+            parts.append(PopulationSnapshot.select_columns(connection))
+        finally:
+            connection.close()
+    columns = np.concatenate(parts)
+    return columns[:, 0], columns[:, 1]
+
+
+def weights(text, count, name):
+    try:
+        values = [float(value) for value in text.split(',')]
+    except ValueError:
+        values = []
+    if len(values) != count or min(values) < 0 or not sum(values):
+        raise argparse.ArgumentTypeError(f"--{name} needs {count} non-negative weights")
+    values = np.array(values)
+    return values / values.sum()
+
+
+def print_report(report):
+    config, totals = report['config'], report['totals']
+    print(f"Simulated {totals['battles']:,} battles for {config['players']:,} players over {config['days']} days "
+          f"in {totals['elapsed_seconds']:.1f}s ({totals['battles_per_second'] / 1e6:.1f}M battles/s), "
+          f"{totals['refused']:,} bets refused")
+    print("\nEV per coin wagered (player view; house edge is the negative)")
+    for section, rows in (('game', report['by_game']), ('game x bet', report['by_game_bet']),
+                          ('game x balance', report['by_game_band'])):
+        print(f"  by {section}:")
+        for row in rows:
+            label = ' '.join(str(row[key]) for key in ('game', 'bet', 'band') if key in row)
+            print(f"    {label:<20} {row['ev_per_coin']:+8.4f}  ({row['battles']:,} battles)")
+    print("\nCoin supply")
+    start = report['supply'][0]['coins'] or 1
+    for day in report['supply']:
+        print(f"  day {day['day']:>3}: {day['coins']:>14,} ({100 * (day['coins'] - start) / start:+7.2f}%), "
+              f"median {day['median']:,.0f}, broke {day['broke']:,}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--players', type=int, default=200_000, help='simulated players (ignored with --db)')
+    parser.add_argument('--median-coins', type=float, default=300, help='median starting balance')
+    parser.add_argument('--sigma', type=float, default=1.0, help='spread of the lognormal starting balances')
+    parser.add_argument('--db', help='start from the players of this DB_PATH instead')
+    parser.add_argument('--shards', type=int, default=1, help='SHARD_COUNT of --db')
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--battles-per-day', type=float, default=20, help='mean battles per player per day')
+    parser.add_argument('--games', default='1,1,1', help='weights of rps,dice,stats')
+    parser.add_argument('--bets', default=','.join('1' for _ in BETS),
+                        help=f"weights of the bet sizes {','.join(map(str, BETS))}")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='also write the report as JSON')
+    args = parser.parse_args(argv)
+    try:
+        args.game_weights = weights(args.games, len(GAMES), 'games')
+        args.bet_weights = weights(args.bets, len(BETS), 'bets')
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.db:
+        missing = [path for path in sharding.shard_paths(args.db, args.shards) if not os.path.exists(path)]
+        if missing:
+            print(f"No database at {', '.join(missing)}", file=sys.stderr)
+            return 1
+        coins, levels = database_population(args.db, args.shards)
+    else:
+        coins, levels = lognormal_population(np.random.default_rng(args.seed), args.players,
+                                             args.median_coins, args.sigma)
+
+    start = time.perf_counter()
+    final, tally, supply, played = simulate(
+        coins, levels, args.days, args.battles_per_day, args.game_weights, args.bet_weights, args.seed
+    )
+    elapsed = time.perf_counter() - start
+
+    report = {
+        'config': {
+            'players': len(coins),
+            'days': args.days,
+            'battles_per_day': args.battles_per_day,
+            'games': dict(zip(GAMES, args.game_weights.tolist())),
+            'bets': dict(zip(map(str, BETS), args.bet_weights.tolist())),
+            'source': args.db or f"lognormal(median={args.median_coins}, sigma={args.sigma})",
+            'seed': args.seed,
+        },
+        'totals': {
+            'battles': played,
+            'refused': tally.refused,
+            'elapsed_seconds': elapsed,
+            'battles_per_second': played / elapsed if elapsed else 0.0,
+        },
+        'by_game': tally.summary(('game',)),
+        'by_game_bet': tally.summary(('game', 'bet')),
+        'by_game_band': tally.summary(('game', 'band')),
+        'supply': supply,
+    }
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+        print(f"\nReport written to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
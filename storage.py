@@ -0,0 +1,276 @@
+import asyncio
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DB_QUEUE_WAIT = metrics.histogram(
+    'db_queue_wait_seconds', 'Time a storage job waited for a worker thread', ['database', 'kind']
+)
+DB_JOB_SECONDS = metrics.histogram(
+    'db_job_seconds', 'Time spent running one storage job', ['database', 'kind', 'job']
+)
+DB_ROWS = metrics.counter(
+    'db_rows_total', 'Rows returned by reads and changed by writes', ['database', 'kind', 'job']
+)
+DB_JOB_ERRORS = metrics.counter(
+    'db_job_errors_total', 'Storage jobs that raised', ['database', 'kind', 'job']
+)
+DB_COMMITS = metrics.counter('db_commits_total', 'Group commits', ['database'])
+DB_COMMIT_SECONDS = metrics.histogram('db_commit_seconds', 'Duration of COMMIT', ['database'])
+DB_GROUP_SIZE = metrics.histogram(
+    'db_group_commit_jobs', 'Write jobs per group commit', ['database'],
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+)
+
+# Sentinel pushed onto the job queues to stop the worker threads
+_STOP = object()
+
+
+class Storage:
+    """SQLite access off the event loop.
+
+    Writes go through one writer thread that owns the only read-write
+    connection, reads are spread over a small pool of read-only connections.
+    The database runs in WAL mode so readers never block the writer.
+    Every job is a plain function ``fn(connection, *args)`` executed in a
+    worker thread; the coroutine API awaits its result as a future.
+
+    Write jobs are group committed: the writer collects whatever arrives
+    within ``commit_interval`` seconds (up to ``max_batch`` jobs), runs each
+    one inside its own savepoint and commits the whole group once. A failing
+    job only rolls back its own savepoint. Flush hooks registered with
+    add_flush_hook() run right before each COMMIT, letting jobs buffer rows
+    that are written in bulk as part of the same transaction. A hook's mark
+    callback is read before each job, and when the job fails its discard
+    callback is passed that mark to drop what the job buffered; without a
+    mark, discard drops the whole buffer when the group is rolled back.
+    """
+
+    def __init__(self, path, readers=4, timeout=10, schema=None,
+                 commit_interval=0.002, max_batch=256):
+        self.path = path
+        self.timeout = timeout
+        self.commit_interval = commit_interval
+        self.max_batch = max_batch
+        self.commits = 0
+        self.name = os.path.basename(path)
+        self._statement_counts = []
+        self._write_jobs = queue.Queue()
+        self._read_jobs = queue.Queue()
+        self._flush_hooks = []
+        self._threads = []
+
+        # The writer manages its own transactions (BEGIN/SAVEPOINT/COMMIT)
+        self._writer = self._connect()
+        self._writer.isolation_level = None
+        self._writer.execute('PRAGMA journal_mode=WAL')
+        self._writer.execute('PRAGMA synchronous=NORMAL')
+        if schema:
+            self._writer.execute('BEGIN')
+            schema(self._writer)
+            self._writer.execute('COMMIT')
+
+        self._readers = [self._connect(readonly=True) for _ in range(readers)]
+        self._start(self._write_loop, 'db-writer')
+        for i, connection in enumerate(self._readers):
+            self._start(self._read_loop, f'db-reader-{i}', connection)
+
+    def _connect(self, readonly=False):
+        if readonly:
+            return sqlite3.connect(
+                f'file:{self.path}?mode=ro', uri=True,
+                check_same_thread=False, timeout=self.timeout
+            )
+        return sqlite3.connect(self.path, check_same_thread=False, timeout=self.timeout)
+
+    def _start(self, target, name, *args):
+        thread = threading.Thread(target=target, name=name, args=args, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    # Worker threads
+    def _write_loop(self):
+        connection = self._writer
+        stopping = False
+        while not stopping:
+            job = self._write_jobs.get()
+            if job is _STOP:
+                break
+            batch = [job]
+            deadline = time.monotonic() + self.commit_interval
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        job = self._write_jobs.get(timeout=remaining)
+                    else:
+                        job = self._write_jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is _STOP:
+                    stopping = True
+                    break
+                batch.append(job)
+            self._run_batch(connection, batch)
+        connection.close()
+
+    def _run_batch(self, connection, batch):
+        outcomes = []
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            for future, fn, args, queued in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                started = time.perf_counter()
+                DB_QUEUE_WAIT.observe(started - queued, (self.name, 'write'))
+                changes = connection.total_changes
+                marks = [mark() if mark else None for _, _, mark in self._flush_hooks]
+                connection.execute('SAVEPOINT job')
+                try:
+                    result = fn(connection, *args)
+                except Exception as e:
+                    connection.execute('ROLLBACK TO job')
+                    connection.execute('RELEASE job')
+                    for (_, discard, _), position in zip(self._flush_hooks, marks):
+                        if position is not None:
+                            discard(position)
+                    DB_JOB_ERRORS.inc(1, (self.name, 'write', fn.__name__))
+                    outcomes.append((future, e, False))
+                else:
+                    connection.execute('RELEASE job')
+                    outcomes.append((future, result, True))
+                labels = (self.name, 'write', fn.__name__)
+                DB_JOB_SECONDS.observe(time.perf_counter() - started, labels)
+                DB_ROWS.inc(connection.total_changes - changes, labels)
+            for flush, _, _ in self._flush_hooks:
+                flush(connection)
+            committing = time.perf_counter()
+            connection.execute('COMMIT')
+            DB_COMMIT_SECONDS.observe(time.perf_counter() - committing, (self.name,))
+            DB_COMMITS.inc(1, (self.name,))
+            DB_GROUP_SIZE.observe(len(batch), (self.name,))
+            self.commits += 1
+        except Exception as e:
+            # The group as a whole failed (lock timeout, disk error...)
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            for _, discard, _ in self._flush_hooks:
+                if discard:
+                    discard()
+            logger.error(f"Group commit of {len(batch)} jobs failed: {e}")
+            for future, fn, args, queued in batch:
+                if future.running() or future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+            return
+
+        for future, value, ok in outcomes:
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def _read_loop(self, connection):
+        while True:
+            job = self._read_jobs.get()
+            if job is _STOP:
+                break
+            future, fn, args, queued = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            started = time.perf_counter()
+            DB_QUEUE_WAIT.observe(started - queued, (self.name, 'read'))
+            labels = (self.name, 'read', fn.__name__)
+            try:
+                result = fn(connection, *args)
+            except BaseException as e:
+                DB_JOB_ERRORS.inc(1, labels)
+                future.set_exception(e)
+            else:
+                DB_ROWS.inc(_row_count(result), labels)
+                future.set_result(result)
+            DB_JOB_SECONDS.observe(time.perf_counter() - started, labels)
+        connection.close()
+
+    def count_statements(self):
+        """Count every SQL statement run from now on, on all connections.
+
+        Meant for benchmarks: the trace callback costs a Python call per
+        statement, so it is off unless asked for.
+        """
+        if self._statement_counts:
+            return
+        for connection in [self._writer] + self._readers:
+            counter = [0]
+            self._statement_counts.append(counter)
+            connection.set_trace_callback(lambda sql, counter=counter: counter.__setitem__(0, counter[0] + 1))
+
+    @property
+    def statements(self):
+        return sum(counter[0] for counter in self._statement_counts)
+
+    def add_flush_hook(self, flush, discard=None, mark=None):
+        # Only call before jobs that rely on the hook are submitted
+        self._flush_hooks.append((flush, discard, mark))
+
+    # Job submission
+    def submit_write(self, fn, *args):
+        future = Future()
+        self._write_jobs.put((future, fn, args, time.perf_counter()))
+        return future
+
+    def submit_read(self, fn, *args):
+        future = Future()
+        self._read_jobs.put((future, fn, args, time.perf_counter()))
+        return future
+
+    async def write(self, fn, *args):
+        return await asyncio.wrap_future(self.submit_write(fn, *args))
+
+    async def read(self, fn, *args):
+        return await asyncio.wrap_future(self.submit_read(fn, *args))
+
+    # Shortcuts for single statements
+    async def execute(self, sql, params=()):
+        return await self.write(_execute, sql, params)
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(_fetchone, sql, params)
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(_fetchall, sql, params)
+
+    def close(self):
+        for thread in self._threads:
+            if thread.name == 'db-writer':
+                self._write_jobs.put(_STOP)
+            else:
+                self._read_jobs.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+def _row_count(result):
+    if isinstance(result, list):
+        return len(result)
+    return 0 if result is None else 1
+
+
+def _execute(connection, sql, params):
+    return connection.execute(sql, params).rowcount
+
+
+def _fetchone(connection, sql, params):
+    return connection.execute(sql, params).fetchone()
+
+
+def _fetchall(connection, sql, params):
+    return connection.execute(sql, params).fetchall()
@@ -0,0 +1,157 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+RED, BLUE = 0, 1
+TEAMS = ('🔴 Red', '🔵 Blue')
+
+
+class TeamBattle:
+    """One team battle in a group chat, aggregated in memory.
+
+    A contribution only bumps the team total and the player's own counters
+    and bumps `version`; nothing is written until the battle closes, and
+    the scoreboard is redrawn from these counters at most once per refresh
+    interval however many contributions arrive in between.
+    """
+
+    def __init__(self, battle_id, chat_id, ends_at, cooldown, bot=None):
+        self.battle_id = battle_id
+        self.chat_id = chat_id
+        self.ends_at = ends_at
+        self.cooldown = cooldown
+        self.bot = bot
+        self.message_id = None
+        self.scores = [0, 0]
+        self.members = [0, 0]
+        self.actions = 0
+        self.version = 0
+        self.closed = False
+        # user_id -> [team, actions, damage, last action, username]
+        self.players = {}
+
+    def __len__(self):
+        return len(self.players)
+
+    def team_of(self, user_id):
+        player = self.players.get(user_id)
+        return player[0] if player else None
+
+    def join(self, user_id, username, team):
+        """Put a player on a team; players stay on the first team they picked."""
+        player = self.players.get(user_id)
+        if player is None:
+            self.players[user_id] = [team, 0, 0, 0.0, username]
+            self.members[team] += 1
+            self.version += 1
+            return team
+        return player[0]
+
+    def contribute(self, user_id, damage, now=None):
+        """Add an attack for a player who joined; returns False while on cooldown or closed."""
+        now = time.monotonic() if now is None else now
+        player = self.players.get(user_id)
+        if player is None or self.closed or now - player[3] < self.cooldown:
+            return False
+        player[1] += 1
+        player[2] += damage
+        player[3] = now
+        self.scores[player[0]] += damage
+        self.actions += 1
+        self.version += 1
+        return True
+
+    def winner(self):
+        if self.scores[RED] == self.scores[BLUE]:
+            return None
+        return RED if self.scores[RED] > self.scores[BLUE] else BLUE
+
+    def top(self, limit=3):
+        """(user_id, username, team, damage) of the biggest hitters."""
+        best = heapq.nlargest(limit, self.players.items(), key=lambda item: item[1][2])
+        return [(user_id, player[4], player[0], player[2]) for user_id, player in best if player[2]]
+
+    def contributors(self):
+        """(user_id, team, actions, damage) of every player who attacked at least once."""
+        return [(user_id, player[0], player[1], player[2])
+                for user_id, player in self.players.items() if player[1]]
+
+
+class TeamBattles:
+    """Running team battles, one per chat.
+
+    Each battle gets a task that redraws the scoreboard through
+    on_refresh(battle) whenever it changed, at most every `refresh`
+    seconds, and calls on_close(battle) once its window is over.
+    """
+
+    def __init__(self, on_refresh, on_close, refresh=3.0, cooldown=1.0):
+        self.on_refresh = on_refresh
+        self.on_close = on_close
+        self.refresh = refresh
+        self.cooldown = cooldown
+        self.actions = 0
+        self._battles = {}
+        self._ids = itertools.count(1)
+        self._tasks = set()
+
+    def __len__(self):
+        return len(self._battles)
+
+    def get(self, chat_id, battle_id=None):
+        battle = self._battles.get(chat_id)
+        if battle is None or (battle_id is not None and battle.battle_id != battle_id):
+            return None
+        return battle
+
+    def start(self, chat_id, duration, bot=None):
+        """A new battle for the chat, or None if one is already running there."""
+        if chat_id in self._battles:
+            return None
+        battle = TeamBattle(next(self._ids), chat_id, time.monotonic() + duration, self.cooldown, bot)
+        self._battles[chat_id] = battle
+        return battle
+
+    def discard(self, battle):
+        battle.closed = True
+        if self._battles.get(battle.chat_id) is battle:
+            del self._battles[battle.chat_id]
+
+    def run(self, battle):
+        task = asyncio.create_task(self._run(battle))
+        self._tasks.add(task)
+        task.add_done_callback(self._finished)
+
+    def contribute(self, battle, user_id, damage):
+        if battle.contribute(user_id, damage):
+            self.actions += 1
+            return True
+        return False
+
+    async def _run(self, battle):
+        shown = None
+        try:
+            while True:
+                remaining = battle.ends_at - time.monotonic()
+                if remaining <= 0:
+                    break
+                await asyncio.sleep(min(self.refresh, remaining))
+                if battle.version != shown and battle.ends_at > time.monotonic():
+                    shown = battle.version
+                    try:
+                        await self.on_refresh(battle)
+                    except Exception as e:
+                        logger.warning(f"Team battle scoreboard update failed in chat {battle.chat_id}: {e}")
+        finally:
+            battle.closed = True
+            self._battles.pop(battle.chat_id, None)
+        await self.on_close(battle)
+
+    def _finished(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Team battle failed: {task.exception()}")
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# bot opens its database at import; keep it out of the working tree
+os.environ.setdefault('DB_PATH', os.path.join(tempfile.mkdtemp(), 'game_bot.db'))
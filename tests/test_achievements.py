@@ -0,0 +1,25 @@
+import asyncio
+
+import bot
+from achievements import AchievementEngine
+
+
+def test_state_cache_evicts_the_least_recently_active_player(tmp_path):
+    db = bot.Database(str(tmp_path / 'game_bot.db'))
+    engine = AchievementEngine(db, capacity=2)
+
+    async def run():
+        for user_id in (1, 2):
+            engine.emit(user_id, 'loss')
+        await engine.process()
+        # Player 1 stays active, player 2 goes idle
+        engine.emit(1, 'loss')
+        await engine.process()
+        engine.emit(3, 'loss')
+        await engine.process()
+
+    try:
+        asyncio.run(run())
+    finally:
+        db.close()
+    assert list(engine._states) == [1, 3]
@@ -0,0 +1,30 @@
+import asyncio
+
+import pytest
+
+from admission import NORMAL, URGENT, Admission, PrioritySlots, Shed
+
+
+def test_zero_queue_sheds_instead_of_waiting():
+    async def run():
+        slots = PrioritySlots(1, 0)
+        await slots.acquire(NORMAL)
+        for priority in (NORMAL, URGENT):
+            with pytest.raises(Shed) as shed:
+                await slots.acquire(priority)
+            assert shed.value.reason == 'overload'
+        slots.release()
+        await slots.acquire(URGENT)
+
+    asyncio.run(run())
+
+
+def test_zero_queue_admission_counts_the_shed_update():
+    async def run():
+        admission = Admission(rate=100, burst=100, slots=1, queue_limit=0)
+        await admission.acquire(NORMAL)
+        with pytest.raises(Shed):
+            await admission.acquire(NORMAL)
+        return admission.shed
+
+    assert asyncio.run(run()) == 1
@@ -0,0 +1,31 @@
+import asyncio
+
+import bot
+import sharding
+from leaderboard import Leaderboard
+
+
+def test_leaderboard_loads_players_from_every_shard(tmp_path, monkeypatch):
+    db = bot.Database(str(tmp_path / 'game_bot.db'), shards=3)
+    monkeypatch.setattr(bot, 'db', db)
+    monkeypatch.setattr(bot, 'leaderboard', Leaderboard())
+    players = {user_id: (user_id * 37) % 1000 for user_id in range(1, 201)}
+
+    def insert(connection, rows):
+        connection.executemany('INSERT INTO users (user_id, username, coins) VALUES (?, ?, ?)', rows)
+
+    async def run():
+        for shard in db.shards:
+            rows = [(user_id, f'p{user_id}', coins) for user_id, coins in players.items()
+                    if sharding.shard_index(user_id, 3) == shard.index]
+            assert rows
+            await shard.storage.write(insert, rows)
+        return await bot.load_leaderboard()
+
+    try:
+        assert asyncio.run(run()) == len(players)
+    finally:
+        db.close()
+    expected = sorted(players, key=lambda user_id: (-players[user_id], user_id))
+    assert [row[0] for row in bot.leaderboard.top(len(players))] == expected
+    assert bot.leaderboard.rank(expected[0]) == 1
@@ -0,0 +1,17 @@
+import metrics
+
+
+def test_summary_reports_the_interval_quantiles():
+    histogram = metrics.Histogram('test_seconds', 'Test latency')
+    sections = {'test': histogram}
+    previous = {'test': histogram.bucket_counts()}
+
+    for _ in range(10_000):
+        histogram.observe(0.002)
+    assert metrics.summary_line(sections, previous) == "Metrics | test: 10000 obs, p50<=2.5ms p99<=2.5ms"
+
+    for _ in range(100):
+        histogram.observe(2.0)
+    assert metrics.summary_line(sections, previous) == "Metrics | test: 100 obs, p50<=2500ms p99<=2500ms"
+
+    assert metrics.summary_line(sections, previous) == "Metrics | test: 0 obs, p50/p99 n/a"
@@ -0,0 +1,76 @@
+import sqlite3
+
+import casino
+import reshard
+import sharding
+import shop
+
+PLAYERS = range(1, 301)
+
+
+def create_shard(path, index, count):
+    connection = sqlite3.connect(path, isolation_level=None)
+    connection.execute('CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT, coins INTEGER DEFAULT 100, gems INTEGER DEFAULT 0, battles_won INTEGER DEFAULT 0)')
+    connection.execute('''
+        CREATE TABLE battles (
+            battle_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            player1_id INTEGER,
+            battle_type TEXT,
+            bet_amount INTEGER
+        )
+    ''')
+    casino.create_schema(connection)
+    shop.create_schema(connection)
+    sharding.stamp_layout(connection, index, count)
+    return connection
+
+
+def seed(path, count):
+    """A shard set where every shard numbers its battles and spins from 1."""
+    connections = [create_shard(shard_path, i, count) for i, shard_path in enumerate(sharding.shard_paths(path, count))]
+    for user_id in PLAYERS:
+        connection = connections[sharding.shard_index(user_id, count)]
+        connection.execute('INSERT INTO users (user_id, username, coins) VALUES (?, ?, ?)', (user_id, f'p{user_id}', user_id * 10))
+        for bet in (10, 20, 30):
+            connection.execute('INSERT INTO battles (player1_id, battle_type, bet_amount) VALUES (?, ?, ?)',
+                               (user_id, 'quick', bet))
+        casino.spin(connection, user_id, 'flip', 'heads', 10, 0, 7, user_id)
+        shop.grant(connection, [user_id], shop.ITEMS['potion'], 1)
+    for connection in connections:
+        connection.close()
+
+
+def read_set(path, count, sql):
+    rows = []
+    for index, shard_path in enumerate(sharding.shard_paths(path, count)):
+        with sqlite3.connect(shard_path) as connection:
+            rows.extend((index, *row) for row in connection.execute(sql))
+    return rows
+
+
+def test_reshard_from_several_shards(tmp_path):
+    source = str(tmp_path / 'game_bot.db')
+    seed(source, 2)
+    battles = sorted(row[1:] for row in read_set(source, 2, 'SELECT player1_id, battle_type, bet_amount FROM battles'))
+
+    reshard.reshard(source, 2, 3)
+
+    users = read_set(source, 3, 'SELECT user_id, coins FROM users')
+    assert sorted(user_id for _, user_id, _ in users) == list(PLAYERS)
+    assert all(index == sharding.shard_index(user_id, 3) for index, user_id, _ in users)
+    assert sorted(row[1:] for row in read_set(source, 3, 'SELECT player1_id, battle_type, bet_amount FROM battles')) == battles
+    for index, player_id in read_set(source, 3, 'SELECT player1_id FROM battles'):
+        assert index == sharding.shard_index(player_id, 3)
+    assert len(read_set(source, 3, 'SELECT spin_id FROM casino_spins')) == len(PLAYERS)
+    assert len(read_set(source, 3, 'SELECT user_id FROM inventory')) == len(PLAYERS)
+
+
+def test_reshard_keeps_each_players_battle_order(tmp_path):
+    source = str(tmp_path / 'game_bot.db')
+    seed(source, 2)
+
+    reshard.reshard(source, 2, 3)
+
+    rows = read_set(source, 3, 'SELECT player1_id, bet_amount FROM battles ORDER BY battle_id')
+    for user_id in PLAYERS:
+        assert [bet for _, player_id, bet in rows if player_id == user_id] == [10, 20, 30]
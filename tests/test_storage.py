@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+from battlelog import BattleLog
+from storage import Storage
+
+
+def create_battles(connection):
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS battles (
+            battle_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            player1_id INTEGER,
+            player2_id INTEGER,
+            battle_type TEXT,
+            bet_amount INTEGER,
+            winner_id INTEGER,
+            battle_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    BattleLog.create_schema(connection)
+
+
+def test_failed_job_drops_the_battles_it_recorded(tmp_path):
+    battles = BattleLog()
+    storage = Storage(str(tmp_path / 'game_bot.db'), schema=create_battles, commit_interval=0.05)
+    storage.add_flush_hook(battles.flush, battles.discard, battles.mark)
+
+    def settle(connection, player_id, fail):
+        battles.record(player_id, None, 'quick', 10, player_id, 10)
+        if fail:
+            raise RuntimeError('settlement failed after recording')
+
+    async def run():
+        # Queued together so they share one group commit
+        return await asyncio.gather(
+            storage.write(settle, 1, False), storage.write(settle, 2, True), storage.write(settle, 3, False),
+            return_exceptions=True
+        )
+
+    try:
+        ok, failed, also_ok = asyncio.run(run())
+        assert isinstance(failed, RuntimeError) and ok is None and also_ok is None
+        rows = asyncio.run(storage.read(lambda connection: connection.execute(
+            'SELECT player1_id FROM battles ORDER BY battle_id').fetchall()))
+    finally:
+        storage.close()
+    assert [player_id for player_id, in rows] == [1, 3]
@@ -0,0 +1,489 @@
+"""Tournament brackets: registration, seeding, pairings and prize payouts.
+
+State lives on the first shard (tournaments, tournament_players,
+tournament_matches, tournament_prizes) except registrations, which are
+tournament_entries rows on the entrant's own shard, written together with
+the entry fee. Players only submit their dice roll during a round; the
+round is decided, the next one paired and the standings updated by one
+close_round() job when its deadline passes, so a restart resumes from the
+stored round without replaying anything.
+
+Prizes and refunds are recorded first and then paid per shard; an entry
+row's prize column is set when it is paid, which makes paying safe to
+repeat after a crash.
+"""
+import math
+from collections import namedtuple
+
+import games
+
+SINGLE_ELIMINATION = 'single'
+SWISS = 'swiss'
+FORMATS = {SINGLE_ELIMINATION: 'Single elimination', SWISS: 'Swiss'}
+
+# Share of the prize pool (entry fees) per final place
+PRIZE_SHARES = (50, 25, 15, 10)
+
+MIN_PLAYERS = 2
+
+Tournament = namedtuple(
+    'Tournament', 'tournament_id name format entry_fee status round rounds starts_at deadline pending players'
+)
+COLUMNS = ', '.join(Tournament._fields)
+
+
+def create_schema(connection):
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS tournaments (
+            tournament_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            format TEXT NOT NULL,
+            entry_fee INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'registration',
+            round INTEGER DEFAULT 0,
+            rounds INTEGER DEFAULT 0,
+            starts_at REAL NOT NULL,
+            deadline REAL,
+            pending INTEGER DEFAULT 0,
+            players INTEGER DEFAULT 0,
+            cancelled INTEGER DEFAULT 0,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS tournament_players (
+            tournament_id INTEGER,
+            user_id INTEGER,
+            username TEXT,
+            seed INTEGER,
+            wins INTEGER DEFAULT 0,
+            eliminated_round INTEGER,
+            byes INTEGER DEFAULT 0,
+            table_no INTEGER,
+            PRIMARY KEY (tournament_id, user_id)
+        )
+    ''')
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS tournament_matches (
+            tournament_id INTEGER,
+            round INTEGER,
+            table_no INTEGER,
+            player1_id INTEGER,
+            player2_id INTEGER,
+            roll1 INTEGER,
+            roll2 INTEGER,
+            winner_id INTEGER,
+            PRIMARY KEY (tournament_id, round, table_no)
+        )
+    ''')
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS tournament_prizes (
+            tournament_id INTEGER,
+            user_id INTEGER,
+            place INTEGER,
+            amount INTEGER,
+            PRIMARY KEY (tournament_id, user_id)
+        )
+    ''')
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS tournament_entries (
+            tournament_id INTEGER,
+            user_id INTEGER,
+            username TEXT,
+            fee INTEGER NOT NULL,
+            prize INTEGER,
+            PRIMARY KEY (tournament_id, user_id)
+        )
+    ''')
+
+
+# Brackets and pairings
+def round_count(players):
+    return max(1, math.ceil(math.log2(players)))
+
+
+def bracket_order(size):
+    """Seed numbers in bracket position order, e.g. 1, 8, 4, 5, 2, 7, 3, 6 for 8."""
+    order = [1]
+    while len(order) < size:
+        total = 2 * len(order) + 1
+        order = [seed for top in order for seed in (top, total - top)]
+    return order
+
+
+def first_round(user_ids):
+    """Single elimination round 1 for players in seed order; seeds past the field get byes."""
+    order = bracket_order(2 ** round_count(len(user_ids)))
+    players = [user_ids[seed - 1] if seed <= len(user_ids) else None for seed in order]
+    return [(players[i], players[i + 1]) for i in range(0, len(players), 2)]
+
+
+def next_round(winners):
+    """Single elimination: winners of tables 2k and 2k + 1 meet at table k."""
+    return [(winners[i], winners[i + 1]) for i in range(0, len(winners), 2)]
+
+
+def swiss_round(ranked, played, byes):
+    """Pair players ranked by standing with the next player they haven't met.
+
+    An odd field gives a bye to the lowest ranked player with the fewest
+    byes. Falls back to a rematch when every remaining player was met.
+    """
+    ranked = list(ranked)
+    pairs = []
+    if len(ranked) % 2:
+        fewest = min(byes.get(user_id, 0) for user_id in ranked)
+        bye = next(user_id for user_id in reversed(ranked) if byes.get(user_id, 0) == fewest)
+        ranked.remove(bye)
+        pairs.append((bye, None))
+    while ranked:
+        first = ranked.pop(0)
+        index = next((i for i, user_id in enumerate(ranked) if frozenset((first, user_id)) not in played), 0)
+        pairs.append((first, ranked.pop(index)))
+    # Byes go last so table numbers of real matches stay stable
+    return pairs[1:] + pairs[:1] if pairs and pairs[0][1] is None else pairs
+
+
+def decide(format, player1, player2, roll1, roll2, seeds):
+    """Winner of a match at the deadline: higher roll, then the better seed.
+
+    A player who didn't roll loses to one who did; when neither rolled, the
+    better seed advances in single elimination and nobody wins in Swiss.
+    """
+    if player2 is None:
+        return player1
+    if roll1 is None and roll2 is None:
+        return min(player1, player2, key=seeds.get) if format == SINGLE_ELIMINATION else None
+    if roll2 is None:
+        return player1
+    if roll1 is None:
+        return player2
+    outcome = games.dice_outcome(roll1, roll2)
+    if outcome == games.TIE:
+        return min(player1, player2, key=seeds.get)
+    return player1 if outcome == games.WIN else player2
+
+
+def prize_split(pool, places):
+    shares = PRIZE_SHARES[:places]
+    amounts = [pool * share // sum(shares) for share in shares]
+    if amounts:
+        amounts[0] += pool - sum(amounts)
+    return amounts
+
+
+# Storage jobs - first shard
+def create(connection, name, format, entry_fee, starts_at):
+    return connection.execute(
+        'INSERT INTO tournaments (name, format, entry_fee, starts_at) VALUES (?, ?, ?, ?) RETURNING tournament_id',
+        (name, format, entry_fee, starts_at)
+    ).fetchone()[0]
+
+
+def get(connection, tournament_id):
+    row = connection.execute(f'SELECT {COLUMNS} FROM tournaments WHERE tournament_id = ?', (tournament_id,)).fetchone()
+    return Tournament(*row) if row else None
+
+
+def latest(connection):
+    row = connection.execute(f'SELECT {COLUMNS} FROM tournaments ORDER BY tournament_id DESC LIMIT 1').fetchone()
+    return Tournament(*row) if row else None
+
+
+def active(connection):
+    """Tournaments that still need jobs scheduled: registering, running or paying out."""
+    return [Tournament(*row) for row in connection.execute(
+        f"SELECT {COLUMNS} FROM tournaments "
+        f"WHERE status IN ('registration', 'running', 'paying') ORDER BY tournament_id"
+    )]
+
+
+def start(connection, tournament_id, seeded, deadline):
+    """Seed the entrants, pair round 1 and open it; seeded is [(user_id, username)] best first."""
+    format, status = connection.execute(
+        'SELECT format, status FROM tournaments WHERE tournament_id = ?', (tournament_id,)
+    ).fetchone()
+    if status != 'registration':
+        return None
+    connection.executemany(
+        'INSERT INTO tournament_players (tournament_id, user_id, username, seed) VALUES (?, ?, ?, ?)',
+        [(tournament_id, user_id, username, seed) for seed, (user_id, username) in enumerate(seeded, 1)]
+    )
+    user_ids = [user_id for user_id, _ in seeded]
+    pairs = first_round(user_ids) if format == SINGLE_ELIMINATION else swiss_round(user_ids, set(), {})
+    pending = _open_round(connection, tournament_id, 1, pairs)
+    connection.execute(
+        "UPDATE tournaments SET status = 'running', round = 1, rounds = ?, deadline = ?, pending = ?, players = ? "
+        "WHERE tournament_id = ?",
+        (round_count(len(seeded)), deadline, pending, len(seeded), tournament_id)
+    )
+    return pairs
+
+
+def _open_round(connection, tournament_id, round_no, pairs):
+    """Insert a round's matches; byes are decided on the spot. Returns the matches left to play."""
+    connection.executemany(
+        'INSERT INTO tournament_matches (tournament_id, round, table_no, player1_id, player2_id, winner_id) '
+        'VALUES (?, ?, ?, ?, ?, ?)',
+        [(tournament_id, round_no, table_no, player1, player2, player1 if player2 is None else None)
+         for table_no, (player1, player2) in enumerate(pairs)]
+    )
+    connection.executemany(
+        'UPDATE tournament_players SET table_no = ? WHERE tournament_id = ? AND user_id = ?',
+        [(table_no, tournament_id, user_id)
+         for table_no, pair in enumerate(pairs) for user_id in pair if user_id is not None]
+    )
+    return sum(1 for _, player2 in pairs if player2 is not None)
+
+
+def current_match(connection, tournament_id, user_id):
+    """(round, player1, player2, roll1, roll2, winner_id, username1, username2) of the player's latest match."""
+    return connection.execute(
+        'SELECT m.round, m.player1_id, m.player2_id, m.roll1, m.roll2, m.winner_id, p1.username, p2.username '
+        'FROM tournament_players p '
+        'JOIN tournaments t ON t.tournament_id = p.tournament_id '
+        'JOIN tournament_matches m ON m.tournament_id = p.tournament_id AND m.round = t.round AND m.table_no = p.table_no '
+        'LEFT JOIN tournament_players p1 ON p1.tournament_id = m.tournament_id AND p1.user_id = m.player1_id '
+        'LEFT JOIN tournament_players p2 ON p2.tournament_id = m.tournament_id AND p2.user_id = m.player2_id '
+        'WHERE p.tournament_id = ? AND p.user_id = ? AND (p.eliminated_round IS NULL OR p.eliminated_round = t.round)',
+        (tournament_id, user_id)
+    ).fetchone()
+
+
+def submit_roll(connection, tournament_id, round_no, user_id, roll):
+    """Record a player's roll for the open round.
+
+    Returns (roll, matches still waiting for a roll), or None when the
+    round is closed, the player has no match in it or already rolled.
+    """
+    row = connection.execute(
+        'SELECT m.table_no, m.player1_id, m.player2_id FROM tournament_players p '
+        'JOIN tournaments t ON t.tournament_id = p.tournament_id '
+        'JOIN tournament_matches m ON m.tournament_id = p.tournament_id AND m.round = t.round AND m.table_no = p.table_no '
+        "WHERE p.tournament_id = ? AND p.user_id = ? AND t.round = ? AND t.status = 'running' "
+        'AND p.eliminated_round IS NULL AND m.player2_id IS NOT NULL',
+        (tournament_id, user_id, round_no)
+    ).fetchone()
+    if row is None:
+        return None
+    table_no, player1, player2 = row
+    column, other = ('roll1', 'roll2') if user_id == player1 else ('roll2', 'roll1')
+    rows = connection.execute(
+        f'UPDATE tournament_matches SET {column} = ? '
+        f'WHERE tournament_id = ? AND round = ? AND table_no = ? AND {column} IS NULL RETURNING {other}',
+        (roll, tournament_id, round_no, table_no)
+    ).fetchall()
+    if not rows:
+        return None
+    if rows[0][0] is None:
+        pending = connection.execute(
+            'SELECT pending FROM tournaments WHERE tournament_id = ?', (tournament_id,)
+        ).fetchone()[0]
+    else:
+        pending = connection.execute(
+            'UPDATE tournaments SET pending = pending - 1 WHERE tournament_id = ? RETURNING pending', (tournament_id,)
+        ).fetchone()[0]
+    return roll, pending
+
+
+def close_round(connection, tournament_id, round_no, deadline):
+    """Decide every match of the round in one job, then pair the next round or finish.
+
+    Returns ('round', pairs, usernames) for the new round, ('finished',
+    prizes, usernames) when the last round was closed, or None if the round
+    was already closed.
+    """
+    format, status, current, rounds, entry_fee, players = connection.execute(
+        'SELECT format, status, round, rounds, entry_fee, players FROM tournaments WHERE tournament_id = ?',
+        (tournament_id,)
+    ).fetchone()
+    if status != 'running' or current != round_no:
+        return None
+
+    standing = {
+        user_id: [seed, wins, eliminated, byes, username]
+        for user_id, seed, wins, eliminated, byes, username in connection.execute(
+            'SELECT user_id, seed, wins, eliminated_round, byes, username FROM tournament_players WHERE tournament_id = ?',
+            (tournament_id,)
+        )
+    }
+    seeds = {user_id: player[0] for user_id, player in standing.items()}
+    matches = connection.execute(
+        'SELECT table_no, player1_id, player2_id, roll1, roll2, winner_id FROM tournament_matches '
+        'WHERE tournament_id = ? AND round = ? ORDER BY table_no',
+        (tournament_id, round_no)
+    ).fetchall()
+
+    winners = []
+    decided = []
+    for table_no, player1, player2, roll1, roll2, winner in matches:
+        if winner is None:
+            winner = decide(format, player1, player2, roll1, roll2, seeds)
+            decided.append((winner, tournament_id, round_no, table_no))
+        winners.append(winner)
+        if winner is not None:
+            standing[winner][1] += 1
+        if player2 is None:
+            standing[player1][3] += 1
+        elif format == SINGLE_ELIMINATION:
+            standing[player2 if winner == player1 else player1][2] = round_no
+    connection.executemany(
+        'UPDATE tournament_matches SET winner_id = ? WHERE tournament_id = ? AND round = ? AND table_no = ?', decided
+    )
+    connection.executemany(
+        'UPDATE tournament_players SET wins = ?, eliminated_round = ?, byes = ? WHERE tournament_id = ? AND user_id = ?',
+        [(wins, eliminated, byes, tournament_id, user_id)
+         for user_id, (seed, wins, eliminated, byes, username) in standing.items()]
+    )
+    usernames = {user_id: player[4] for user_id, player in standing.items()}
+
+    if round_no < rounds:
+        if format == SINGLE_ELIMINATION:
+            pairs = next_round(winners)
+        else:
+            played = {frozenset(pair) for pair in connection.execute(
+                'SELECT player1_id, player2_id FROM tournament_matches WHERE tournament_id = ? AND player2_id IS NOT NULL',
+                (tournament_id,)
+            )}
+            ranked = sorted(standing, key=lambda user_id: (-standing[user_id][1], standing[user_id][0]))
+            pairs = swiss_round(ranked, played, {user_id: player[3] for user_id, player in standing.items()})
+        pending = _open_round(connection, tournament_id, round_no + 1, pairs)
+        connection.execute(
+            'UPDATE tournaments SET round = ?, deadline = ?, pending = ? WHERE tournament_id = ?',
+            (round_no + 1, deadline, pending, tournament_id)
+        )
+        return 'round', pairs, usernames
+
+    places = final_standings(connection, tournament_id, format, standing)
+    amounts = prize_split(entry_fee * players, min(len(places), len(PRIZE_SHARES)))
+    prizes = [(user_id, place, amount) for place, (user_id, amount) in enumerate(zip(places, amounts), 1)]
+    _record_prizes(connection, tournament_id, prizes, cancelled=False)
+    return 'finished', prizes, usernames
+
+
+def final_standings(connection, tournament_id, format, standing):
+    """User ids best first: single elimination by round reached, Swiss by wins then Buchholz."""
+    if format == SINGLE_ELIMINATION:
+        return sorted(standing, key=lambda user_id: (-(standing[user_id][2] or math.inf), standing[user_id][0]))
+    buchholz = dict.fromkeys(standing, 0)
+    for player1, player2 in connection.execute(
+        'SELECT player1_id, player2_id FROM tournament_matches WHERE tournament_id = ? AND player2_id IS NOT NULL',
+        (tournament_id,)
+    ):
+        buchholz[player1] += standing[player2][1]
+        buchholz[player2] += standing[player1][1]
+    return sorted(standing, key=lambda user_id: (-standing[user_id][1], -buchholz[user_id], standing[user_id][0]))
+
+
+def cancel(connection, tournament_id, entrants):
+    """Refund every entry fee of a tournament that didn't get enough players."""
+    status, = connection.execute('SELECT status FROM tournaments WHERE tournament_id = ?', (tournament_id,)).fetchone()
+    if status != 'registration':
+        return None
+    refunds = [(user_id, None, fee) for user_id, username, fee in entrants]
+    _record_prizes(connection, tournament_id, refunds, cancelled=True)
+    return refunds
+
+
+def _record_prizes(connection, tournament_id, prizes, cancelled):
+    connection.executemany(
+        'INSERT INTO tournament_prizes (tournament_id, user_id, place, amount) VALUES (?, ?, ?, ?)',
+        [(tournament_id, user_id, place, amount) for user_id, place, amount in prizes]
+    )
+    connection.execute(
+        "UPDATE tournaments SET status = 'paying', deadline = NULL, pending = 0, cancelled = ? WHERE tournament_id = ?",
+        (int(cancelled), tournament_id)
+    )
+
+
+def unpaid_prizes(connection, tournament_id):
+    return connection.execute(
+        'SELECT user_id, place, amount FROM tournament_prizes WHERE tournament_id = ? ORDER BY place', (tournament_id,)
+    ).fetchall()
+
+
+def finish(connection, tournament_id):
+    connection.execute(
+        "UPDATE tournaments SET status = CASE cancelled WHEN 1 THEN 'cancelled' ELSE 'finished' END "
+        "WHERE tournament_id = ? AND status = 'paying'",
+        (tournament_id,)
+    )
+
+
+def top_players(connection, tournament_id, limit=5):
+    """(user_id, username, place, amount) of the prize winners, or the leaders by wins while running."""
+    rows = connection.execute(
+        'SELECT p.user_id, p.username, z.place, z.amount FROM tournament_prizes z '
+        'JOIN tournament_players p ON p.tournament_id = z.tournament_id AND p.user_id = z.user_id '
+        'WHERE z.tournament_id = ? AND z.place IS NOT NULL ORDER BY z.place LIMIT ?',
+        (tournament_id, limit)
+    ).fetchall()
+    if rows:
+        return rows
+    return connection.execute(
+        'SELECT user_id, username, wins, NULL FROM tournament_players WHERE tournament_id = ? '
+        'ORDER BY eliminated_round IS NOT NULL, wins DESC, seed LIMIT ?',
+        (tournament_id, limit)
+    ).fetchall()
+
+
+# Storage jobs - the entrant's shard
+def register(connection, tournament_id, user_id, username, fee):
+    """Take the entry fee and register; Settlement-like (ok, balance, battles_won)."""
+    if connection.execute(
+        'SELECT 1 FROM tournament_entries WHERE tournament_id = ? AND user_id = ?', (tournament_id, user_id)
+    ).fetchone():
+        return None
+    rows = connection.execute(
+        'UPDATE users SET coins = coins - ? WHERE user_id = ? AND coins >= ? RETURNING coins, battles_won',
+        (fee, user_id, fee)
+    ).fetchall()
+    if not rows:
+        current = connection.execute(
+            'SELECT coins, battles_won FROM users WHERE user_id = ?', (user_id,)
+        ).fetchone() or (0, 0)
+        return (False, *current)
+    connection.execute(
+        'INSERT INTO tournament_entries (tournament_id, user_id, username, fee) VALUES (?, ?, ?, ?)',
+        (tournament_id, user_id, username, fee)
+    )
+    return (True, *rows[0])
+
+
+def is_registered(connection, tournament_id, user_id):
+    return connection.execute(
+        'SELECT 1 FROM tournament_entries WHERE tournament_id = ? AND user_id = ?', (tournament_id, user_id)
+    ).fetchone() is not None
+
+
+def entrants(connection, tournament_id):
+    return connection.execute(
+        'SELECT user_id, username, fee FROM tournament_entries WHERE tournament_id = ?', (tournament_id,)
+    ).fetchall()
+
+
+def count_entrants(connection, tournament_id):
+    return connection.execute(
+        'SELECT COUNT(*) FROM tournament_entries WHERE tournament_id = ?', (tournament_id,)
+    ).fetchone()[0]
+
+
+def pay_prizes(connection, tournament_id, prizes):
+    """Credit this shard's prizes and refunds; entries already paid are skipped.
+
+    Returns [(user_id, coins, battles_won)] of the players credited now.
+    """
+    paid = []
+    for user_id, amount in prizes:
+        marked = connection.execute(
+            'UPDATE tournament_entries SET prize = ? WHERE tournament_id = ? AND user_id = ? AND prize IS NULL',
+            (amount, tournament_id, user_id)
+        ).rowcount
+        if not marked:
+            continue
+        rows = connection.execute(
+            'UPDATE users SET coins = coins + ? WHERE user_id = ? RETURNING coins, battles_won', (amount, user_id)
+        ).fetchall()
+        if rows:
+            paid.append((user_id, *rows[0]))
+    return paid
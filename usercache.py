@@ -0,0 +1,130 @@
+from collections import OrderedDict
+
+
+class UserRecord:
+    """One row of the users table with named fields.
+
+    __slots__ keeps every cached player at a fixed, small footprint (no
+    per-instance __dict__), which matters once the cache holds millions.
+    """
+
+    __slots__ = ('user_id', 'username', 'coins', 'gems', 'level',
+                 'battles_won', 'battles_lost', 'created_date', 'rating')
+
+    # Column list for SELECTs that feed from_row()
+    COLUMNS = ', '.join(__slots__)
+
+    def __init__(self, user_id, username, coins, gems, level,
+                 battles_won, battles_lost, created_date, rating=1000):
+        self.user_id = user_id
+        self.username = username
+        self.coins = coins
+        self.gems = gems
+        self.level = level
+        self.battles_won = battles_won
+        self.battles_lost = battles_lost
+        self.created_date = created_date
+        self.rating = rating
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*row)
+
+    def __repr__(self):
+        return f"UserRecord(user_id={self.user_id}, coins={self.coins}, level={self.level})"
+
+
+class UserCache:
+    """Bounded LRU of UserRecord keyed by user_id.
+
+    Reads fill the cache, every balance write updates it in place
+    (write-through), so a hot player never goes back to SQLite. A write to
+    a player who isn't cached has nothing to update, so while a miss read
+    is in flight the player's writes are counted: a read that saw a write
+    land after it started is not cached, since its row may predate it.
+    """
+
+    def __init__(self, capacity=100_000):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._records = OrderedDict()
+        # user_id -> [miss reads in flight, writes seen since the first one started]
+        self._reads = {}
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, user_id):
+        record = self._records.get(user_id)
+        if record is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._records.move_to_end(user_id)
+        return record
+
+    def put(self, record):
+        self._records[record.user_id] = record
+        self._records.move_to_end(record.user_id)
+        while len(self._records) > self.capacity:
+            self._records.popitem(last=False)
+            self.evictions += 1
+        return record
+
+    def begin_read(self, user_id):
+        """Start a miss read; pass the returned version to end_read()."""
+        entry = self._reads.setdefault(user_id, [0, 0])
+        entry[0] += 1
+        return entry[1]
+
+    def end_read(self, user_id, version):
+        """Finish a miss read; False if a write landed while it ran."""
+        entry = self._reads[user_id]
+        entry[0] -= 1
+        if not entry[0]:
+            del self._reads[user_id]
+        return entry[1] == version
+
+    def fill(self, record):
+        # A read that raced with a write must not replace the fresher entry
+        cached = self._records.get(record.user_id)
+        if cached is not None:
+            return cached
+        return self.put(record)
+
+    def update_balance(self, user_id, coins, battles_won=None, battles_lost=None, rating=None, gems=None):
+        record = self._records.get(user_id)
+        if record is None:
+            self._written(user_id)
+            return
+        record.coins = coins
+        if battles_won is not None:
+            record.battles_won = battles_won
+        if battles_lost is not None:
+            record.battles_lost = battles_lost
+        if rating is not None:
+            record.rating = rating
+        if gems is not None:
+            record.gems = gems
+
+    def invalidate(self, user_id):
+        self._records.pop(user_id, None)
+        self._written(user_id)
+
+    def _written(self, user_id):
+        entry = self._reads.get(user_id)
+        if entry is not None:
+            entry[1] += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._records),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }